@@ -12,7 +12,7 @@ app = Flask(__name__)
 
 # Configure logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get("LOG_LEVEL", "DEBUG").upper(),
     format='%(asctime)s [%(levelname)s] %(message)s'
 )
 
@@ -24,8 +24,104 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 app.config["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY")
+app.config["OPENAI_BASE_URL"] = os.environ.get("OPENAI_BASE_URL")  # None uses the public API
+app.config["OPENAI_TIMEOUT"] = float(os.environ.get("OPENAI_TIMEOUT", 30))  # per attempt, seconds
+app.config["OPENAI_DEADLINE"] = float(os.environ.get("OPENAI_DEADLINE", 45))  # all attempts, seconds
+app.config["OPENAI_MAX_RETRIES"] = int(os.environ.get("OPENAI_MAX_RETRIES", 2))
+app.config["OPENAI_BREAKER_THRESHOLD"] = int(os.environ.get("OPENAI_BREAKER_THRESHOLD", 5))  # consecutive failures
+app.config["OPENAI_BREAKER_RESET"] = float(os.environ.get("OPENAI_BREAKER_RESET", 30))  # seconds before a probe
+
+# Connection pools of the async HTTP clients used by asgi.py (per process)
+app.config["ASYNC_MAX_CONNECTIONS"] = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 200))
+app.config["ASYNC_MAX_KEEPALIVE"] = int(os.environ.get("ASYNC_MAX_KEEPALIVE", 50))
+app.config["ASGI_WSGI_THREADS"] = int(os.environ.get("ASGI_WSGI_THREADS", 32))  # threads serving WSGI fallbacks
+app.config["ASGI_BODY_SPOOL_SIZE"] = int(os.environ.get("ASGI_BODY_SPOOL_SIZE", 1024 * 1024))  # bytes in memory, then disk
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB max file size
-app.config["UPLOAD_FOLDER"] = os.path.join(app.root_path, 'static', 'uploads')
+app.config["UPLOAD_FOLDER"] = os.environ.get("UPLOAD_FOLDER", os.path.join(app.root_path, 'static', 'uploads'))
+
+# Upload storage ('local' keeps files in UPLOAD_FOLDER, 's3' uses an S3-compatible bucket)
+app.config["STORAGE_BACKEND"] = os.environ.get("STORAGE_BACKEND", "local")
+app.config["STORAGE_PUBLIC_URL"] = os.environ.get("STORAGE_PUBLIC_URL")  # CDN or bucket URL serving the objects
+app.config["STORAGE_S3_BUCKET"] = os.environ.get("STORAGE_S3_BUCKET")
+app.config["STORAGE_S3_PREFIX"] = os.environ.get("STORAGE_S3_PREFIX", "uploads/")
+app.config["STORAGE_S3_ENDPOINT_URL"] = os.environ.get("STORAGE_S3_ENDPOINT_URL")  # e.g. MinIO; None uses AWS
+app.config["STORAGE_S3_REGION"] = os.environ.get("STORAGE_S3_REGION")
+app.config["STORAGE_CACHE_FOLDER"] = os.environ.get("STORAGE_CACHE_FOLDER", os.path.join(app.root_path, 'instance', 'upload_cache'))
+app.config["STORAGE_ORPHAN_AGE"] = int(os.environ.get("STORAGE_ORPHAN_AGE", 24 * 60 * 60))  # seconds before cleanup may remove
+
+# Task suggestion cache ('memory' per process, or 'sql' shared through the database)
+app.config["TASK_CACHE_BACKEND"] = os.environ.get("TASK_CACHE_BACKEND", "memory")
+app.config["TASK_CACHE_TTL"] = int(os.environ.get("TASK_CACHE_TTL", 24 * 60 * 60))  # capped at the daily rollover
+app.config["TASK_CACHE_MAX_ENTRIES"] = int(os.environ.get("TASK_CACHE_MAX_ENTRIES", 1024))
+app.config["TASK_CACHE_PRECISION"] = int(os.environ.get("TASK_CACHE_PRECISION", 2))  # decimal places, ~1km
+
+# Materialized task sets (scheduler.py regenerates regions requested within this many days)
+app.config["TASK_REGION_ACTIVE_DAYS"] = int(os.environ.get("TASK_REGION_ACTIVE_DAYS", 7))
+app.config["TASK_BATCH_MAX_REGIONS"] = int(os.environ.get("TASK_BATCH_MAX_REGIONS", 25))  # per model call
+app.config["TASK_BATCH_MAX_TOKENS"] = int(os.environ.get("TASK_BATCH_MAX_TOKENS", 4000))  # estimated prompt + output
+app.config["TASK_BATCH_OUTPUT_TOKENS"] = int(os.environ.get("TASK_BATCH_OUTPUT_TOKENS", 80))  # expected per region
+app.config["TASK_BATCH_TIMEOUT"] = float(os.environ.get("TASK_BATCH_TIMEOUT", 120))  # per attempt, seconds
+
+# Coalescing of identical in-flight geocoding and task generation calls
+# ('local' across threads, 'db' also across processes via PostgreSQL advisory locks)
+app.config["SINGLE_FLIGHT_BACKEND"] = os.environ.get("SINGLE_FLIGHT_BACKEND", "local")
+# Connections per process holding 'db' locks, in their own pool on top of the app's (5 + 10 overflow)
+app.config["SINGLE_FLIGHT_LOCK_POOL"] = int(os.environ.get("SINGLE_FLIGHT_LOCK_POOL", 5))
+
+# Reverse geocoding ('online' uses Nominatim, 'offline' the gazetteer, 'auto' gazetteer first)
+app.config["GEOCODER_MODE"] = os.environ.get("GEOCODER_MODE", "online")
+app.config["GEOCODER_GAZETTEER"] = os.environ.get("GEOCODER_GAZETTEER")  # TSV: lat, lng, city, state, country
+app.config["GEOCODER_OFFLINE_MAX_KM"] = float(os.environ.get("GEOCODER_OFFLINE_MAX_KM", 50))
+app.config["GEOCODER_PRECISION"] = int(os.environ.get("GEOCODER_PRECISION", 2))
+app.config["GEOCODER_CACHE_TTL"] = int(os.environ.get("GEOCODER_CACHE_TTL", 30 * 24 * 60 * 60))
+app.config["GEOCODER_CACHE_MAX_ENTRIES"] = int(os.environ.get("GEOCODER_CACHE_MAX_ENTRIES", 100000))
+app.config["GEOCODER_TIMEOUT"] = float(os.environ.get("GEOCODER_TIMEOUT", 5))
+app.config["NOMINATIM_URL"] = os.environ.get("NOMINATIM_URL", "https://nominatim.openstreetmap.org/reverse")
+
+# Upload preprocessing (longest side in px; 'jpeg' or 'webp')
+app.config["IMAGE_MAX_DIMENSION"] = int(os.environ.get("IMAGE_MAX_DIMENSION", 1024))
+app.config["IMAGE_THUMBNAIL_SIZE"] = int(os.environ.get("IMAGE_THUMBNAIL_SIZE", 640))
+app.config["IMAGE_QUALITY"] = int(os.environ.get("IMAGE_QUALITY", 85))
+app.config["IMAGE_FORMAT"] = os.environ.get("IMAGE_FORMAT", "jpeg")
+
+# Recognition cache (exact content hash always; perceptual hash for near-duplicates)
+app.config["RECOGNITION_CACHE_PHASH"] = os.environ.get("RECOGNITION_CACHE_PHASH", "").lower() in ("1", "true", "yes")
+app.config["RECOGNITION_CACHE_PHASH_DISTANCE"] = int(os.environ.get("RECOGNITION_CACHE_PHASH_DISTANCE", 3))  # differing bits of 64, at most 3
+
+# Local pre-classifier ('' off, 'quality' blank/blur gate, 'onnx' gate plus classifier model)
+app.config["LOCAL_CLASSIFIER"] = os.environ.get("LOCAL_CLASSIFIER", "")
+app.config["LOCAL_CLASSIFIER_MODEL"] = os.environ.get("LOCAL_CLASSIFIER_MODEL")  # .onnx file
+app.config["LOCAL_CLASSIFIER_LABELS"] = os.environ.get("LOCAL_CLASSIFIER_LABELS")  # one class name per line
+app.config["LOCAL_CLASSIFIER_THREADS"] = int(os.environ.get("LOCAL_CLASSIFIER_THREADS", 1))  # per process
+app.config["LOCAL_CLASSIFIER_ANSWER_THRESHOLD"] = float(os.environ.get("LOCAL_CLASSIFIER_ANSWER_THRESHOLD", 0.9))
+app.config["LOCAL_CLASSIFIER_REJECT_THRESHOLD"] = float(os.environ.get("LOCAL_CLASSIFIER_REJECT_THRESHOLD", 0.9))
+app.config["IMAGE_MIN_CONTRAST"] = float(os.environ.get("IMAGE_MIN_CONTRAST", 8))  # grey-level std dev
+app.config["IMAGE_MIN_SHARPNESS"] = float(os.environ.get("IMAGE_MIN_SHARPNESS", 4))  # edge std dev
+
+# Background recognition ('mode=async' form field or RECOGNITION_ASYNC for every upload)
+app.config["RECOGNITION_ASYNC"] = os.environ.get("RECOGNITION_ASYNC", "").lower() in ("1", "true", "yes")
+app.config["RECOGNITION_WORKERS"] = int(os.environ.get("RECOGNITION_WORKERS", 4))
+app.config["RECOGNITION_QUEUE_SIZE"] = int(os.environ.get("RECOGNITION_QUEUE_SIZE", 32))  # queued + running jobs
+app.config["RECOGNITION_JOB_TIMEOUT"] = int(os.environ.get("RECOGNITION_JOB_TIMEOUT", 5 * 60))  # seconds pending before a job is stale
+
+# Rendered share and badge pages (server-side TTL, then Cache-Control max-age for clients/CDNs; seconds)
+app.config["SHARE_CACHE_TTL"] = int(os.environ.get("SHARE_CACHE_TTL", 60 * 60))
+app.config["SHARE_MAX_AGE"] = int(os.environ.get("SHARE_MAX_AGE", 5 * 60))
+app.config["BADGES_CACHE_TTL"] = int(os.environ.get("BADGES_CACHE_TTL", 5 * 60))
+app.config["BADGES_MAX_AGE"] = int(os.environ.get("BADGES_MAX_AGE", 60))
+
+# Leaderboards and stats read spotting_rollup; "inline" updates it with each spotting,
+# "deferred" leaves it to scripts/rebuild_rollups.py run from cron
+app.config["ROLLUP_MODE"] = os.environ.get("ROLLUP_MODE", "inline")
+app.config["STATS_CACHE_TTL"] = int(os.environ.get("STATS_CACHE_TTL", 60))
+app.config["STATS_MAX_AGE"] = int(os.environ.get("STATS_MAX_AGE", 60))
+
+# Requests issuing more SQL statements than this are logged (likely N+1 lazy loads); 0 turns the check off
+app.config["QUERY_COUNT_WARN"] = int(os.environ.get("QUERY_COUNT_WARN", 20))
+
+# Prometheus metrics at /metrics, optionally with per-request Server-Timing headers
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING", "").lower() in ("1", "true", "yes")
 
 # Ensure upload directory exists with proper permissions
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
@@ -33,13 +129,26 @@ os.chmod(app.config["UPLOAD_FOLDER"], 0o755)
 
 db.init_app(app)
 
-# Register routes after db initialization
+# Migrate the schema before registering routes, which seed badges and counters
 with app.app_context():
+    from migrations import run_migrations
+    run_migrations()
+
+    from services import openai_client
+    openai_client.init_app(app)
+
+    from services import query_counter
+    query_counter.init_app(app, db.engine)
+
+    from services import metrics
+    metrics.init_app(app)
+
     from routes import register_routes
     register_routes(app)
-    
-    import models
-    db.create_all()
+
+    # Jobs pending in the pool of a process that has since exited will never finish
+    from services import recognition_jobs
+    recognition_jobs.expire_stale()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
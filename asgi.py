@@ -0,0 +1,263 @@
+"""ASGI entry point: async views for the I/O-bound endpoints, WSGI for the rest.
+
+Run with an ASGI server (uvicorn is a project dependency)::
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+
+``python main.py`` still starts the plain WSGI development server, without the
+async views.
+
+POST /api/tasks, /api/recognize and /api/recognize/stream (the path the camera
+page uses) are served by the async views in async_routes.py, which await
+Nominatim and OpenAI through pooled async HTTP clients, so one process holds
+many upstream calls in flight. Database and image work still runs in worker
+threads. Every other request, and any request an async view declines, goes to
+the Flask WSGI app with its response streamed back chunk by chunk (server-sent
+events keep working). WSGI requests run on a pool of ASGI_WSGI_THREADS threads
+of their own, so slow WSGI views cannot starve the default executor the async
+views use for database work.
+
+Request bodies are spooled to a temporary file once they exceed
+ASGI_BODY_SPOOL_SIZE, so concurrent uploads do not each hold up to
+MAX_CONTENT_LENGTH in memory.
+
+Async views run with the app's before/after-request, error and teardown
+handlers, so query counting, metrics and Server-Timing cover them too.
+"""
+import asyncio
+import logging
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from flask import request_started
+from app import app
+from async_routes import ASYNC_VIEWS
+from services.location_service import close_async_http_client
+from services.openai_client import close_async_clients
+
+logger = logging.getLogger(__name__)
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=app.config.get('ASGI_WSGI_THREADS', 32),
+                                    thread_name_prefix='wsgi')
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+async def read_body(receive, limit, spool_size):
+    """Spool the request body to a file, in memory up to ``spool_size`` bytes.
+
+    Returns the file rewound to the start, or None if the client disconnected first.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            chunk = message.get('body', b'')
+            if limit is not None and body.tell() + len(chunk) > limit:
+                raise _BodyTooLarge()
+            body.write(chunk)
+            if not message.get('more_body'):
+                body.seek(0)
+                return body
+    except BaseException:
+        body.close()
+        raise
+
+
+def build_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope and its spooled body."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    length = body.seek(0, 2)
+    body.seek(0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+async def send_simple(send, status, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': _encode_headers([('Content-Type', 'text/plain; charset=utf-8'),
+                                    ('Content-Length', str(len(body)))]),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def serve_async_view(view, declines, environ, send):
+    """Run an async view as Flask's full_dispatch_request would; returns False when it declined.
+
+    before_request hooks may answer in place of the view, errors go through the
+    app's error handlers, after_request hooks see the response, and teardown hooks
+    run once the body is sent. A response whose body is an async iterator is
+    streamed chunk by chunk with the request context still active.
+    """
+    with app.request_context(environ):
+        if declines is not None and declines():
+            return False
+        try:
+            try:
+                request_started.send(app, _async_wrapper=app.ensure_sync)
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = await view()
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            response = app.finalize_request(rv)
+        except Exception as e:
+            response = app.handle_exception(e)
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': _encode_headers(response.headers.to_wsgi_list()),
+        })
+        if hasattr(response.response, '__aiter__'):
+            async for chunk in response.response:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        else:
+            await send({'type': 'http.response.body', 'body': response.get_data()})
+    return True
+
+
+async def serve_wsgi(environ, send):
+    """Run the Flask WSGI app on the WSGI thread pool, streaming its response back."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def put(*item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def run():
+        response = {}
+
+        def emit(data):
+            if not response.get('started'):
+                response['started'] = True
+                put('start', response['status'], response['headers'])
+            if data:
+                put('body', data)
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return emit
+
+        try:
+            result = app(environ, start_response)
+            try:
+                for chunk in result:
+                    emit(chunk)
+                emit(b'')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as e:
+            put('error', e)
+        else:
+            put('end')
+
+    worker = loop.run_in_executor(_wsgi_executor, run)
+    started = False
+    try:
+        while True:
+            kind, *data = await queue.get()
+            if kind == 'start':
+                started = True
+                status, headers = data
+                await send({'type': 'http.response.start', 'status': status,
+                            'headers': _encode_headers(headers)})
+            elif kind == 'body':
+                await send({'type': 'http.response.body', 'body': data[0], 'more_body': True})
+            elif kind == 'end':
+                await send({'type': 'http.response.body', 'body': b''})
+                break
+            else:
+                logger.error(f"WSGI application failed: {str(data[0])}", exc_info=data[0])
+                if not started:
+                    await send_simple(send, 500, b'Internal Server Error')
+                break
+    finally:
+        await worker
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_clients()
+            await close_async_http_client()
+            _wsgi_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        raise RuntimeError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    try:
+        body = await read_body(receive, app.config.get('MAX_CONTENT_LENGTH'),
+                               app.config.get('ASGI_BODY_SPOOL_SIZE', 1024 * 1024))
+    except _BodyTooLarge:
+        await send_simple(send, 413, b'Request Entity Too Large')
+        return
+    if body is None:
+        return
+
+    with body:
+        environ = build_environ(scope, body)
+        entry = ASYNC_VIEWS.get((scope['method'], environ['PATH_INFO']))
+        if entry is not None and await serve_async_view(*entry, environ, send):
+            return
+        body.seek(0)
+        await serve_wsgi(environ, send)
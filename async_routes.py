@@ -0,0 +1,145 @@
+"""Async views for the I/O-bound endpoints, served by asgi.py.
+
+Each view runs on the event loop inside a Flask request context and mirrors
+its WSGI counterpart in routes.py. ASYNC_VIEWS maps a method and path to
+``(view, declines)``; when ``declines()`` is true the request goes to the WSGI
+app instead (e.g. background recognition, which is already non-blocking).
+"""
+import asyncio
+from flask import Response, request, jsonify, current_app, session, url_for
+from routes import save_image_upload, sse
+from services.location_service import get_location_info_async, parse_coordinates
+from services.recognition_service import process_upload_async, remove_upload, stream_upload_async
+from services.task_cache import get_or_generate_tasks_async, region_key
+
+
+async def get_tasks():
+    try:
+        if not request.is_json:
+            return jsonify({
+                'error': 'Invalid request format. Expected JSON.'
+            }), 400
+
+        data = request.get_json()
+        if not data:
+            return jsonify({
+                'error': 'Missing request data.'
+            }), 400
+
+        lat = data.get('latitude')
+        lng = data.get('longitude')
+
+        if lat is None or lng is None:
+            return jsonify({
+                'error': 'Location coordinates are required. Please enable location access.'
+            }), 400
+        lat, lng = parse_coordinates(lat, lng)
+
+        location_info = await get_location_info_async(lat, lng)
+        if 'error' in location_info:
+            return jsonify({
+                'error': f'Failed to get location information: {location_info["error"]}'
+            }), 500
+
+        tasks = await get_or_generate_tasks_async(lat, lng, location_info)
+        session['task_region'] = region_key(lat, lng, location_info)
+        return jsonify(tasks)
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Error generating tasks: {str(e)}", exc_info=True)
+        return jsonify({
+            'error': 'Failed to generate tasks. Please try again later.'
+        }), 500
+
+
+def wants_background_job():
+    return current_app.config['RECOGNITION_ASYNC'] or request.form.get('mode') == 'async'
+
+
+async def recognize():
+    try:
+        # Decoding and resizing the image is CPU work; keep it off the event loop
+        filename, content_hash, created = await asyncio.to_thread(save_image_upload)
+        task_id = request.form.get('task_id')
+        location = request.form.get('location')
+
+        try:
+            result, share_id, badge_names = await process_upload_async(filename, content_hash, task_id, location)
+            return jsonify({
+                'result': result["animal"],
+                'details': result["details"],
+                'new_badges': badge_names,
+                'share_url': url_for('share', share_id=share_id, _external=True)
+            })
+
+        except Exception as e:
+            # Clean up file if processing failed, unless an earlier upload owns it
+            if created:
+                remove_upload(filename)
+            raise e
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Error processing image: {str(e)}", exc_info=True)
+        return jsonify({
+            'error': 'Failed to process image. Please try again with a different image.'
+        }), 500
+
+
+async def recognize_stream():
+    try:
+        filename, content_hash, created = await asyncio.to_thread(save_image_upload)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Error storing image: {str(e)}", exc_info=True)
+        return jsonify({
+            'error': 'Failed to process image. Please try again with a different image.'
+        }), 500
+
+    task_id = request.form.get('task_id')
+    location = request.form.get('location')
+
+    async def generate():
+        try:
+            async for event, data in stream_upload_async(filename, content_hash, task_id, location):
+                if event == 'animal':
+                    yield sse('animal', {'animal': data})
+                elif event == 'detail':
+                    field, value = data
+                    yield sse('detail', {'field': field, 'value': value})
+                else:
+                    result, share_id, badge_names = data
+                    yield sse('done', {
+                        'result': result["animal"],
+                        'details': result["details"],
+                        'new_badges': badge_names,
+                        'share_url': url_for('share', share_id=share_id, _external=True)
+                    })
+        except Exception as e:
+            # Clean up file if processing failed, unless an earlier upload owns it
+            if created:
+                await asyncio.to_thread(remove_upload, filename)
+            if isinstance(e, ValueError):
+                yield sse('error', {'error': str(e)})
+                return
+            current_app.logger.error(f"Error streaming recognition: {str(e)}", exc_info=True)
+            yield sse('error', {
+                'error': 'Failed to process image. Please try again with a different image.'
+            })
+
+    # asgi.py sends the body as the async generator produces it
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # let proxies pass events through unbuffered
+    })
+
+
+ASYNC_VIEWS = {
+    ('POST', '/api/tasks'): (get_tasks, None),
+    ('POST', '/api/recognize'): (recognize, wants_background_job),
+    ('POST', '/api/recognize/stream'): (recognize_stream, wants_background_job),
+}
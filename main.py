@@ -1,3 +1,4 @@
+# WSGI development server; see asgi.py to serve the async views with uvicorn
 from app import app
 
 if __name__ == "__main__":
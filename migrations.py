@@ -0,0 +1,110 @@
+"""Ordered schema migrations, applied once each at startup.
+
+Each migration is a function taking the connection of the migration
+transaction. Applied versions are recorded in ``schema_version``; add new
+migrations to the end of ``MIGRATIONS`` and never renumber existing ones.
+"""
+import logging
+from sqlalchemy import inspect, select, text
+from app import db
+from models import (
+    AnimalSpotting, Badge, RecognitionCacheEntry, RecognitionJob, SchemaVersion, SpottingRollup, Task, TaskRegion,
+    spotting_badges
+)
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK = 0x616e696d  # pg_advisory_xact_lock key shared by all workers
+
+
+def create_tables(connection):
+    db.metadata.create_all(connection)
+
+
+def create_indexes(connection, table, names):
+    for index in table.indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+
+def add_hot_path_indexes(connection):
+    """Index the columns the index, share, task and achievement queries filter and sort on."""
+    create_indexes(connection, Task.__table__, {'ix_task_expires_at_created_at'})
+    create_indexes(connection, AnimalSpotting.__table__, {'ix_animal_spotting_task_id', 'ix_animal_spotting_spotted_at'})
+    create_indexes(connection, spotting_badges, {'ix_spotting_badges_awarded_at', 'ix_spotting_badges_badge_id'})
+
+
+def widen_badge_criteria(connection):
+    """Badge rules are JSON and no longer fit the original VARCHAR(100)."""
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(f'ALTER TABLE {Badge.__tablename__} ALTER COLUMN criteria TYPE TEXT'))
+
+
+def add_task_regions(connection):
+    """Tasks are materialized per region by scheduler.py."""
+    columns = {column['name'] for column in inspect(connection).get_columns(Task.__tablename__)}
+    if 'region' not in columns:
+        connection.execute(text(f'ALTER TABLE {Task.__tablename__} ADD COLUMN region VARCHAR(255)'))
+    create_indexes(connection, Task.__table__, {'ix_task_region_expires_at'})
+    TaskRegion.__table__.create(connection, checkfirst=True)
+
+
+def add_spotting_rollups(connection):
+    """Leaderboards and stats read per-day rollups.
+
+    Existing spottings are not counted here, which would hold the migration lock
+    for a full scan; run scripts/rebuild_rollups.py once after deploying.
+    """
+    SpottingRollup.__table__.create(connection, checkfirst=True)
+    logger.warning("Run scripts/rebuild_rollups.py to count spottings recorded before the rollups")
+
+
+def add_job_error_messages(connection):
+    """Failed jobs keep the user-facing rejection reason apart from the internal error."""
+    columns = {column['name'] for column in inspect(connection).get_columns(RecognitionJob.__tablename__)}
+    if 'error_message' not in columns:
+        connection.execute(text(f'ALTER TABLE {RecognitionJob.__tablename__} ADD COLUMN error_message VARCHAR(255)'))
+
+
+def add_phash_band_indexes(connection):
+    """Near-duplicate lookups match any 16-bit band of the perceptual hash, then compare bits."""
+    create_indexes(connection, RecognitionCacheEntry.__table__, {
+        f'ix_recognition_cache_entry_phash_band{band}' for band in range(4)
+    })
+
+
+def coarsen_location_rollups(connection):
+    """Location rollups were keyed by 0.1 degree cells, too precise for a public leaderboard.
+
+    The old rows are dropped; run scripts/rebuild_rollups.py to recount them by place.
+    """
+    connection.execute(SpottingRollup.__table__.delete().where(SpottingRollup.dimension == 'location'))
+    logger.warning("Run scripts/rebuild_rollups.py to recount location rollups by place")
+
+
+MIGRATIONS = [
+    (1, 'create tables', create_tables),
+    (2, 'add hot path indexes', add_hot_path_indexes),
+    (3, 'widen badge criteria', widen_badge_criteria),
+    (4, 'add task regions', add_task_regions),
+    (5, 'add spotting rollups', add_spotting_rollups),
+    (6, 'add job error messages', add_job_error_messages),
+    (7, 'add phash band indexes', add_phash_band_indexes),
+    (8, 'coarsen location rollups', coarsen_location_rollups),
+]
+
+
+def run_migrations():
+    """Apply pending migrations in one transaction, serialised across workers."""
+    with db.engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK})
+        SchemaVersion.__table__.create(connection, checkfirst=True)
+        applied = set(connection.execute(select(SchemaVersion.version)).scalars())
+
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {name}")
+            migrate(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(version=version, name=name))
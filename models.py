@@ -7,17 +7,30 @@ class Task(db.Model):
     animal = db.Column(db.String(100), nullable=False)
     task_type = db.Column(db.String(10), nullable=False)  # 'daily' or 'weekly'
     location = db.Column(db.String(100))
+    region = db.Column(db.String(255))  # TaskRegion.key of the materialized task set
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=False)
 
+    # Current tasks are selected by expiry and creation date, task sets by region
+    __table_args__ = (
+        db.Index('ix_task_expires_at_created_at', 'expires_at', 'created_at'),
+        db.Index('ix_task_region_expires_at', 'region', 'expires_at'),
+    )
+
+class TaskRegion(db.Model):
+    key = db.Column(db.String(255), primary_key=True)  # task_cache.location_key
+    location_info = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_requested_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 class AnimalSpotting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    task_id = db.Column(db.Integer, db.ForeignKey('task.id'))
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), index=True)
     image_path = db.Column(db.String(255))
     recognition_result = db.Column(db.String(500))  # Increased from 100 to 500
     detailed_info = db.Column(db.JSON)  # Add JSON column for detailed animal information
     confidence_score = db.Column(db.Float)
-    spotted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    spotted_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     location = db.Column(db.String(100))
     share_id = db.Column(db.String(50), unique=True)
     task = db.relationship('Task', backref=db.backref('spottings', lazy=True))
@@ -37,7 +50,7 @@ class Badge(db.Model):
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(255))
     icon_class = db.Column(db.String(50))  # Font Awesome icon class
-    criteria = db.Column(db.String(100), nullable=False)  # e.g., 'first_spot', 'daily_5', 'weekly_complete'
+    criteria = db.Column(db.Text, nullable=False)  # legacy name ('first_spot', ...) or JSON rule, see services/badge_rules.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     spottings = db.relationship('AnimalSpotting', secondary='spotting_badges', back_populates='badges')
 
@@ -45,5 +58,81 @@ class Badge(db.Model):
 spotting_badges = db.Table('spotting_badges',
     db.Column('spotting_id', db.Integer, db.ForeignKey('animal_spotting.id'), primary_key=True),
     db.Column('badge_id', db.Integer, db.ForeignKey('badge.id'), primary_key=True),
-    db.Column('awarded_at', db.DateTime, default=datetime.utcnow)
+    db.Column('awarded_at', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_spotting_badges_awarded_at', 'awarded_at'),
+    db.Index('ix_spotting_badges_badge_id', 'badge_id')
 )
+
+class TaskCacheEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(255), unique=True, nullable=False)
+    tasks = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    accessed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class GeocodeCacheEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cell = db.Column(db.String(50), unique=True, nullable=False)  # rounded "lat,lng"
+    location_info = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class RecognitionCacheEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 of the upload
+    perceptual_hash = db.Column(db.String(16), index=True)  # dHash for near-duplicates
+    image_path = db.Column(db.String(255))
+    result = db.Column(db.JSON, nullable=False)  # {'animal': ..., 'details': {...}}
+    hit_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_hit_at = db.Column(db.DateTime)
+
+    # One index per 16-bit band of the dHash (see recognition_cache.PHASH_BANDS)
+    __table_args__ = (
+        db.Index('ix_recognition_cache_entry_phash_band0', db.func.substr(perceptual_hash, 1, 4)),
+        db.Index('ix_recognition_cache_entry_phash_band1', db.func.substr(perceptual_hash, 5, 4)),
+        db.Index('ix_recognition_cache_entry_phash_band2', db.func.substr(perceptual_hash, 9, 4)),
+        db.Index('ix_recognition_cache_entry_phash_band3', db.func.substr(perceptual_hash, 13, 4)),
+    )
+
+class RecognitionJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    status = db.Column(db.String(10), nullable=False, default='queued')  # 'queued', 'running', 'done', 'failed'
+    image_path = db.Column(db.String(255), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+    owns_file = db.Column(db.Boolean, default=True)  # False when the file predates this upload
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'))
+    location = db.Column(db.String(100))
+    spotting_id = db.Column(db.Integer, db.ForeignKey('animal_spotting.id'))
+    new_badges = db.Column(db.JSON)
+    error = db.Column(db.String(255))  # internal, for logs
+    error_message = db.Column(db.String(255))  # user-facing reason, only for rejected images
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    spotting = db.relationship('AnimalSpotting')
+
+class AchievementCounter(db.Model):
+    name = db.Column(db.String(64), primary_key=True)  # e.g. 'spottings:total', 'spottings:day:2024-11-16'
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SpottingRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    dimension = db.Column(db.String(16), nullable=False)  # 'all', 'species' or 'location'
+    key = db.Column(db.String(255), nullable=False)  # normalised species or location, '' for 'all'
+    day = db.Column(db.Date, nullable=False)  # rollups.TOTAL_DAY for all-time totals
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Counters are found by (dimension, key, day); leaderboards read one day ordered by value
+    __table_args__ = (
+        db.UniqueConstraint('dimension', 'key', 'day', name='uq_spotting_rollup_dimension_key_day'),
+        db.Index('ix_spotting_rollup_dimension_day_value', 'dimension', 'day', 'value'),
+    )
+
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True)  # see migrations.py
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -1,35 +1,74 @@
-import os
+import json
 from datetime import datetime, timedelta
-from flask import render_template, request, jsonify, current_app, url_for, abort
-from werkzeug.utils import secure_filename
+from flask import Response, render_template, request, jsonify, current_app, url_for, abort, redirect, send_from_directory, session, stream_with_context
 from app import db
 from models import Task, AnimalSpotting, Badge, spotting_badges  # Add spotting_badges import
-from services.gpt_service import generate_tasks, recognize_animal
-from services.location_service import get_location_info
+from services.location_service import get_location_info, parse_coordinates
 from services.achievement_service import AchievementService
+from services.openai_client import breaker
+from services.task_cache import cache_stats, get_or_generate_tasks, region_key
+from services import metrics, queries, recognition_cache, recognition_jobs, response_cache, rollups
+from services.recognition_service import process_upload, remove_upload, stream_upload
+from services.image_service import thumbnail_name
+from services.storage import CACHE_CONTROL, CACHE_MAX_AGE, LocalStorage, get_storage
+
+def save_image_upload():
+    """Validate the uploaded image and store it under its content hash.
+
+    Raises ValueError with a user-facing message for a missing or non-image upload.
+    """
+    if not request.files:
+        raise ValueError('No files were uploaded. Please capture or upload an image.')
+
+    file = request.files.get('image') or request.files.get('camera_image')
+    if not file:
+        raise ValueError('No image file provided. Please capture or upload an image.')
+
+    if not file.filename:
+        raise ValueError('No selected file. Please choose an image file.')
+
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise ValueError('Invalid file type. Please upload an image file (JPEG, PNG, etc.).')
+
+    # Store the file under its content hash so repeat uploads share one copy
+    return recognition_cache.save_upload(file)
+
+
+def sse(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 
 def register_routes(app):
-    # Ensure uploads directory exists
-    uploads_dir = os.path.join(app.root_path, 'static', 'uploads')
-    os.makedirs(uploads_dir, exist_ok=True)
+    @app.template_global()
+    def upload_thumbnail(image_path):
+        """Return the thumbnail for an upload, or the upload itself for older images."""
+        thumbnail = thumbnail_name(image_path)
+        if get_storage().exists(thumbnail):
+            return thumbnail
+        return image_path
+
+    @app.template_global()
+    def upload_url(key):
+        return get_storage().url(key)
+
+    @app.route('/uploads/<path:key>')
+    def upload_file(key):
+        """Serve a stored upload; keys are content-addressed, so responses never change."""
+        storage = get_storage()
+        if not isinstance(storage, LocalStorage):
+            return redirect(storage.url(key))
+        response = send_from_directory(storage.root, key, max_age=CACHE_MAX_AGE)
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        return response
 
     @app.route('/')
     def index():
-        # Get today's tasks
-        today = datetime.utcnow().date()
-        current_tasks = Task.query.filter(
-            Task.expires_at >= today,
-            Task.created_at <= today + timedelta(days=1)
-        ).all()
-        
+        # The template never renders current tasks (location.js requests them), so they are not queried here
         # Get recent badges (last 5)
-        recent_badges = Badge.query.join(spotting_badges)\
-            .join(AnimalSpotting)\
-            .order_by(spotting_badges.c.awarded_at.desc())\
-            .limit(5).all()
+        recent_badges = queries.recent_badges(5).all()
         
         return render_template('index.html', 
-                             current_tasks=current_tasks,
                              recent_badges=recent_badges)
 
     @app.route('/tasks')
@@ -38,13 +77,24 @@ def register_routes(app):
 
     @app.route('/badges')
     def badges():
-        all_badges = Badge.query.all()
-        return render_template('badges.html', badges=all_badges)
+        def render():
+            all_badges = Badge.query.all()
+            return render_template('badges.html', badges=all_badges)
+
+        return response_cache.cached_response(
+            'badges:page', render, app.config['BADGES_CACHE_TTL'], app.config['BADGES_MAX_AGE']
+        )
         
     @app.route('/share/<share_id>')
     def share(share_id):
-        spotting = AnimalSpotting.query.filter_by(share_id=share_id).first_or_404()
-        return render_template('share.html', spotting=spotting)
+        def render():
+            spotting = queries.spotting_by_share_id(share_id).first_or_404()
+            return render_template('share.html', spotting=spotting)
+
+        # A spotting does not change after recognition, so the page is rendered once per TTL
+        return response_cache.cached_response(
+            f"share:{share_id}", render, app.config['SHARE_CACHE_TTL'], app.config['SHARE_MAX_AGE']
+        )
 
     @app.route('/api/tasks', methods=['POST'])
     def get_tasks():
@@ -67,6 +117,7 @@ def register_routes(app):
                 return jsonify({
                     'error': 'Location coordinates are required. Please enable location access.'
                 }), 400
+            lat, lng = parse_coordinates(lat, lng)
                 
             location_info = get_location_info(lat, lng)
             if 'error' in location_info:
@@ -74,7 +125,8 @@ def register_routes(app):
                     'error': f'Failed to get location information: {location_info["error"]}'
                 }), 500
                 
-            tasks = generate_tasks(location_info)
+            tasks = get_or_generate_tasks(lat, lng, location_info)
+            session['task_region'] = region_key(lat, lng, location_info)
             return jsonify(tasks)
             
         except ValueError as e:
@@ -85,56 +137,37 @@ def register_routes(app):
                 'error': 'Failed to generate tasks. Please try again later.'
             }), 500
 
+    def enqueue_recognition(filename, content_hash, created, task_id, location):
+        """Hand an upload to the background workers and answer 202 with its status URL."""
+        try:
+            job = recognition_jobs.enqueue(filename, content_hash, task_id, location, owns_file=created)
+        except recognition_jobs.QueueFullError as e:
+            if created:
+                remove_upload(filename)
+            return jsonify({'error': str(e)}), 503
+        except Exception:
+            if created:
+                remove_upload(filename)
+            raise
+
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': url_for('recognition_status', job_id=job.id)
+        }), 202
+
     @app.route('/api/recognize', methods=['POST'])
     def recognize():
         try:
-            if not request.files:
-                return jsonify({
-                    'error': 'No files were uploaded. Please capture or upload an image.'
-                }), 400
+            filename, content_hash, created = save_image_upload()
+            task_id = request.form.get('task_id')
+            location = request.form.get('location')
 
-            file = request.files.get('image') or request.files.get('camera_image')
-            if not file:
-                return jsonify({
-                    'error': 'No image file provided. Please capture or upload an image.'
-                }), 400
-
-            if not file.filename:
-                return jsonify({
-                    'error': 'No selected file. Please choose an image file.'
-                }), 400
-                
-            if not file.content_type or not file.content_type.startswith('image/'):
-                return jsonify({
-                    'error': 'Invalid file type. Please upload an image file (JPEG, PNG, etc.).'
-                }), 400
-                
-            # Create a unique filename with timestamp
-            timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-            filename = secure_filename(f"{timestamp}_{file.filename}")
-            filepath = os.path.join(current_app.root_path, 'static/uploads', filename)
-            
-            # Save the file
-            file.save(filepath)
+            if current_app.config['RECOGNITION_ASYNC'] or request.form.get('mode') == 'async':
+                return enqueue_recognition(filename, content_hash, created, task_id, location)
             
             try:
-                # Process the image
-                result = recognize_animal(filepath)
-                
-                # Create spotting record and set attributes
-                spotting = AnimalSpotting()
-                spotting.task_id = request.form.get('task_id')
-                spotting.image_path = filename
-                spotting.recognition_result = result["animal"]
-                spotting.detailed_info = result["details"]
-                spotting.location = request.form.get('location')
-                spotting.generate_share_id()
-                
-                db.session.add(spotting)
-                db.session.commit()
-                
-                # Check and award achievements
-                new_badges = AchievementService.check_achievements(spotting)
+                result, spotting, new_badges = process_upload(filename, content_hash, task_id, location)
                 badge_names = [badge.name for badge in new_badges]
                 
                 return jsonify({
@@ -145,11 +178,9 @@ def register_routes(app):
                 })
                     
             except Exception as e:
-                # Clean up file if processing failed
-                try:
-                    os.remove(filepath)
-                except:
-                    pass
+                # Clean up file if processing failed, unless an earlier upload owns it
+                if created:
+                    remove_upload(filename)
                 raise e
                 
         except ValueError as e:
@@ -160,37 +191,197 @@ def register_routes(app):
                 'error': 'Failed to process image. Please try again with a different image.'
             }), 500
 
+    @app.route('/api/recognize/stream', methods=['POST'])
+    def recognize_stream():
+        """Recognize an upload, streaming the result as server-sent events.
+
+        Emits ``animal`` with the species as soon as it is known, ``detail`` for
+        each finished detail field and ``done`` with the same payload as
+        /api/recognize once the spotting is stored; ``error`` ends a failed stream.
+        """
+        try:
+            filename, content_hash, created = save_image_upload()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            current_app.logger.error(f"Error storing image: {str(e)}", exc_info=True)
+            return jsonify({
+                'error': 'Failed to process image. Please try again with a different image.'
+            }), 500
+
+        task_id = request.form.get('task_id')
+        location = request.form.get('location')
+
+        if current_app.config['RECOGNITION_ASYNC'] or request.form.get('mode') == 'async':
+            return enqueue_recognition(filename, content_hash, created, task_id, location)
+
+        def generate():
+            try:
+                for event, data in stream_upload(filename, content_hash, task_id, location):
+                    if event == 'animal':
+                        yield sse('animal', {'animal': data})
+                    elif event == 'detail':
+                        field, value = data
+                        yield sse('detail', {'field': field, 'value': value})
+                    else:
+                        result, spotting, new_badges = data
+                        yield sse('done', {
+                            'result': result["animal"],
+                            'details': result["details"],
+                            'new_badges': [badge.name for badge in new_badges],
+                            'share_url': url_for('share', share_id=spotting.share_id, _external=True)
+                        })
+            except Exception as e:
+                db.session.rollback()
+                # Clean up file if processing failed, unless an earlier upload owns it
+                if created:
+                    remove_upload(filename)
+                if isinstance(e, ValueError):
+                    yield sse('error', {'error': str(e)})
+                    return
+                current_app.logger.error(f"Error streaming recognition: {str(e)}", exc_info=True)
+                yield sse('error', {
+                    'error': 'Failed to process image. Please try again with a different image.'
+                })
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # let proxies pass events through unbuffered
+        })
+
+    @app.route('/api/recognize/<job_id>', methods=['GET'])
+    def recognition_status(job_id):
+        job = recognition_jobs.get_job(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown recognition job.'}), 404
+
+        data = {'job_id': job.id, 'status': job.status}
+        if job.status == 'done':
+            spotting = job.spotting
+            data.update({
+                'result': spotting.recognition_result,
+                'details': spotting.detailed_info,
+                'new_badges': job.new_badges or [],
+                'share_url': url_for('share', share_id=spotting.share_id, _external=True)
+            })
+        elif job.status == 'failed':
+            # Only rejected images have a reason worth showing; other errors stay in the logs
+            data['error'] = job.error_message or 'Failed to process image. Please try again with a different image.'
+            data['rejected'] = job.error_message is not None
+        return jsonify(data)
+
     @app.route('/api/badges', methods=['GET'])
     def get_badges():
-        try:
+        def render():
             badges = Badge.query.all()
-            return jsonify([{
+            return current_app.json.dumps([{
                 'name': badge.name,
                 'description': badge.description,
                 'icon_class': badge.icon_class
             } for badge in badges])
+
+        try:
+            return response_cache.cached_response(
+                'badges:api', render, app.config['BADGES_CACHE_TTL'], app.config['BADGES_MAX_AGE'],
+                mimetype='application/json'
+            )
         except Exception as e:
             current_app.logger.error(f"Error fetching badges: {str(e)}", exc_info=True)
             return jsonify({'error': 'Failed to fetch badges'}), 500
 
     @app.route('/api/tasks/current')
     def get_current_tasks():
+        """Progress on the current tasks of a region.
+
+        The region is the one of ``?latitude=...&longitude=...`` when given,
+        otherwise the last one this session asked tasks for; without either, the
+        current tasks of any region are listed as before regions existed.
+        """
+        lat = request.args.get('latitude')
+        lng = request.args.get('longitude')
+        region = session.get('task_region')
+        if lat is not None or lng is not None:
+            try:
+                lat, lng = parse_coordinates(lat, lng)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            location_info = get_location_info(lat, lng)
+            if 'error' in location_info:
+                return jsonify({
+                    'error': f'Failed to get location information: {location_info["error"]}'
+                }), 500
+            region = session['task_region'] = region_key(lat, lng, location_info)
+
         today = datetime.utcnow().date()
-        current_tasks = Task.query.filter(
-            Task.expires_at >= today,
-            Task.created_at <= today + timedelta(days=1)
-        ).all()
-        
         tasks_data = [{
-            'id': task.id,
-            'animal': task.animal,
-            'task_type': task.task_type,
-            'completed': bool(task.spottings),
-            'progress': len(task.spottings) if task.task_type == 'daily' else None
-        } for task in current_tasks]
+            'id': task_id,
+            'animal': animal,
+            'task_type': task_type,
+            'completed': spottings > 0,
+            'progress': spottings if task_type == 'daily' else None
+        } for task_id, animal, task_type, spottings in queries.current_task_progress(today, region)]
         
         return jsonify({'tasks': tasks_data})
 
+    def cached_stats(key, render):
+        try:
+            return response_cache.cached_response(
+                key, render, app.config['STATS_CACHE_TTL'], app.config['STATS_MAX_AGE'],
+                mimetype='application/json'
+            )
+        except Exception as e:
+            current_app.logger.error(f"Error fetching stats: {str(e)}", exc_info=True)
+            return jsonify({'error': 'Failed to fetch statistics'}), 500
+
+    @app.route('/api/stats/summary')
+    def stats_summary():
+        return cached_stats('stats:summary', lambda: current_app.json.dumps(rollups.summary()))
+
+    @app.route('/api/stats/daily')
+    def stats_daily():
+        days = min(max(request.args.get('days', 30, type=int), 1), 366)
+
+        def render():
+            return current_app.json.dumps({'days': [
+                {'date': day.isoformat(), 'spottings': count} for day, count in rollups.daily_counts(days)
+            ]})
+
+        return cached_stats(f"stats:daily:{days}", render)
+
+    @app.route('/api/leaderboard/<board>')
+    def leaderboard(board):
+        dimension = {'species': 'species', 'locations': 'location'}.get(board)
+        if dimension is None:
+            return jsonify({'error': 'Unknown leaderboard. Use species or locations.'}), 404
+        period = request.args.get('period', 'week')
+        if period not in rollups.PERIODS:
+            return jsonify({'error': f"Invalid period. Use one of: {', '.join(rollups.PERIODS)}."}), 400
+        limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+
+        def render():
+            return current_app.json.dumps({'period': period, 'entries': [
+                {'name': key, 'spottings': count} for key, count in rollups.top(dimension, period, limit)
+            ]})
+
+        return cached_stats(f"leaderboard:{dimension}:{period}:{limit}", render)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """Prometheus scrape target; 404 unless METRICS_ENABLED is set."""
+        if not metrics.enabled():
+            abort(404)
+
+        gauges = [('model_circuit_state', 'Model circuit breaker state (1 for the current state).', {
+            (('state', state),): int(breaker.state == state) for state in ('closed', 'half-open', 'open')
+        })]
+        caches = {'tasks': cache_stats(), 'responses': response_cache.cache_stats()}
+        for stat in ('hits', 'misses', 'size'):
+            gauges.append((f"cache_{stat}", f"Cache {stat} in this process.",
+                           {(('cache', name),): stats[stat] for name, stats in caches.items()}))
+        return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
     # Initialize default badges when the app starts
     with app.app_context():
         AchievementService.initialize_default_badges()
+        AchievementService.initialize_counters()
@@ -0,0 +1,52 @@
+"""Pre-generate task sets for active regions at each daily and weekly rollover.
+
+Usage: python scheduler.py [--once]
+
+Runs a refresh immediately, then again just after every UTC midnight (weekly
+sets roll over on Mondays). ``--once`` performs a single refresh and exits, for
+use from cron.
+"""
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+from app import app, db
+from services import task_sets
+
+logger = logging.getLogger(__name__)
+
+ROLLOVER_DELAY = 5  # seconds past midnight, so the previous sets have expired
+
+
+def refresh():
+    started = time.monotonic()
+    try:
+        refreshed, failed = task_sets.refresh_active_regions()
+    except Exception as e:
+        logger.error(f"Task set refresh failed: {str(e)}", exc_info=True)
+        return
+    finally:
+        db.session.remove()
+    logger.info(f"Refreshed {refreshed} regions ({failed} failed) in {time.monotonic() - started:.1f}s")
+
+
+def seconds_until_rollover():
+    now = datetime.utcnow()
+    next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return (next_midnight - now).total_seconds() + ROLLOVER_DELAY
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--once', action='store_true', help='refresh once and exit')
+    args = parser.parse_args()
+
+    with app.app_context():
+        refresh()
+        while not args.once:
+            time.sleep(seconds_until_rollover())
+            refresh()
+
+
+if __name__ == '__main__':
+    main()
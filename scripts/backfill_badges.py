@@ -0,0 +1,57 @@
+"""Award badges to historical spottings after adding or changing badge rules.
+
+Usage: python scripts/backfill_badges.py [--chunk-size N] [BADGE_ID ...]
+
+Re-evaluates the given badges (all badges by default) over every spotting and
+seeds the counters their rules read. Run it before restarting the app so the
+workers pick up the new rules with their counters already in place.
+
+Requires PostgreSQL: the set-based statements in services/badge_backfill.py
+do not run on SQLite.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select
+from app import app, db
+from models import Badge
+from services.badge_backfill import UnsupportedDatabaseError, backfill_rule, require_postgresql
+from services.badge_rules import RuleError, compile_rule
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('badge_ids', nargs='*', type=int, help='badges to backfill (default: all)')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='spottings per INSERT ... SELECT')
+    args = parser.parse_args()
+
+    with app.app_context():
+        try:
+            require_postgresql()
+        except UnsupportedDatabaseError as e:
+            print(str(e), file=sys.stderr)
+            return 2
+
+        query = select(Badge.id, Badge.criteria).order_by(Badge.id)
+        if args.badge_ids:
+            query = query.where(Badge.id.in_(args.badge_ids))
+
+        failed = False
+        for badge_id, criteria in db.session.execute(query).all():
+            try:
+                rule = compile_rule(badge_id, criteria)
+            except RuleError as e:
+                print(f"Badge {badge_id}: invalid criteria: {str(e)}", file=sys.stderr)
+                failed = True
+                continue
+            awarded = backfill_rule(rule, chunk_size=args.chunk_size)
+            print(f"Badge {badge_id}: {awarded} new awards")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,370 @@
+"""Measure endpoint latency, throughput and SQL query counts without real upstream calls.
+
+Usage: BENCHMARK_DATABASE_URL=postgresql://... python scripts/benchmark.py
+           [--scenarios tasks,recognize,share,badges,leaderboard] [--requests 500] [--concurrency 16]
+           [--spottings 20000] [--save-baseline | --compare] [--url http://host:port]
+
+Seeds the benchmark database with tasks, spottings and badge awards, then
+drives each scenario and reports latency percentiles, requests per second and
+SQL statements per request. OpenAI and Nominatim are replaced by
+scripts/fake_upstream.py, whose latency and error profile is configurable.
+
+By default the app runs in this process behind the Flask test client, with
+statements counted by services.query_counter. With ``--url`` the requests go to
+a running server instead (start it against ``fake_upstream.py`` and the same
+database); query counts are then read from X-Query-Count, which the app only
+sends in debug mode.
+
+``--save-baseline`` stores the results (scripts/benchmark_baseline.json unless
+``--baseline`` says otherwise); ``--compare`` reports scenarios that regressed
+beyond ``--tolerance`` against it and exits with status 1 if any did. The
+benchmark database is written to, so it is never taken from DATABASE_URL.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_upstream import COMMON_ANIMALS, RARE_ANIMALS, FakeUpstream, add_profile_arguments, profile_from_args
+
+SCENARIOS = ('tasks', 'recognize', 'share', 'badges', 'leaderboard')
+DEFAULT_BASELINE = os.path.join(ROOT, 'scripts', 'benchmark_baseline.json')
+SEED_PREFIX = 'benchmark-'  # image_path prefix of seeded spottings
+LEADERBOARD_PERIODS = ('day', 'week', 'month', 'all')
+COORDINATES = [
+    (45.52, -122.68), (30.27, -97.74), (43.65, -79.38), (53.48, -2.24), (45.76, 4.84),
+    (48.14, 11.58), (-37.81, 144.96), (35.01, 135.77), (-33.92, 18.42), (-25.43, -49.27),
+]
+
+
+def seed(spottings, tasks, regions):
+    """Top the benchmark database up to the requested row counts, award badges and roll up the counts."""
+    from sqlalchemy import insert, select
+    from app import db
+    from models import AnimalSpotting, Badge, Task
+    from services import rollups
+    from services.badge_backfill import UnsupportedDatabaseError, backfill_rule, require_postgresql
+    from services.badge_rules import RuleError, compile_rule
+
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+
+    existing = db.session.query(Task).filter(Task.region.like(f"{SEED_PREFIX}%")).count()
+    task_rows = [{
+        'animal': rng.choice(COMMON_ANIMALS + RARE_ANIMALS),
+        'task_type': rng.choice(('daily', 'weekly')),
+        'region': f"{SEED_PREFIX}{rng.randrange(regions)}",
+        'created_at': now - timedelta(days=rng.randrange(30)),
+        # Mostly expired history with a current set on top
+        'expires_at': tomorrow if rng.random() < 0.2 else now - timedelta(days=rng.randrange(1, 30)),
+    } for _ in range(max(0, tasks - existing))]
+    if task_rows:
+        db.session.execute(insert(Task), task_rows)
+    task_ids = list(db.session.execute(select(Task.id).where(Task.region.like(f"{SEED_PREFIX}%"))).scalars())
+
+    existing = db.session.query(AnimalSpotting).filter(AnimalSpotting.image_path.like(f"{SEED_PREFIX}%")).count()
+    for start in range(existing, spottings, 5000):
+        rows = []
+        for n in range(start, min(spottings, start + 5000)):
+            animal = rng.choice(COMMON_ANIMALS + RARE_ANIMALS)
+            rows.append({
+                'task_id': rng.choice(task_ids) if task_ids and rng.random() < 0.6 else None,
+                'image_path': f"{SEED_PREFIX}{n}.jpg",
+                'recognition_result': animal,
+                'detailed_info': {
+                    'habitat': 'Parks and gardens', 'diet': 'Omnivorous', 'behavior': 'Diurnal',
+                    'interesting_facts': [f"{animal} fact {i}" for i in range(3)],
+                },
+                'confidence_score': round(rng.uniform(0.5, 1.0), 3),
+                'spotted_at': now - timedelta(seconds=rng.randrange(90 * 24 * 60 * 60)),
+                'location': rng.choice(('Park', 'Garden', 'Riverside', 'Forest', None)),
+                'share_id': uuid.uuid4().hex,
+            })
+        db.session.execute(insert(AnimalSpotting), rows)
+        db.session.commit()
+    db.session.commit()
+
+    # Award badges the way a rule change would, which also seeds their counters
+    try:
+        require_postgresql()
+    except UnsupportedDatabaseError as e:
+        print(f"Skipping badge backfill: {str(e)}", file=sys.stderr)
+    else:
+        for badge_id, criteria in db.session.execute(select(Badge.id, Badge.criteria)).all():
+            try:
+                backfill_rule(compile_rule(badge_id, criteria))
+            except RuleError as e:
+                print(f"Skipping badge {badge_id}: {str(e)}", file=sys.stderr)
+
+    # Bulk inserts bypass record_spotting, so the rollups are recomputed as after a backfill
+    rollups.rebuild()
+    db.session.commit()
+
+    return list(db.session.execute(
+        select(AnimalSpotting.share_id).where(AnimalSpotting.image_path.like(f"{SEED_PREFIX}%")).limit(5000)
+    ).scalars())
+
+
+def make_images(count):
+    """Return ``count`` distinct small JPEG photos-to-be (colour fields with shapes)."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(7)
+    images = []
+    for _ in range(count):
+        image = Image.new('RGB', (640, 480), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x, y = rng.randrange(600), rng.randrange(440)
+            draw.ellipse((x, y, x + rng.randrange(20, 200), y + rng.randrange(20, 200)),
+                         fill=tuple(rng.randrange(256) for _ in range(3)))
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=85)
+        images.append(out.getvalue())
+    return images
+
+
+class Scenario:
+    """Produces the requests of one benchmark scenario."""
+
+    def __init__(self, name, share_ids, images, regions):
+        self.name = name
+        self.share_ids = share_ids
+        self.images = images
+        self.regions = regions
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def next_request(self, rng):
+        """Return ``(method, path, json_body, files)``."""
+        if self.name == 'tasks':
+            lat, lng = rng.choice(COORDINATES)
+            # Spread requests over ``regions`` cells around the cities
+            cell = rng.randrange(self.regions)
+            return 'POST', '/api/tasks', {'latitude': lat + cell * 0.05, 'longitude': lng}, None
+        if self.name == 'recognize':
+            with self._lock:
+                image = self.images[self._counter % len(self.images)]
+                self._counter += 1
+            return 'POST', '/api/recognize', None, {'image': ('benchmark.jpg', image, 'image/jpeg')}
+        if self.name == 'share':
+            return 'GET', f"/share/{rng.choice(self.share_ids)}", None, None
+        if self.name == 'leaderboard':
+            dimension = rng.choice(('species', 'locations'))
+            return 'GET', f"/api/leaderboard/{dimension}?period={rng.choice(LEADERBOARD_PERIODS)}", None, None
+        return 'GET', '/api/badges', None, None
+
+
+class InProcessDriver:
+    """Sends requests through the Flask test client, counting SQL statements per request."""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, method, path, json_body, files):
+        from services.query_counter import counting_queries
+
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        kwargs = {'json': json_body} if json_body is not None else {}
+        if files:
+            kwargs['data'] = {name: (io.BytesIO(data), filename, mime_type)
+                              for name, (filename, data, mime_type) in files.items()}
+            kwargs['content_type'] = 'multipart/form-data'
+        with counting_queries() as counter:
+            response = client.open(path, method=method, **kwargs)
+            response.close()
+        return response.status_code, counter.count
+
+
+class HttpDriver:
+    """Sends requests to a running server, reading query counts from X-Query-Count."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self._local = threading.local()
+
+    def send(self, method, path, json_body, files):
+        import requests
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        response = session.request(method, self.base_url + path, json=json_body, files=files, timeout=120)
+        count = response.headers.get('X-Query-Count')
+        return response.status_code, int(count) if count is not None else None
+
+
+def run_scenario(driver, scenario, requests_count, concurrency, warmup):
+    rng = random.Random(scenario.name)
+    rng_lock = threading.Lock()
+
+    def one(_):
+        with rng_lock:
+            request = scenario.next_request(rng)
+        started = time.perf_counter()
+        try:
+            status, queries = driver.send(*request)
+        except Exception as e:
+            logging.getLogger(__name__).debug(f"Request failed: {str(e)}")
+            status, queries = None, None
+        return time.perf_counter() - started, status, queries
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(warmup)))
+        started = time.perf_counter()
+        samples = list(executor.map(one, range(requests_count)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _, _ in samples)
+    counts = [queries for _, _, queries in samples if queries is not None]
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': requests_count,
+        'errors': sum(1 for _, status, _ in samples if status is None or status >= 400),
+        'rps': round(requests_count / elapsed, 1),
+        'p50_ms': round(percentiles[49], 1),
+        'p90_ms': round(percentiles[89], 1),
+        'p99_ms': round(percentiles[98], 1),
+        'max_ms': round(latencies[-1], 1),
+        'queries_per_request': round(statistics.mean(counts), 2) if counts else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return human-readable regressions of ``results`` against ``baseline``."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            if before[metric] and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {before[metric]} -> {result[metric]}")
+        if before['rps'] and result['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: rps {before['rps']} -> {result['rps']}")
+        if before.get('queries_per_request') is not None and result['queries_per_request'] is not None \
+                and result['queries_per_request'] > before['queries_per_request'] + 0.5:
+            regressions.append(f"{name}: queries/request {before['queries_per_request']} -> "
+                               f"{result['queries_per_request']}")
+        if result['errors'] > before['errors'] + max(1, int(result['requests'] * 0.01)):
+            regressions.append(f"{name}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+
+def print_report(results):
+    header = f"{'scenario':<10} {'rps':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'queries':>8} {'errors':>7}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        queries = result['queries_per_request']
+        print(f"{name:<10} {result['rps']:>8} {result['p50_ms']:>9} {result['p90_ms']:>9} {result['p99_ms']:>9} "
+              f"{result['max_ms']:>9} {queries if queries is not None else '-':>8} {result['errors']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL'),
+                        help='database to seed and run against (default: BENCHMARK_DATABASE_URL)')
+    parser.add_argument('--url', help='benchmark a running server instead of the app in this process')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated scenarios to run')
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--spottings', type=int, default=20000, help='seeded spottings')
+    parser.add_argument('--tasks', type=int, default=2000, help='seeded tasks')
+    parser.add_argument('--regions', type=int, default=50, help='distinct task regions requested and seeded')
+    parser.add_argument('--images', type=int, default=100, help='distinct images uploaded, then repeated')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if not args.database_url:
+        parser.error('set BENCHMARK_DATABASE_URL or --database-url; the benchmark database is seeded with data')
+
+    upstream = None
+    if not args.url:
+        upstream = FakeUpstream(profile_from_args(args)).start()
+        os.environ['OPENAI_API_KEY'] = 'benchmark'
+        os.environ['OPENAI_BASE_URL'] = f"{upstream.base_url}/v1"
+        os.environ['NOMINATIM_URL'] = f"{upstream.base_url}/reverse"
+        os.environ['GEOCODER_MODE'] = 'online'
+        os.environ['UPLOAD_FOLDER'] = tempfile.mkdtemp(prefix='benchmark-uploads-')
+    os.environ['DATABASE_URL'] = args.database_url
+
+    # The app reads its configuration at import time, so import it only now
+    from app import app
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with app.app_context():
+        print(f"Seeding up to {args.spottings} spottings and {args.tasks} tasks...")
+        share_ids = seed(args.spottings, args.tasks, args.regions)
+    images = make_images(args.images) if 'recognize' in scenarios else []
+    driver = HttpDriver(args.url) if args.url else InProcessDriver(app)
+
+    results = {}
+    try:
+        for name in scenarios:
+            scenario = Scenario(name, share_ids, images, args.regions)
+            results[name] = run_scenario(driver, scenario, args.requests, args.concurrency, args.warmup)
+    finally:
+        if upstream is not None:
+            upstream.stop()
+
+    print_report(results)
+    report = {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'settings': {
+            'requests': args.requests, 'concurrency': args.concurrency, 'spottings': args.spottings,
+            'latency_ms': args.latency_ms, 'error_rate': args.error_rate, 'target': args.url or 'in-process',
+        },
+        'scenarios': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+    status = 0
+    if args.compare:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print('\nRegressions against the baseline:')
+            for regression in regressions:
+                print(f"  {regression}")
+            status = 1
+        else:
+            print('\nNo regressions against the baseline.')
+    if args.save_baseline:
+        with open(args.baseline, 'w') as out:
+            json.dump(report, out, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Check that the hot read queries are planned as index scans.
+
+Usage: QUERY_PLAN_DATABASE_URL=postgresql://... python scripts/check_query_plans.py [--rows N]
+
+Seeds N tasks, spottings and badge awards inside a transaction, runs EXPLAIN
+(PostgreSQL) or EXPLAIN QUERY PLAN (SQLite) for each query in services/queries.py
+and rolls the seed data back. Exits non-zero if a plan does not use the index
+the query relies on. On PostgreSQL sequential scans are disabled for the check,
+so it asserts that a usable index exists rather than depending on statistics.
+
+Starting the app migrates the database and seeds the default badges, so the
+check runs only against a throwaway database named by QUERY_PLAN_DATABASE_URL
+or --database-url, never the one in DATABASE_URL. Run it in CI against a fresh
+database to catch plan regressions.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, insert, select, text
+
+# Plan fragments that show a table being read through an index
+INDEX_MARKERS = {
+    'postgresql': ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan'),
+    'sqlite': ('USING INDEX', 'USING COVERING INDEX', 'USING INTEGER PRIMARY KEY', 'USING PRIMARY KEY'),
+}
+
+
+def seed(connection, rows):
+    from models import AnimalSpotting, Badge, Task, spotting_badges
+
+    now = datetime.utcnow()
+    first_task = (connection.execute(select(func.max(Task.id))).scalar() or 0) + 1
+    connection.execute(insert(Task), [{
+        'animal': f'Animal {i}',
+        'task_type': 'daily' if i % 7 else 'weekly',
+        'region': f'plan-region-{i % 10}',
+        'created_at': now - timedelta(days=i),
+        'expires_at': now - timedelta(days=i - 1),
+    } for i in range(rows)])
+    connection.execute(insert(AnimalSpotting), [{
+        'task_id': first_task + i,
+        'recognition_result': f'Animal {i}',
+        'spotted_at': now - timedelta(hours=i),
+        'share_id': f'plan{i:08d}',
+    } for i in range(rows)])
+
+    spotting_ids = connection.execute(
+        select(AnimalSpotting.id).where(AnimalSpotting.share_id.like('plan%'))
+    ).scalars().all()
+    badge_ids = connection.execute(select(Badge.id)).scalars().all()
+    if badge_ids:
+        connection.execute(insert(spotting_badges), [{
+            'spotting_id': spotting_id,
+            'badge_id': badge_ids[i % len(badge_ids)],
+            'awarded_at': now - timedelta(hours=i),
+        } for i, spotting_id in enumerate(spotting_ids)])
+
+
+def explain(connection, query):
+    compiled = query.statement.compile(dialect=connection.dialect)
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = connection.exec_driver_sql(prefix + str(compiled), params).all()
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('QUERY_PLAN_DATABASE_URL'),
+                        help='throwaway database to check against (default: QUERY_PLAN_DATABASE_URL)')
+    parser.add_argument('--rows', type=int, default=1000, help='rows to seed per table')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('set QUERY_PLAN_DATABASE_URL or --database-url to a throwaway database')
+    if args.database_url == os.environ.get('DATABASE_URL'):
+        parser.error('refusing to check against DATABASE_URL; use a throwaway database')
+    os.environ['DATABASE_URL'] = args.database_url
+
+    # The app reads its configuration at import time, so import it only now
+    from app import app, db
+    from services import queries
+
+    failed = False
+    with app.app_context():
+        today = datetime.utcnow().date()
+        # Expected index per query; None accepts any index (unique constraints are named by the database)
+        hot_queries = {
+            'current tasks': (queries.current_tasks(today), 'ix_task_expires_at_created_at'),
+            'current task progress': (
+                queries.current_task_progress(today, 'plan-region-1'), 'ix_task_region_expires_at'
+            ),
+            'current task progress, any region': (
+                queries.current_task_progress(today), 'ix_task_expires_at_created_at'
+            ),
+            'recent badges': (queries.recent_badges(5), 'ix_spotting_badges_awarded_at'),
+            'share page': (queries.spotting_by_share_id('plan00000001'), None),
+            'spottings by day': (
+                queries.spottings_between(today, today + timedelta(days=1)), 'ix_animal_spotting_spotted_at'
+            ),
+        }
+
+        connection = db.session.connection()
+        markers = INDEX_MARKERS.get(connection.dialect.name)
+        if markers is None:
+            print(f"Unsupported database: {connection.dialect.name}", file=sys.stderr)
+            return 2
+        try:
+            seed(connection, args.rows)
+            if connection.dialect.name == 'postgresql':
+                connection.execute(text('SET LOCAL enable_seqscan = off'))
+
+            for name, (query, index_name) in hot_queries.items():
+                plan = explain(connection, query)
+                if index_name:
+                    uses_index = index_name in plan
+                else:
+                    uses_index = any(marker in plan for marker in markers)
+                print(f"{'ok' if uses_index else 'FAIL'}: {name}")
+                if not uses_index:
+                    print(plan)
+                    failed = True
+        finally:
+            db.session.rollback()
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,35 @@
+"""Delete stored uploads left behind by failed or interrupted recognitions.
+
+Usage: python scripts/cleanup_uploads.py [--min-age SECONDS] [--dry-run]
+
+Uploads younger than --min-age (STORAGE_ORPHAN_AGE by default) are kept, since
+their recognition may still be running. Recognition jobs pending longer than
+RECOGNITION_JOB_TIMEOUT (stranded by a restart) are marked failed first, and
+their uploads removed. With the S3 backend this also prunes this node's local
+cache of downloaded objects. Run it periodically from cron.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from services.upload_cleanup import remove_orphans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-age', type=int, help='seconds an upload must be stored before removal')
+    parser.add_argument('--dry-run', action='store_true', help='list orphans without deleting them')
+    args = parser.parse_args()
+
+    with app.app_context():
+        min_age = args.min_age if args.min_age is not None else app.config['STORAGE_ORPHAN_AGE']
+        removed = remove_orphans(min_age, dry_run=args.dry_run)
+        print(f"{'Found' if args.dry_run else 'Removed'} {removed} orphaned uploads")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
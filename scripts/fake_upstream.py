@@ -0,0 +1,260 @@
+"""Stand-in OpenAI and Nominatim server for benchmarks and local load tests.
+
+Usage: python scripts/fake_upstream.py [--port 8900] [--latency-ms 800] [--jitter-ms 200]
+                                       [--error-rate 0.0] [--rate-limit-rate 0.0]
+
+Serves ``POST /v1/chat/completions`` with structured outputs matching the
+response models in gpt_service (streamed when requested) and Nominatim's
+``GET /reverse``. Point the app at it with::
+
+    OPENAI_API_KEY=fake OPENAI_BASE_URL=http://127.0.0.1:8900/v1 \\
+    NOMINATIM_URL=http://127.0.0.1:8900/reverse python main.py
+
+Each response waits for the configured latency (plus uniform jitter), and the
+given fractions of requests fail with 500 or 429 to exercise retries and the
+circuit breaker. Geocoder requests use a tenth of the model latency.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+COMMON_ANIMALS = [
+    'Eastern Gray Squirrel', 'American Robin', 'House Sparrow', 'Mallard', 'Rock Pigeon',
+    'European Starling', 'Monarch Butterfly', 'Honey Bee', 'Northern Cardinal', 'Blue Jay',
+]
+RARE_ANIMALS = [
+    'Red Fox', 'Red-tailed Hawk', 'White-tailed Deer', 'Great Horned Owl', 'Raccoon',
+    'Coyote', 'Great Blue Heron', 'Painted Turtle', 'Bald Eagle', 'River Otter',
+]
+CITIES = [
+    ('Portland', 'Oregon', 'United States'), ('Austin', 'Texas', 'United States'),
+    ('Toronto', 'Ontario', 'Canada'), ('Manchester', 'England', 'United Kingdom'),
+    ('Lyon', 'Auvergne-Rhône-Alpes', 'France'), ('Munich', 'Bavaria', 'Germany'),
+    ('Melbourne', 'Victoria', 'Australia'), ('Kyoto', 'Kyoto Prefecture', 'Japan'),
+    ('Cape Town', 'Western Cape', 'South Africa'), ('Curitiba', 'Paraná', 'Brazil'),
+]
+STREAM_CHUNK = 24  # characters of content per streamed chunk
+REGION_ID = re.compile(r'^(r\d+):', re.MULTILINE)
+
+
+class Profile:
+    """Latency and failure behaviour of the fake upstream."""
+
+    def __init__(self, latency_ms=800, jitter_ms=200, error_rate=0.0, rate_limit_rate=0.0, token_delay_ms=5):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.token_delay_ms = token_delay_ms
+
+    def delay(self, scale=1.0):
+        jitter = random.uniform(-self.jitter_ms, self.jitter_ms)
+        time.sleep(max(0.0, self.latency_ms + jitter) * scale / 1000)
+
+    def failure(self):
+        """Return an HTTP status to fail this request with, or None."""
+        roll = random.random()
+        if roll < self.error_rate:
+            return 500
+        if roll < self.error_rate + self.rate_limit_rate:
+            return 429
+        return None
+
+
+def task_payload(rng):
+    return {'daily': rng.sample(COMMON_ANIMALS, 3), 'weekly': rng.sample(RARE_ANIMALS, 2)}
+
+
+def recognition_payload(rng):
+    animal = rng.choice(COMMON_ANIMALS + RARE_ANIMALS)
+    return {
+        'animal': animal,
+        'details': {
+            'habitat': f"Woodland edges, parks and gardens where the {animal} finds cover.",
+            'diet': "Seeds, fruit, insects and whatever else the season offers.",
+            'behavior': "Most active around dawn and dusk, wary but used to people.",
+            'interesting_facts': [
+                f"The {animal} is a frequent sight for urban wildlife spotters.",
+                "Populations have adapted well to city environments.",
+                "It can often be identified by its call before it is seen.",
+            ],
+        },
+    }
+
+
+def completion_payload(request):
+    """Build the structured output for a chat completion request."""
+    schema_name = (request.get('response_format') or {}).get('json_schema', {}).get('name')
+    prompt = ' '.join(
+        message['content'] if isinstance(message['content'], str)
+        else ' '.join(part.get('text', '') for part in message['content'])
+        for message in request.get('messages', [])
+    )
+    rng = random.Random(prompt if schema_name != 'AnimalRecognitionResponse' else None)
+    if schema_name == 'BatchTaskResponse':
+        return {'regions': [dict(task_payload(rng), region_id=region_id) for region_id in REGION_ID.findall(prompt)]}
+    if schema_name == 'AnimalRecognitionResponse':
+        return recognition_payload(rng)
+    return task_payload(rng)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self, status):
+        headers = {'Retry-After': '1'} if status == 429 else None
+        self._send_json(status, {'error': {
+            'message': 'Simulated upstream failure', 'type': 'server_error' if status == 500 else 'rate_limit_exceeded'
+        }}, headers)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/reverse':
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        profile = self.server.profile
+        profile.delay(scale=0.1)
+        status = profile.failure()
+        if status:
+            self._fail(status)
+            return
+        params = parse_qs(url.query)
+        lat = float(params.get('lat', ['0'])[0])
+        lon = float(params.get('lon', ['0'])[0])
+        city, state, country = CITIES[hash((round(lat), round(lon))) % len(CITIES)]
+        self._send_json(200, {
+            'lat': str(lat), 'lon': str(lon),
+            'address': {'city': city, 'state': state, 'country': country},
+        })
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': 'Not found'})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+
+        profile = self.server.profile
+        profile.delay()
+        status = profile.failure()
+        if status:
+            self._fail(status)
+            return
+
+        content = json.dumps(completion_payload(request))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        if request.get('stream'):
+            self._stream(completion_id, request.get('model'), content)
+            return
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content, 'refusal': None},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': len(json.dumps(request)) // 4, 'completion_tokens': len(content) // 4,
+                      'total_tokens': (len(json.dumps(request)) + len(content)) // 4},
+        })
+
+    def _stream(self, completion_id, model, content):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish_reason=None):
+            payload = {
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        chunk({'role': 'assistant', 'content': ''})
+        for start in range(0, len(content), STREAM_CHUNK):
+            time.sleep(self.server.profile.token_delay_ms / 1000)
+            chunk({'content': content[start:start + STREAM_CHUNK]})
+        chunk({}, 'stop')
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class FakeUpstream:
+    """Run the fake upstream server in a background thread."""
+
+    def __init__(self, profile, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.profile = profile
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-upstream', daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=800, help='median model latency (geocoder: a tenth)')
+    parser.add_argument('--jitter-ms', type=float, default=200, help='uniform jitter around the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of requests failing with 429')
+    parser.add_argument('--token-delay-ms', type=float, default=5, help='delay between streamed chunks')
+
+
+def profile_from_args(args):
+    return Profile(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, args.token_delay_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(profile_from_args(args), args.host, args.port)
+    print(f"Fake upstream listening on {upstream.base_url} (OpenAI: /v1, Nominatim: /reverse)")
+    try:
+        upstream.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        upstream.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Recompute the spotting rollups behind the leaderboards and stats.
+
+Usage: python scripts/rebuild_rollups.py [--days N]
+
+With --days, only the last N days (including today) are recomputed, then the
+all-time totals; without it every day is. Run it without --days once after
+migration 5 creates the table, to count the spottings recorded before it, and
+again after migration 8, which drops location rollups keyed by coordinates.
+With ROLLUP_MODE=deferred, run it from cron (e.g. ``--days 2`` every few
+minutes); in inline mode it repairs counts after spottings were edited or
+deleted by hand. Inline recording waits for a rebuild to commit, so run full
+rebuilds off-peak.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from services import rollups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, help='recompute only the last N days')
+    args = parser.parse_args()
+    if args.days is not None and args.days < 1:
+        parser.error('--days must be at least 1')
+
+    with app.app_context():
+        start = datetime.utcnow().date() - timedelta(days=args.days - 1) if args.days else None
+        counted = rollups.rebuild(start=start)
+        db.session.commit()
+        print(f"Rebuilt rollups from {counted} spottings" + (f" in the last {args.days} days" if args.days else ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,45 +1,141 @@
+import logging
+import threading
 from datetime import datetime, timedelta
-from models import Badge, AnimalSpotting, db
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from models import AchievementCounter, Badge, AnimalSpotting, db
+from services import counters, queries
+from services.badge_rules import RuleError, compile_rule
+
+logger = logging.getLogger(__name__)
+
+TOTAL_SPOTTINGS = 'spottings:total'
+STREAK_CURRENT = 'streak:current'
+STREAK_LAST_DAY = 'streak:last_day'  # date.toordinal() of the latest spotting
+
+
+def day_counter(day):
+    return f'spottings:day:{day.isoformat()}'
+
 
 class AchievementService:
+    _badge_rules = None
+    _rules_lock = threading.Lock()
+
+    @classmethod
+    def badge_rules(cls):
+        """Compile every badge's criteria into rules, once per process"""
+        if cls._badge_rules is None:
+            with cls._rules_lock:
+                if cls._badge_rules is None:
+                    rules = []
+                    for badge_id, criteria in db.session.execute(select(Badge.id, Badge.criteria)):
+                        try:
+                            rules.append(compile_rule(badge_id, criteria))
+                        except RuleError as e:
+                            logger.error(f"Skipping badge {badge_id} with invalid criteria: {str(e)}")
+                    cls._badge_rules = rules
+        return cls._badge_rules
+
+    @classmethod
+    def invalidate_rules(cls):
+        with cls._rules_lock:
+            cls._badge_rules = None
+
+    @staticmethod
+    def record_spotting(day):
+        """Update the aggregate counters for a new spotting in the current transaction"""
+        total = counters.increment(AchievementCounter, {'name': TOTAL_SPOTTINGS})
+        today_count = counters.increment(AchievementCounter, {'name': day_counter(day)})
+
+        # Touching both streak rows first creates them if needed and locks them
+        # against concurrent spottings until this transaction ends.
+        last_day = counters.increment(AchievementCounter, {'name': STREAK_LAST_DAY}, 0)
+        streak = streak_before = counters.increment(AchievementCounter, {'name': STREAK_CURRENT}, 0)
+        if last_day != day.toordinal():
+            streak = streak_before + 1 if last_day == day.toordinal() - 1 else 1
+            db.session.execute(
+                update(AchievementCounter)
+                .where(AchievementCounter.name == STREAK_CURRENT)
+                .values(value=streak)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.execute(
+                update(AchievementCounter)
+                .where(AchievementCounter.name == STREAK_LAST_DAY)
+                .values(value=day.toordinal())
+                .execution_options(synchronize_session=False)
+            )
+            if streak == 1:
+                streak_before = 0
+
+        return {
+            'counters': {TOTAL_SPOTTINGS: total, day_counter(day): today_count},
+            'streak': streak,
+            'streak_before': streak_before,
+        }
+
     @staticmethod
     def check_achievements(spotting):
-        """Check and award achievements for a new animal spotting"""
-        badges = []
-        
-        # First spotting badge
-        first_spot_badge = Badge.query.filter_by(criteria='first_spot').first()
-        if first_spot_badge and AnimalSpotting.query.count() == 1:
-            badges.append(first_spot_badge)
-        
-        # Daily streak badges
+        """Update counters and award achievements for a new animal spotting.
+
+        Runs in the same transaction as the spotting insert; the caller commits.
+        """
         today = datetime.utcnow().date()
-        yesterday = today - timedelta(days=1)
-        
-        daily_spottings = AnimalSpotting.query.filter(
-            AnimalSpotting.spotted_at >= yesterday,
-            AnimalSpotting.spotted_at < today + timedelta(days=1)
-        ).count()
-        
-        if daily_spottings >= 5:
-            daily_5_badge = Badge.query.filter_by(criteria='daily_5').first()
-            if daily_5_badge:
-                badges.append(daily_5_badge)
-        
-        # Weekly task completion badge
-        if spotting.task and spotting.task.task_type == 'weekly':
-            weekly_complete_badge = Badge.query.filter_by(criteria='weekly_complete').first()
-            if weekly_complete_badge:
-                badges.append(weekly_complete_badge)
-        
+        stats = AchievementService.record_spotting(today)
+        values = stats['counters']
+
+        rules = [rule for rule in AchievementService.badge_rules()
+                 if rule.window == 'streak' or rule.matches(spotting)]
+
+        # Bump each rule's current bucket once, then read earlier buckets in one query
+        for rule in rules:
+            names = rule.bucket_names(today)
+            if names and names[0] not in values:
+                values[names[0]] = counters.increment(AchievementCounter, {'name': names[0]})
+        earlier = {name for rule in rules for name in rule.bucket_names(today)[1:]} - values.keys()
+        if earlier:
+            values.update(counters.get_values(AchievementCounter, AchievementCounter.name, list(earlier)))
+
+        badges = []
+        for rule in rules:
+            if rule.window == 'streak':
+                count, count_before = stats['streak'], stats['streak_before']
+            else:
+                count = sum(values[name] for name in rule.bucket_names(today))
+                count_before = count - 1
+            if rule.is_met(count, count_before):
+                badges.append(db.session.get(Badge, rule.badge_id))
+
         # Award badges
         for badge in badges:
             if badge not in spotting.badges:
                 spotting.badges.append(badge)
-        
-        db.session.commit()
+
         return badges
 
+    @staticmethod
+    def initialize_counters():
+        """Seed aggregate counters from existing spottings the first time they are used"""
+        if db.session.get(AchievementCounter, TOTAL_SPOTTINGS):
+            return
+
+        today = datetime.utcnow().date()
+        yesterday = today - timedelta(days=1)
+        seeds = {
+            TOTAL_SPOTTINGS: AnimalSpotting.query.count(),
+        }
+        for day in (yesterday, today):
+            seeds[day_counter(day)] = queries.spottings_between(day, day + timedelta(days=1)).count()
+
+        for name, value in seeds.items():
+            db.session.add(AchievementCounter(name=name, value=value))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker seeded the counters concurrently
+            db.session.rollback()
+
     @staticmethod
     def initialize_default_badges():
         """Create default badges if they don't exist"""
@@ -63,10 +159,11 @@ class AchievementService:
                 'criteria': 'weekly_complete'
             }
         ]
-        
+
         for badge_data in default_badges:
             if not Badge.query.filter_by(criteria=badge_data['criteria']).first():
                 badge = Badge(**badge_data)
                 db.session.add(badge)
-        
+
         db.session.commit()
+        AchievementService.invalidate_rules()
@@ -0,0 +1,18 @@
+import asyncio
+from flask import current_app
+
+
+async def run_sync(func, *args):
+    """Run blocking work (database queries, file I/O) in a worker thread.
+
+    The call gets its own app context and therefore its own database session,
+    which is removed when it returns, so ``func`` should return plain data
+    rather than ORM objects.
+    """
+    app = current_app._get_current_object()
+
+    def call():
+        with app.app_context():
+            return func(*args)
+
+    return await asyncio.to_thread(call)
@@ -0,0 +1,245 @@
+"""Re-evaluate badge rules over historical spottings with set-based SQL.
+
+Matching spottings are aggregated into per-day totals with one GROUP BY. From
+those totals each active day gets the rank a spotting needs within its day to
+earn the badge, and the awards are inserted chunk by chunk with
+``INSERT ... SELECT`` over a ranked window, so no spotting is loaded into the ORM.
+
+The statements are PostgreSQL-only (``ON CONFLICT DO NOTHING``, ``~`` regex
+matching, ``split_part``); ``backfill_rule`` raises UnsupportedDatabaseError on
+any other database instead of failing to compile.
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    Boolean, Date, DateTime, Float, Integer, and_, case, cast, column, func, literal, or_, select, update, values
+)
+from sqlalchemy.dialects.postgresql import insert
+from app import db
+from models import AchievementCounter, AnimalSpotting, Task, spotting_badges
+from services.badge_rules import week_start
+
+logger = logging.getLogger(__name__)
+
+COORDINATES = r'^\s*-?[0-9]+(\.[0-9]+)?\s*,\s*-?[0-9]+(\.[0-9]+)?\s*$'
+
+
+class UnsupportedDatabaseError(RuntimeError):
+    """Raised when the backfill runs on a database other than PostgreSQL."""
+
+
+def require_postgresql():
+    dialect = db.engine.dialect.name
+    if dialect != 'postgresql':
+        raise UnsupportedDatabaseError(
+            f"The badge backfill requires PostgreSQL; DATABASE_URL points to {dialect}."
+        )
+
+
+def spotting_conditions(rule):
+    """SQL equivalent of ``rule.matches`` for AnimalSpotting rows."""
+    conditions = [AnimalSpotting.spotted_at.isnot(None)]
+    if rule.species:
+        animal = func.lower(AnimalSpotting.recognition_result)
+        conditions.append(or_(*[animal.contains(term, autoescape=True) for term in rule.species]))
+    if rule.bbox:
+        # CASE guards the casts so rows with non-coordinate locations never reach them
+        is_point = AnimalSpotting.location.op('~')(COORDINATES)
+        lat = case((is_point, cast(func.split_part(AnimalSpotting.location, ',', 1), Float)))
+        lng = case((is_point, cast(func.split_part(AnimalSpotting.location, ',', 2), Float)))
+        min_lat, min_lng, max_lat, max_lng = rule.bbox
+        conditions += [lat.between(min_lat, max_lat), lng.between(min_lng, max_lng)]
+    if rule.task_type:
+        conditions.append(AnimalSpotting.task_id.in_(
+            select(Task.id).where(Task.task_type == rule.task_type)
+        ))
+    return conditions
+
+
+def daily_totals(rule, since=None):
+    """Return ``{date: matching spottings}`` for every day with at least one, from ``since`` if given."""
+    day = cast(AnimalSpotting.spotted_at, Date)
+    conditions = spotting_conditions(rule)
+    if since is not None:
+        conditions.append(AnimalSpotting.spotted_at >= since)
+    rows = db.session.execute(
+        select(day, func.count()).where(*conditions).group_by(day)
+    ).all()
+    return dict(rows)
+
+
+def window_total(rule, totals, day):
+    """Matching spottings in the day/week buckets ``rule`` reads on ``day``, up to ``day``."""
+    if rule.window == 'day':
+        first = day - timedelta(days=rule.span - 1)
+    else:
+        first = week_start(day) - timedelta(weeks=rule.span - 1)
+    return sum(totals.get(first + timedelta(days=i), 0) for i in range((day - first).days + 1))
+
+
+def award_ranks(rule, totals):
+    """Map each active day to ``(rank, exact)``: the rank (1-based, by spotted_at) a
+    spotting needs within its day to earn the badge, and whether only that rank qualifies.
+    """
+    ranks = {}
+    if rule.window == 'streak':
+        # Streaks count consecutive active days; only the day's first spotting can 'reach'
+        streak, previous = 0, None
+        for day in sorted(totals):
+            streak = streak + 1 if previous == day - timedelta(days=1) else 1
+            previous = day
+            if rule.mode == 'reach' and streak == rule.threshold:
+                ranks[day] = (1, True)
+            elif rule.mode == 'at_least' and streak >= rule.threshold:
+                ranks[day] = (1, False)
+        return ranks
+
+    running = 0
+    for day in sorted(totals):
+        count = totals[day]
+        # Spottings earlier than this day that fall in the same window
+        if rule.window == 'all':
+            before, running = running, running + count
+        else:
+            before = window_total(rule, totals, day) - count
+        needed = rule.threshold - before
+        if needed > count:
+            continue
+        if rule.mode == 'reach':
+            if needed >= 1:
+                ranks[day] = (needed, True)
+        else:
+            ranks[day] = (max(needed, 1), False)
+    return ranks
+
+
+def chunk_days(totals, days, chunk_size):
+    """Group sorted days into runs of roughly ``chunk_size`` spottings."""
+    chunk, rows = [], 0
+    for day in sorted(days):
+        chunk.append(day)
+        rows += totals[day]
+        if rows >= chunk_size:
+            yield chunk
+            chunk, rows = [], 0
+    if chunk:
+        yield chunk
+
+
+def insert_awards(rule, chunk, ranks):
+    """Award the badge to qualifying spottings on the given days in one statement."""
+    day = cast(AnimalSpotting.spotted_at, Date)
+    ranked = select(
+        AnimalSpotting.id.label('spotting_id'),
+        day.label('day'),
+        func.row_number().over(
+            partition_by=day, order_by=(AnimalSpotting.spotted_at, AnimalSpotting.id)
+        ).label('rank'),
+    ).where(
+        *spotting_conditions(rule),
+        AnimalSpotting.spotted_at >= chunk[0],
+        AnimalSpotting.spotted_at < chunk[-1] + timedelta(days=1),
+    ).subquery()
+
+    needs = values(
+        column('day', Date), column('rank', Integer), column('exact', Boolean), name='needs'
+    ).data([(d, *ranks[d]) for d in chunk])
+
+    awarded = select(
+        ranked.c.spotting_id, literal(rule.badge_id, Integer), literal(datetime.utcnow(), DateTime)
+    ).join(
+        needs, needs.c.day == ranked.c.day
+    ).where(or_(
+        and_(needs.c.exact, ranked.c.rank == needs.c.rank),
+        and_(~needs.c.exact, ranked.c.rank >= needs.c.rank),
+    ))
+
+    statement = insert(spotting_badges).from_select(
+        ['spotting_id', 'badge_id', 'awarded_at'], awarded
+    ).on_conflict_do_nothing()
+    return db.session.execute(statement).rowcount
+
+
+def counter_values(rule, totals, today):
+    """``{counter name: value}`` of the buckets ``rule`` reads on ``today``."""
+    names = rule.bucket_names(today)
+    if rule.window == 'all':
+        return {names[0]: sum(totals.values())}
+    if rule.window == 'day':
+        return {name: totals.get(today - timedelta(days=i), 0) for i, name in enumerate(names)}
+    counts = {}
+    for i, name in enumerate(names):
+        start = week_start(today) - timedelta(weeks=i)
+        counts[name] = sum(count for d, count in totals.items() if start <= d < start + timedelta(weeks=1))
+    return counts
+
+
+def first_bucket_day(rule, today):
+    """First day counted by the buckets ``rule`` reads on ``today``; None for all time."""
+    if rule.window == 'day':
+        return today - timedelta(days=rule.span - 1)
+    if rule.window == 'week':
+        return week_start(today) - timedelta(weeks=rule.span - 1)
+    return None
+
+
+def write_counters(rule, totals, today):
+    """Store the counters the live evaluator reads for ``rule`` from now on.
+
+    The shared spotting counters are maintained live by every upload and are only
+    created from ``totals`` if missing. Badge-specific counters are recounted
+    with their rows locked and overwritten in the caller's transaction: a
+    spotting committed before the lock is in the recount, and one recorded
+    after waits for the lock and then increments the stored value, so none is
+    lost however long the backfill ran.
+    """
+    if not rule.bucket_names(today):
+        return
+    now = datetime.utcnow()
+    if not rule.filtered:
+        statement = insert(AchievementCounter).values([
+            {'name': name, 'value': value, 'updated_at': now}
+            for name, value in counter_values(rule, totals, today).items()
+        ]).on_conflict_do_nothing()
+        db.session.execute(statement)
+        return
+
+    names = sorted(rule.bucket_names(today))
+    # Rows must exist before locking, or an upload could insert one the recount misses
+    db.session.execute(insert(AchievementCounter).values([
+        {'name': name, 'value': 0, 'updated_at': now} for name in names
+    ]).on_conflict_do_nothing())
+    db.session.commit()
+
+    db.session.execute(
+        select(AchievementCounter.name).where(AchievementCounter.name.in_(names))
+        .order_by(AchievementCounter.name).with_for_update()
+    )
+    recounted = daily_totals(rule, first_bucket_day(rule, today))
+    for name, value in counter_values(rule, recounted, today).items():
+        db.session.execute(
+            update(AchievementCounter).where(AchievementCounter.name == name)
+            .values(value=value, updated_at=now)
+        )
+
+
+def backfill_rule(rule, chunk_size=50000):
+    """Award ``rule``'s badge to every historical spotting that earns it.
+
+    Commits after each chunk so a long backfill can be interrupted and re-run;
+    existing awards are left untouched. Returns the number of new awards.
+    Raises UnsupportedDatabaseError unless the database is PostgreSQL.
+    """
+    require_postgresql()
+    totals = daily_totals(rule)
+    ranks = award_ranks(rule, totals)
+
+    awarded = 0
+    for chunk in chunk_days(totals, ranks, chunk_size):
+        awarded += insert_awards(rule, chunk, ranks)
+        db.session.commit()
+        logger.info(f"Badge {rule.badge_id}: {awarded} awards through {chunk[-1].isoformat()}")
+
+    write_counters(rule, totals, datetime.utcnow().date())
+    db.session.commit()
+    return awarded
@@ -0,0 +1,165 @@
+"""Declarative badge rules stored in ``Badge.criteria``.
+
+A rule is a JSON object, for example::
+
+    {"threshold": 3, "window": "week", "species": ["fox"]}
+
+Fields:
+
+- ``threshold``: spottings (or consecutive days for ``streak``) needed, default 1
+- ``window``: ``all``, ``day``, ``week`` (Monday-based, UTC) or ``streak``
+- ``span``: number of day/week buckets the window covers, ending with the current one
+- ``mode``: ``reach`` awards only the spotting that hits the threshold, ``at_least``
+  awards every spotting once the threshold is met (default)
+- ``species``: terms matched case-insensitively against the recognised animal
+- ``bbox``: ``[min_lat, min_lng, max_lat, max_lng]`` matched against the spotting location
+- ``task_type``: only count spottings made for ``daily`` or ``weekly`` tasks
+
+The original criteria names ('first_spot', 'daily_5', 'weekly_complete') remain
+valid and are expanded to their equivalent rules.
+"""
+import json
+from datetime import timedelta
+
+LEGACY_RULES = {
+    'first_spot': {'threshold': 1, 'window': 'all', 'mode': 'reach'},
+    'daily_5': {'threshold': 5, 'window': 'day', 'span': 2},
+    'weekly_complete': {'task_type': 'weekly'},
+}
+
+WINDOWS = ('all', 'day', 'week', 'streak')
+MODES = ('reach', 'at_least')
+FIELDS = {'threshold', 'window', 'span', 'mode', 'species', 'bbox', 'task_type'}
+
+
+class RuleError(ValueError):
+    """Raised for badge criteria that cannot be compiled."""
+
+
+def week_start(day):
+    return day - timedelta(days=day.weekday())
+
+
+def parse_location(location):
+    """Parse a 'lat,lng' location string, returning None if it is not coordinates."""
+    try:
+        lat, lng = (float(part) for part in (location or '').split(','))
+    except ValueError:
+        return None
+    return lat, lng
+
+
+class BadgeRule:
+    def __init__(self, badge_id, threshold=1, window='all', span=1, mode='at_least',
+                 species=None, bbox=None, task_type=None):
+        self.badge_id = badge_id
+        self.threshold = threshold
+        self.window = window
+        self.span = span
+        self.mode = mode
+        self.species = [term.lower() for term in species] if species else None
+        self.bbox = bbox
+        self.task_type = task_type
+
+    @property
+    def filtered(self):
+        return bool(self.species or self.bbox or self.task_type)
+
+    @property
+    def namespace(self):
+        """Counter name prefix; unfiltered rules share the global spotting counters."""
+        return f'badge:{self.badge_id}' if self.filtered else 'spottings'
+
+    def matches(self, spotting):
+        if self.species:
+            animal = (spotting.recognition_result or '').lower()
+            if not any(term in animal for term in self.species):
+                return False
+        if self.bbox:
+            point = parse_location(spotting.location)
+            if point is None:
+                return False
+            min_lat, min_lng, max_lat, max_lng = self.bbox
+            if not (min_lat <= point[0] <= max_lat and min_lng <= point[1] <= max_lng):
+                return False
+        if self.task_type:
+            if not spotting.task or spotting.task.task_type != self.task_type:
+                return False
+        return True
+
+    def bucket_names(self, day):
+        """Counter names for the current bucket followed by the earlier buckets in the span."""
+        if self.window == 'all':
+            return [f'{self.namespace}:total']
+        if self.window == 'day':
+            return [f'{self.namespace}:day:{(day - timedelta(days=i)).isoformat()}'
+                    for i in range(self.span)]
+        if self.window == 'week':
+            start = week_start(day)
+            return [f'{self.namespace}:week:{(start - timedelta(weeks=i)).isoformat()}'
+                    for i in range(self.span)]
+        return []
+
+    def is_met(self, count, count_before):
+        """Decide the award given the window count after and before this spotting."""
+        if self.mode == 'reach':
+            return count_before < self.threshold <= count
+        return count >= self.threshold
+
+
+def compile_rule(badge_id, criteria):
+    """Compile a Badge.criteria value into a BadgeRule, raising RuleError if invalid."""
+    if criteria in LEGACY_RULES:
+        spec = LEGACY_RULES[criteria]
+    else:
+        try:
+            spec = json.loads(criteria)
+        except (TypeError, ValueError) as e:
+            raise RuleError(f"Badge criteria is neither a known name nor JSON: {criteria!r}") from e
+        if not isinstance(spec, dict):
+            raise RuleError("Badge criteria JSON must be an object.")
+
+    unknown = set(spec) - FIELDS
+    if unknown:
+        raise RuleError(f"Unknown badge rule fields: {', '.join(sorted(unknown))}")
+
+    threshold = spec.get('threshold', 1)
+    span = spec.get('span', 1)
+    if not isinstance(threshold, int) or threshold < 1:
+        raise RuleError("threshold must be a positive integer.")
+    if not isinstance(span, int) or span < 1:
+        raise RuleError("span must be a positive integer.")
+    if spec.get('window', 'all') not in WINDOWS:
+        raise RuleError(f"window must be one of {', '.join(WINDOWS)}.")
+    if spec.get('mode', 'at_least') not in MODES:
+        raise RuleError(f"mode must be one of {', '.join(MODES)}.")
+    if spec.get('task_type') not in (None, 'daily', 'weekly'):
+        raise RuleError("task_type must be 'daily' or 'weekly'.")
+
+    species = spec.get('species')
+    if isinstance(species, str):
+        species = [species]
+    if species is not None and not all(isinstance(term, str) and term for term in species):
+        raise RuleError("species must be a string or a list of strings.")
+
+    bbox = spec.get('bbox')
+    if bbox is not None:
+        if not (isinstance(bbox, list) and len(bbox) == 4
+                and all(isinstance(value, (int, float)) for value in bbox)):
+            raise RuleError("bbox must be [min_lat, min_lng, max_lat, max_lng].")
+
+    rule = BadgeRule(
+        badge_id,
+        threshold=threshold,
+        window=spec.get('window', 'all'),
+        span=span,
+        mode=spec.get('mode', 'at_least'),
+        species=species,
+        bbox=bbox,
+        task_type=spec.get('task_type'),
+    )
+    if rule.window in ('all', 'streak') and rule.span != 1:
+        raise RuleError("span only applies to day and week windows.")
+    if rule.window == 'streak' and rule.filtered:
+        raise RuleError("streak rules cannot be filtered.")
+    return rule
@@ -0,0 +1,43 @@
+from datetime import datetime
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+
+
+def increment(model, key, amount=1, **columns):
+    """Atomically add ``amount`` to ``model.value`` for the row matching ``key`` and return the new value.
+
+    ``key`` maps primary/unique key columns to values. The row is created on first
+    use; ``columns`` supplies any extra values for that insert. The update runs in
+    the caller's transaction, so the counter commits or rolls back together with
+    whatever triggered it.
+    """
+    conditions = [getattr(model, column) == value for column, value in key.items()]
+    statement = update(model).where(*conditions).values(
+        value=model.value + amount, updated_at=datetime.utcnow()
+    ).returning(model.value).execution_options(synchronize_session=False)
+
+    for _ in range(2):
+        value = db.session.execute(statement).scalar()
+        if value is not None:
+            return value
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(model(value=amount, **key, **columns))
+            return amount
+        except IntegrityError:
+            # A concurrent transaction created the row first; update it instead
+            continue
+
+    raise RuntimeError(f"Could not increment counter {key}")
+
+
+def get_values(model, column, keys):
+    """Return ``{key: value}`` for the given keys of one key column, defaulting to 0."""
+    rows = db.session.execute(
+        select(column, model.value).where(column.in_(keys))
+    ).all()
+    values = dict.fromkeys(keys, 0)
+    values.update(dict(rows))
+    return values
@@ -1,30 +1,41 @@
+import asyncio
 import base64
 import logging
+import mimetypes
 from flask import current_app
 import json
-from openai import OpenAI
 from pydantic import BaseModel
-from typing import Dict, Any, List
-
-# Set up logging to console
-logging.basicConfig(
-    level=logging.DEBUG,  # Set the log level to DEBUG to capture all log messages
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler()  # Log to console
-    ]
-)
+from typing import Dict, Any, AsyncIterator, Iterator, List, Optional, Tuple
+from services import metrics
+from services.openai_client import CircuitOpenError, call_model, call_model_async
 
 logger = logging.getLogger(__name__)
 
-def generate_tasks(location_info: Dict[str, str]) -> Dict[str, list]:
-    """Generate animal spotting tasks based on location using Structured Outputs."""
-    api_key = current_app.config.get('OPENAI_API_KEY')
+# Expected response schemas for Structured Outputs
+class TaskResponse(BaseModel):
+    daily: List[str]
+    weekly: List[str]
 
-    if not api_key:
-        logger.warning("API key is not configured. Using mock tasks.")
-        return get_mock_tasks()
+class RegionTaskResponse(BaseModel):
+    region_id: str
+    daily: List[str]
+    weekly: List[str]
 
+class BatchTaskResponse(BaseModel):
+    regions: List[RegionTaskResponse]
+
+class AnimalDetails(BaseModel):
+    habitat: str
+    diet: str
+    behavior: str
+    interesting_facts: List[str]
+
+class AnimalRecognitionResponse(BaseModel):
+    animal: str
+    details: AnimalDetails
+
+def _task_messages(location_info: Dict[str, str]) -> List[Dict[str, str]]:
+    """Build the task generation request messages for a location."""
     # Ensure location info is properly encoded
     location_str = json.dumps(location_info, ensure_ascii=False)
     prompt = (
@@ -32,27 +43,32 @@ def generate_tasks(location_info: Dict[str, str]) -> Dict[str, list]:
         f"(common animals) and 2 weekly animal spotting tasks (rarer animals) that would "
         f"be realistic to find in this area."
     )
+    return [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant that returns responses in JSON format."
+        },
+        {"role": "user", "content": prompt}
+    ]
 
-    try:
-        client = OpenAI(api_key=api_key)
+def generate_tasks(location_info: Dict[str, str]) -> Dict[str, list]:
+    """Generate animal spotting tasks based on location using Structured Outputs."""
+    api_key = current_app.config.get('OPENAI_API_KEY')
 
-        # Define the expected response schema using Pydantic
-        class TaskResponse(BaseModel):
-            daily: List[str]
-            weekly: List[str]
+    if not api_key:
+        logger.warning("API key is not configured. Using mock tasks.")
+        return get_mock_tasks()
+
+    try:
+        messages = _task_messages(location_info)
 
         # Use Structured Outputs with response_format
-        completion = client.beta.chat.completions.parse(
+        completion = call_model('generate_tasks', lambda client, timeout: client.beta.chat.completions.parse(
             model="gpt-4o-2024-08-06",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that returns responses in JSON format."
-                },
-                {"role": "user", "content": prompt}
-            ],
+            messages=messages,
             response_format=TaskResponse,
-        )
+            timeout=timeout,
+        ))
 
         result = completion.choices[0].message.parsed
 
@@ -60,10 +76,159 @@ def generate_tasks(location_info: Dict[str, str]) -> Dict[str, list]:
         logger.info("Successfully generated tasks.")
         return result.dict()
 
+    except CircuitOpenError as e:
+        logger.warning(f"{str(e)} Using mock tasks.")
+        return get_mock_tasks()
     except Exception as e:
         logger.error(f"Error calling OpenAI API for generate_tasks: {str(e)}", exc_info=True)
         return get_mock_tasks()
 
+async def generate_tasks_async(location_info: Dict[str, str]) -> Dict[str, list]:
+    """Async counterpart of generate_tasks for the ASGI entry point."""
+    if not current_app.config.get('OPENAI_API_KEY'):
+        logger.warning("API key is not configured. Using mock tasks.")
+        return get_mock_tasks()
+
+    try:
+        completion = await call_model_async('generate_tasks', lambda client, timeout: client.beta.chat.completions.parse(
+            model="gpt-4o-2024-08-06",
+            messages=_task_messages(location_info),
+            response_format=TaskResponse,
+            timeout=timeout,
+        ))
+        logger.info("Successfully generated tasks.")
+        return completion.choices[0].message.parsed.dict()
+
+    except CircuitOpenError as e:
+        logger.warning(f"{str(e)} Using mock tasks.")
+        return get_mock_tasks()
+    except Exception as e:
+        logger.error(f"Error calling OpenAI API for generate_tasks: {str(e)}", exc_info=True)
+        return get_mock_tasks()
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token) for batch sizing."""
+    return len(text) // 4 + 1
+
+def pack_task_batches(locations: Dict[str, Dict[str, str]], max_tokens: int, max_regions: int) -> List[List[str]]:
+    """Split location keys into batches whose prompt and expected output fit ``max_tokens``."""
+    per_region_output = current_app.config.get('TASK_BATCH_OUTPUT_TOKENS', 80)
+    batches, batch, used = [], [], 0
+    for key, location_info in locations.items():
+        cost = estimate_tokens(json.dumps(location_info, ensure_ascii=False)) + per_region_output
+        if batch and (used + cost > max_tokens or len(batch) >= max_regions):
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(key)
+        used += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+def _generate_task_batch(locations: Dict[str, Dict[str, str]], keys: List[str]) -> Dict[str, Dict[str, list]]:
+    """Generate tasks for one batch, returning only the regions answered in full."""
+    # Short ids keep long region keys out of the prompt and the response
+    ids = {f"r{i}": key for i, key in enumerate(keys)}
+    listing = "\n".join(
+        f"{region_id}: {json.dumps(locations[key], ensure_ascii=False)}" for region_id, key in ids.items()
+    )
+    prompt = (
+        f"For each of the following locations, suggest 3 daily animal spotting tasks "
+        f"(common animals) and 2 weekly animal spotting tasks (rarer animals) that would "
+        f"be realistic to find in that area. Return one entry per location with its region_id.\n\n"
+        f"{listing}"
+    )
+    max_tokens = current_app.config.get('TASK_BATCH_OUTPUT_TOKENS', 80) * len(keys) + 200
+    # Long batches need more than the default per-call timeout
+    batch_timeout = current_app.config.get('TASK_BATCH_TIMEOUT', 120.0)
+
+    completion = call_model('generate_tasks_batch', lambda client, timeout: client.beta.chat.completions.parse(
+        model="gpt-4o-2024-08-06",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a helpful assistant that returns responses in JSON format."
+            },
+            {"role": "user", "content": prompt}
+        ],
+        response_format=BatchTaskResponse,
+        max_tokens=max_tokens,
+        timeout=timeout,
+    ), timeout=batch_timeout, deadline=batch_timeout * 2)
+
+    results = {}
+    for region in completion.choices[0].message.parsed.regions:
+        key = ids.get(region.region_id)
+        if key is not None and key not in results and region.daily and region.weekly:
+            results[key] = {'daily': region.daily, 'weekly': region.weekly}
+    return results
+
+def generate_tasks_batch(locations: Dict[str, Dict[str, str]]) -> Dict[str, Optional[Dict[str, list]]]:
+    """Generate tasks for many locations, several per model call.
+
+    ``locations`` maps a caller-chosen key (e.g. a region) to its location info.
+    Batches are bounded by TASK_BATCH_MAX_TOKENS and TASK_BATCH_MAX_REGIONS.
+    Returns ``{key: tasks}``; keys whose batch failed or that the model left out
+    map to None so callers can retry them individually. Mock tasks are never
+    returned.
+    """
+    results = dict.fromkeys(locations)
+    if not current_app.config.get('OPENAI_API_KEY'):
+        logger.warning("API key is not configured. Skipping batch task generation.")
+        return results
+
+    batches = pack_task_batches(
+        locations,
+        current_app.config.get('TASK_BATCH_MAX_TOKENS', 4000),
+        current_app.config.get('TASK_BATCH_MAX_REGIONS', 25),
+    )
+    for keys in batches:
+        try:
+            answered = _generate_task_batch(locations, keys)
+        except CircuitOpenError as e:
+            logger.warning(f"{str(e)} Skipping {len(keys)} regions.")
+            continue
+        except Exception as e:
+            logger.error(f"Error calling OpenAI API for generate_tasks_batch: {str(e)}", exc_info=True)
+            continue
+        results.update(answered)
+        if len(answered) < len(keys):
+            logger.warning(f"Batch task generation answered {len(answered)} of {len(keys)} regions")
+    logger.info(f"Generated tasks for {sum(1 for tasks in results.values() if tasks)} of "
+                f"{len(locations)} regions in {len(batches)} batches.")
+    return results
+
+def _recognition_messages(image_path: str) -> List[Dict[str, Any]]:
+    """Build the vision request messages for an image."""
+    # Read and encode the image
+    with open(image_path, "rb") as image_file:
+        base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+    mime_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+
+    # Prepare the messages
+    system_prompt = (
+        "You are an expert wildlife identifier. Analyze the image and provide detailed information "
+        "about any animals present."
+    )
+    user_prompt = "Please identify the animal in this image and provide detailed information."
+
+    # Include the image in the user message
+    return [
+        {"role": "system", "content": system_prompt},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": user_prompt},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{base64_image}"
+                    },
+                },
+            ],
+        },
+    ]
+
 def recognize_animal(image_path: str) -> Dict[str, Any]:
     """Recognize animal in image and provide detailed information using Vision capabilities."""
     api_key = current_app.config.get('OPENAI_API_KEY')
@@ -73,54 +238,16 @@ def recognize_animal(image_path: str) -> Dict[str, Any]:
         return get_mock_recognition()
 
     try:
-        # Read and encode the image
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-        client = OpenAI(api_key=api_key)
-
-        # Define the expected response schema using Pydantic
-        class AnimalDetails(BaseModel):
-            habitat: str
-            diet: str
-            behavior: str
-            interesting_facts: List[str]
-
-        class AnimalRecognitionResponse(BaseModel):
-            animal: str
-            details: AnimalDetails
-
-        # Prepare the messages
-        system_prompt = (
-            "You are an expert wildlife identifier. Analyze the image and provide detailed information "
-            "about any animals present."
-        )
-        user_prompt = "Please identify the animal in this image and provide detailed information."
-
-        # Include the image in the user message
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        },
-                    },
-                ],
-            },
-        ]
+        messages = _recognition_messages(image_path)
 
         # Use the model that supports vision capabilities
-        completion = client.beta.chat.completions.parse(
+        completion = call_model('recognize_animal', lambda client, timeout: client.beta.chat.completions.parse(
             model="gpt-4o-2024-08-06",
             messages=messages,
             response_format=AnimalRecognitionResponse,
             max_tokens=1000,
-        )
+            timeout=timeout,
+        ))
 
         result = completion.choices[0].message.parsed
 
@@ -128,10 +255,137 @@ def recognize_animal(image_path: str) -> Dict[str, Any]:
         logger.info("Successfully recognized animal.")
         return result.dict()
 
+    except CircuitOpenError as e:
+        logger.warning(f"{str(e)} Using mock recognition data.")
+        return get_mock_recognition()
+    except Exception as e:
+        logger.error(f"Error calling OpenAI API for recognize_animal: {str(e)}", exc_info=True)
+        return get_mock_recognition()
+
+async def recognize_animal_async(image_path: str) -> Dict[str, Any]:
+    """Async counterpart of recognize_animal for the ASGI entry point."""
+    if not current_app.config.get('OPENAI_API_KEY'):
+        logger.warning("API key is not configured. Using mock recognition data.")
+        return get_mock_recognition()
+
+    try:
+        # Reading and encoding the image is blocking file work
+        messages = await asyncio.to_thread(_recognition_messages, image_path)
+
+        completion = await call_model_async('recognize_animal', lambda client, timeout: client.beta.chat.completions.parse(
+            model="gpt-4o-2024-08-06",
+            messages=messages,
+            response_format=AnimalRecognitionResponse,
+            max_tokens=1000,
+            timeout=timeout,
+        ))
+        logger.info("Successfully recognized animal.")
+        return completion.choices[0].message.parsed.dict()
+
+    except CircuitOpenError as e:
+        logger.warning(f"{str(e)} Using mock recognition data.")
+        return get_mock_recognition()
     except Exception as e:
         logger.error(f"Error calling OpenAI API for recognize_animal: {str(e)}", exc_info=True)
         return get_mock_recognition()
 
+def stream_recognize_animal(image_path: str) -> Iterator[Tuple[Dict[str, Any], bool]]:
+    """Recognize an animal, yielding ``(snapshot, final)`` pairs as the response is generated.
+
+    Snapshots are the partially parsed AnimalRecognitionResponse; the last pair is
+    the complete result with ``final`` set. Falls back to the mock recognition if
+    the request cannot be started, like recognize_animal. Errors after output has
+    started are raised, since a fallback would contradict what was already sent.
+    """
+    api_key = current_app.config.get('OPENAI_API_KEY')
+
+    if not api_key:
+        logger.warning("API key is not configured. Using mock recognition data.")
+        yield get_mock_recognition(), True
+        return
+
+    try:
+        messages = _recognition_messages(image_path)
+
+        # Entering the stream manager sends the request, so retries cover the connection only
+        def open_stream(client, timeout):
+            manager = client.beta.chat.completions.stream(
+                model="gpt-4o-2024-08-06",
+                messages=messages,
+                response_format=AnimalRecognitionResponse,
+                max_tokens=1000,
+                timeout=timeout,
+            )
+            return manager, manager.__enter__()
+
+        manager, stream = call_model('recognize_animal_stream', open_stream)
+
+    except CircuitOpenError as e:
+        logger.warning(f"{str(e)} Using mock recognition data.")
+        yield get_mock_recognition(), True
+        return
+    except Exception as e:
+        logger.error(f"Error calling OpenAI API for recognize_animal_stream: {str(e)}", exc_info=True)
+        yield get_mock_recognition(), True
+        return
+
+    try:
+        for event in stream:
+            if event.type == 'content.delta' and event.parsed:
+                yield event.parsed, False
+        completion = stream.get_final_completion()
+        metrics.record_tokens('recognize_animal_stream', completion.usage)
+        result = completion.choices[0].message.parsed
+    finally:
+        manager.__exit__(None, None, None)
+
+    logger.info("Successfully recognized animal.")
+    yield result.dict(), True
+
+async def stream_recognize_animal_async(image_path: str) -> AsyncIterator[Tuple[Dict[str, Any], bool]]:
+    """Async counterpart of stream_recognize_animal for the ASGI entry point."""
+    if not current_app.config.get('OPENAI_API_KEY'):
+        logger.warning("API key is not configured. Using mock recognition data.")
+        yield get_mock_recognition(), True
+        return
+
+    try:
+        messages = await asyncio.to_thread(_recognition_messages, image_path)
+
+        async def open_stream(client, timeout):
+            manager = client.beta.chat.completions.stream(
+                model="gpt-4o-2024-08-06",
+                messages=messages,
+                response_format=AnimalRecognitionResponse,
+                max_tokens=1000,
+                timeout=timeout,
+            )
+            return manager, await manager.__aenter__()
+
+        manager, stream = await call_model_async('recognize_animal_stream', open_stream)
+
+    except CircuitOpenError as e:
+        logger.warning(f"{str(e)} Using mock recognition data.")
+        yield get_mock_recognition(), True
+        return
+    except Exception as e:
+        logger.error(f"Error calling OpenAI API for recognize_animal_stream: {str(e)}", exc_info=True)
+        yield get_mock_recognition(), True
+        return
+
+    try:
+        async for event in stream:
+            if event.type == 'content.delta' and event.parsed:
+                yield event.parsed, False
+        completion = await stream.get_final_completion()
+        metrics.record_tokens('recognize_animal_stream', completion.usage)
+        result = completion.choices[0].message.parsed
+    finally:
+        await manager.__aexit__(None, None, None)
+
+    logger.info("Successfully recognized animal.")
+    yield result.dict(), True
+
 def get_mock_tasks() -> Dict[str, list]:
     """Return mock tasks when OpenAI API call fails."""
     logger.debug("Returning mock tasks.")
@@ -0,0 +1,74 @@
+import logging
+import os
+from flask import current_app
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+    'webp': ('WEBP', '.webp', 'image/webp'),
+}
+
+
+def output_format():
+    """Return ``(pillow_format, extension, mime_type)`` for stored uploads."""
+    name = current_app.config.get('IMAGE_FORMAT', 'jpeg').lower()
+    if name not in FORMATS:
+        raise ValueError(f"Unsupported image format: {name}")
+    return FORMATS[name]
+
+
+def thumbnail_name(filename):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}_thumb{ext}"
+
+
+def original_name(filename):
+    """Inverse of thumbnail_name; returns other names unchanged."""
+    stem, ext = os.path.splitext(filename)
+    return f"{stem[:-len('_thumb')]}{ext}" if stem.endswith('_thumb') else filename
+
+
+def _flatten(image):
+    """Convert to RGB, compositing any transparency onto white."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def preprocess_image(source_path, dest_path):
+    """Downscale and re-encode an upload for the vision model, plus a thumbnail.
+
+    Applies EXIF orientation, bounds the longest side to IMAGE_MAX_DIMENSION and
+    writes a compact JPEG/WebP to ``dest_path`` alongside a share-page thumbnail.
+    Raises ValueError if the source is not a readable image.
+    """
+    pil_format, _, _ = output_format()
+    max_dimension = current_app.config.get('IMAGE_MAX_DIMENSION', 1024)
+    thumbnail_size = current_app.config.get('IMAGE_THUMBNAIL_SIZE', 640)
+    quality = current_app.config.get('IMAGE_QUALITY', 85)
+
+    try:
+        with Image.open(source_path) as image:
+            # Let the JPEG decoder scale down while decoding instead of after
+            image.draft('RGB', (max_dimension, max_dimension))
+            image = ImageOps.exif_transpose(image)
+            image = _flatten(image)
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError("The uploaded file is not a valid image.") from e
+
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    # Write under a temporary name so concurrent identical uploads never see a partial file
+    partial_path = f"{dest_path}.partial"
+    image.save(partial_path, pil_format, quality=quality, optimize=True)
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+    thumbnail.save(thumbnail_name(dest_path), pil_format, quality=quality, optimize=True)
+    os.replace(partial_path, dest_path)
+
+    logger.debug(f"Preprocessed {source_path} into {dest_path}")
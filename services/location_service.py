@@ -1,21 +1,357 @@
+import itertools
+import logging
+import math
+import mmap
+import threading
+from datetime import datetime, timedelta
+import httpx
 import requests
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import GeocodeCacheEntry
+from services import metrics, single_flight
+from services.async_support import run_sync
+from services.cache import LRUCache
 
-def get_location_info(lat, lng):
-    """Get location information from coordinates using Nominatim API"""
-    url = f"https://nominatim.openstreetmap.org/reverse?lat={lat}&lon={lng}&format=json"
-    
+logger = logging.getLogger(__name__)
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/reverse"
+USER_AGENT = "AnimalSpotter/0.1"
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180  # of latitude, or of longitude at the equator
+
+EVICT_EVERY = 50  # SQL cache stores per process between evictions
+
+_memory_cache = LRUCache(max_entries=4096)
+_stores = itertools.count(1)
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+_async_http_client = None
+
+
+def parse_coordinates(lat, lng):
+    """Return ``(lat, lng)`` as floats; raises ValueError unless both are valid coordinates."""
     try:
-        response = requests.get(url)
-        data = response.json()
-        
-        address = data.get('address', {})
-        location_info = {
-            'city': address.get('city'),
-            'state': address.get('state'),
-            'country': address.get('country'),
-            'natural': address.get('natural'),
+        lat = float(lat)
+        lng = float(lng)
+    except (TypeError, ValueError):
+        raise ValueError("Coordinates must be numbers.")
+    if not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        raise ValueError("Coordinates are out of range.")
+    return lat, lng
+
+
+def location_cell(lat, lng, precision=2):
+    """Round coordinates to the cache cell they belong to."""
+    lat, lng = parse_coordinates(lat, lng)
+    return f"{round(lat, precision):.{precision}f},{round(lng, precision):.{precision}f}"
+
+
+class Gazetteer:
+    """Offline reverse geocoder over a memory-mapped, tab-separated place list.
+
+    Each line holds ``latitude, longitude, city, state, country``; blank lines and
+    lines starting with ``#`` are ignored. Only coordinates and byte offsets are kept
+    in memory, bucketed into a grid of ``cell_size`` degrees; place names are read
+    back from the mapped file for the nearest match.
+    """
+
+    def __init__(self, path, cell_size=1.0):
+        self.path = path
+        self.cell_size = cell_size
+        self._grid = {}
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._build_index()
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_size), math.floor(lng / self.cell_size))
+
+    def _build_index(self):
+        offset = 0
+        size = len(self._mmap)
+        while offset < size:
+            end = self._mmap.find(b'\n', offset)
+            if end == -1:
+                end = size
+            line = self._mmap[offset:end]
+            if line.strip() and not line.startswith(b'#'):
+                fields = line.split(b'\t', 2)
+                try:
+                    lat, lng = float(fields[0]), float(fields[1])
+                except (IndexError, ValueError):
+                    logger.warning(f"Skipping malformed gazetteer line at byte {offset}")
+                else:
+                    self._grid.setdefault(self._cell(lat, lng), []).append((lat, lng, offset))
+            offset = end + 1
+        logger.info(f"Loaded gazetteer {self.path} into {len(self._grid)} grid cells")
+
+    def _read(self, offset):
+        end = self._mmap.find(b'\n', offset)
+        line = self._mmap[offset:end if end != -1 else len(self._mmap)]
+        fields = line.decode('utf-8').rstrip('\r').split('\t')
+        fields += [''] * (5 - len(fields))
+        return {
+            'city': fields[2] or None,
+            'state': fields[3] or None,
+            'country': fields[4] or None,
+            'natural': None,
         }
-        
-        return location_info
+
+    @staticmethod
+    def _distance_km(lat1, lng1, lat2, lng2):
+        """Great-circle (haversine) distance, correct at any latitude and across the antimeridian."""
+        phi1, phi2 = math.radians(lat1), math.radians(lat2)
+        a = (math.sin((phi2 - phi1) / 2) ** 2
+             + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+    def _search_columns(self, col, lat, rows):
+        """Grid columns within ``rows`` cells of latitude's reach, wrapped around the antimeridian.
+
+        A cell spans cell_size degrees of longitude, which is only cos(latitude) as many
+        kilometres as a degree of latitude, so more columns than rows are searched; the
+        widest latitude the search reaches decides how many.
+        """
+        columns_per_turn = round(360 / self.cell_size)
+        edge_lat = min(89.0, abs(lat) + (rows + 1) * self.cell_size)
+        reach_km = rows * self.cell_size * KM_PER_DEGREE
+        span = math.ceil(reach_km / (self.cell_size * KM_PER_DEGREE * math.cos(math.radians(edge_lat))))
+        if 2 * span + 1 >= columns_per_turn:
+            return range(-(columns_per_turn // 2), columns_per_turn - columns_per_turn // 2)
+        half = columns_per_turn // 2
+        return [(c + half) % columns_per_turn - half for c in range(col - span, col + span + 1)]
+
+    def lookup(self, lat, lng, max_km=50.0):
+        """Return the nearest place within ``max_km``, or None."""
+        row, col = self._cell(lat, lng)
+        # Every cell that can hold a place within max_km, with longitude scaled by latitude
+        rows = math.ceil(max_km / (self.cell_size * KM_PER_DEGREE))
+        columns = self._search_columns(col, lat, rows)
+        best = None
+        best_km = max_km
+        for r in range(row - rows, row + rows + 1):
+            for c in columns:
+                for place_lat, place_lng, offset in self._grid.get((r, c), ()):
+                    km = self._distance_km(lat, lng, place_lat, place_lng)
+                    if km <= best_km:
+                        best, best_km = offset, km
+        return self._read(best) if best is not None else None
+
+
+def get_gazetteer():
+    """Load the configured gazetteer once per process."""
+    global _gazetteer
+    path = current_app.config.get('GEOCODER_GAZETTEER')
+    if not path:
+        return None
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer(path)
+    return _gazetteer
+
+
+def _nominatim_request(lat, lng):
+    """Return the keyword arguments for a Nominatim reverse geocoding request."""
+    return {
+        'url': current_app.config.get('NOMINATIM_URL', NOMINATIM_URL),
+        'params': {'lat': lat, 'lon': lng, 'format': 'json'},
+        'headers': {'User-Agent': current_app.config.get('GEOCODER_USER_AGENT', USER_AGENT)},
+        'timeout': current_app.config.get('GEOCODER_TIMEOUT', 5),
+    }
+
+
+def _parse_nominatim(data):
+    address = data.get('address', {})
+    return {
+        'city': address.get('city'),
+        'state': address.get('state'),
+        'country': address.get('country'),
+        'natural': address.get('natural'),
+    }
+
+
+def _lookup_nominatim(lat, lng):
+    response = requests.get(**_nominatim_request(lat, lng))
+    response.raise_for_status()
+    return _parse_nominatim(response.json())
+
+
+async def _lookup_nominatim_async(lat, lng):
+    response = await get_async_http_client().get(**_nominatim_request(lat, lng))
+    response.raise_for_status()
+    return _parse_nominatim(response.json())
+
+
+def get_async_http_client():
+    """Return the pooled httpx client shared by async geocoding requests."""
+    global _async_http_client
+    if _async_http_client is None:
+        _async_http_client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=current_app.config.get('ASYNC_MAX_CONNECTIONS', 200),
+            max_keepalive_connections=current_app.config.get('ASYNC_MAX_KEEPALIVE', 50),
+        ))
+    return _async_http_client
+
+
+async def close_async_http_client():
+    """Close the pooled httpx client; called when the ASGI server shuts down."""
+    global _async_http_client
+    client, _async_http_client = _async_http_client, None
+    if client is not None:
+        await client.aclose()
+
+
+def _resolve_offline(lat, lng):
+    """Look the point up in the gazetteer per GEOCODER_MODE; None means ask Nominatim."""
+    mode = current_app.config.get('GEOCODER_MODE', 'online')
+    if mode in ('offline', 'auto'):
+        gazetteer = get_gazetteer()
+        if gazetteer is not None:
+            location_info = gazetteer.lookup(lat, lng, current_app.config.get('GEOCODER_OFFLINE_MAX_KM', 50.0))
+            if location_info is not None:
+                return location_info
+        if mode == 'offline':
+            raise LookupError("No gazetteer entry near these coordinates.")
+    return None
+
+
+def _resolve(lat, lng):
+    with metrics.timed('geocode'):
+        return _resolve_offline(lat, lng) or _lookup_nominatim(lat, lng)
+
+
+def _cache_ttl():
+    return current_app.config.get('GEOCODER_CACHE_TTL', 30 * 24 * 60 * 60)
+
+
+def _load_cached(cell):
+    """Return the cached ``(location_info, seconds left)`` of a cell, or ``(None, None)``."""
+    now = datetime.utcnow()
+    entry = GeocodeCacheEntry.query.filter(
+        GeocodeCacheEntry.cell == cell,
+        GeocodeCacheEntry.expires_at > now
+    ).first()
+    if entry is None:
+        return None, None
+    return entry.location_info, (entry.expires_at - now).total_seconds()
+
+
+def _store_cached(cell, location_info):
+    now = datetime.utcnow()
+    entry = GeocodeCacheEntry.query.filter_by(cell=cell).first()
+    if entry is None:
+        entry = GeocodeCacheEntry(cell=cell)
+        db.session.add(entry)
+    entry.location_info = location_info
+    entry.created_at = now
+    entry.expires_at = now + timedelta(seconds=_cache_ttl())
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return
+
+    # Evicting scans the table, so only every EVICT_EVERY stores rather than on each miss
+    if next(_stores) % EVICT_EVERY == 0:
+        _evict_cached(now)
+
+
+def _evict_cached(now):
+    GeocodeCacheEntry.query.filter(GeocodeCacheEntry.expires_at <= now).delete(synchronize_session=False)
+    overflow = GeocodeCacheEntry.query.count() - current_app.config.get('GEOCODER_CACHE_MAX_ENTRIES', 100000)
+    if overflow > 0:
+        oldest = [row.id for row in GeocodeCacheEntry.query
+                  .with_entities(GeocodeCacheEntry.id)
+                  .order_by(GeocodeCacheEntry.created_at.asc())
+                  .limit(overflow)]
+        GeocodeCacheEntry.query.filter(GeocodeCacheEntry.id.in_(oldest)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def _try_store_cached(cell, location_info):
+    try:
+        _store_cached(cell, location_info)
+    except Exception as e:
+        logger.error(f"Failed to store geocode cache entry: {str(e)}", exc_info=True)
+        db.session.rollback()
+
+
+def _lookup_cell(cell, lat, lng):
+    location_info, ttl = _load_cached(cell)
+    if location_info is None:
+        location_info, ttl = _resolve(lat, lng), _cache_ttl()
+        _try_store_cached(cell, location_info)
+    _memory_cache.set(cell, location_info, ttl=ttl)
+    return location_info
+
+
+def known_place(lat, lng):
+    """The place of a point from the geocode caches or the gazetteer, never Nominatim; None if unknown."""
+    cell = location_cell(lat, lng, current_app.config.get('GEOCODER_PRECISION', 2))
+    location_info = _memory_cache.get(cell)
+    if location_info is None:
+        location_info, ttl = _load_cached(cell)
+        if location_info is not None:
+            _memory_cache.set(cell, location_info, ttl=ttl)
+    if location_info is None:
+        gazetteer = get_gazetteer()
+        if gazetteer is not None:
+            location_info = gazetteer.lookup(lat, lng, current_app.config.get('GEOCODER_OFFLINE_MAX_KM', 50.0))
+    return location_info
+
+
+def get_location_info(lat, lng):
+    """Get location information from coordinates, using the geocode cache when possible"""
+    try:
+        precision = current_app.config.get('GEOCODER_PRECISION', 2)
+        cell = location_cell(lat, lng, precision)
+
+        location_info = _memory_cache.get(cell)
+        if location_info is not None:
+            return location_info
+
+        # Snap to the cell centre so every caller in the cell gets the same answer,
+        # and coalesce concurrent lookups for the cell onto a single upstream call.
+        cell_lat, cell_lng = (float(part) for part in cell.split(','))
+        return single_flight.do(
+            f"geocode:{cell}",
+            lambda: _lookup_cell(cell, cell_lat, cell_lng),
+            current_app.config.get('GEOCODER_TIMEOUT', 5) * 2,
+        )
+    except Exception as e:
+        return {'error': str(e)}
+
+
+async def _lookup_cell_async(cell, lat, lng):
+    location_info, ttl = await run_sync(_load_cached, cell)
+    if location_info is None:
+        # The gazetteer is an in-memory index, cheap enough to query on the loop
+        with metrics.timed('geocode'):
+            location_info = _resolve_offline(lat, lng) or await _lookup_nominatim_async(lat, lng)
+        ttl = _cache_ttl()
+        await run_sync(_try_store_cached, cell, location_info)
+    _memory_cache.set(cell, location_info, ttl=ttl)
+    return location_info
+
+
+async def get_location_info_async(lat, lng):
+    """Async counterpart of get_location_info for the ASGI entry point."""
+    try:
+        precision = current_app.config.get('GEOCODER_PRECISION', 2)
+        cell = location_cell(lat, lng, precision)
+
+        location_info = _memory_cache.get(cell)
+        if location_info is not None:
+            return location_info
+
+        cell_lat, cell_lng = (float(part) for part in cell.split(','))
+        return await single_flight.do_async(
+            f"geocode:{cell}",
+            lambda: _lookup_cell_async(cell, cell_lat, cell_lng),
+            current_app.config.get('GEOCODER_TIMEOUT', 5) * 2,
+        )
     except Exception as e:
         return {'error': str(e)}
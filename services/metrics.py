@@ -0,0 +1,218 @@
+"""Request and hot-path timings exported in the Prometheus text format.
+
+METRICS_ENABLED turns on collection and the ``/metrics`` endpoint; while it is
+off, ``timed`` and the other recorders return after one flag check.
+SERVER_TIMING additionally adds a Server-Timing header to each response with
+the time spent per stage (geocode, model, db, ...), for browser dev tools.
+
+Metrics are kept per process; with several worker processes, scrape each one
+or put them behind a per-worker port.
+
+Server-Timing stages are collected in a ContextVar, so stages timed in worker
+threads started with ``asyncio.to_thread`` (services.async_support.run_sync)
+are reported on the request that started them.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+
+PREFIX = 'animal_spotter'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+_enabled = False
+_server_timing = False
+_timings = ContextVar('server_timings', default=None)  # stage -> seconds for the current request
+_timings_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = f"{PREFIX}_{name}"
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = f"{PREFIX}_{name}"
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [per-bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for label_values, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels(self.labels, label_values, ('le', bound))} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(self.labels, label_values, ('le', '+Inf'))} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {count}"
+
+
+request_seconds = Histogram('http_request_duration_seconds', 'Time to handle a request.',
+                            ('endpoint', 'method', 'status'))
+request_queries = Histogram('http_request_db_queries', 'SQL statements issued per request.',
+                            ('endpoint',), COUNT_BUCKETS)
+request_db_seconds = Histogram('http_request_db_duration_seconds', 'Time spent in SQL statements per request.',
+                               ('endpoint',))
+stage_seconds = Histogram('stage_duration_seconds', 'Time spent in an instrumented stage.', ('stage',))
+model_call_seconds = Histogram('model_call_duration_seconds', 'Model call latency, including retries.',
+                               ('operation', 'outcome'))
+model_tokens = Counter('model_tokens_total', 'Tokens used by model calls.', ('operation', 'kind'))
+
+REGISTRY = [request_seconds, request_queries, request_db_seconds, stage_seconds, model_call_seconds, model_tokens]
+
+
+def enabled():
+    return _enabled
+
+
+def _add_server_timing(name, seconds):
+    timings = _timings.get()
+    if timings is not None:
+        with _timings_lock:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+def observe_stage(stage, seconds):
+    if not _enabled:
+        return
+    stage_seconds.observe(seconds, stage)
+    _add_server_timing(stage, seconds)
+
+
+@contextmanager
+def timed(stage):
+    """Time the block as ``stage`` in stage_duration_seconds and Server-Timing."""
+    if not _enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def observe_model_call(operation, outcome, seconds, usage=None):
+    """Record a model call; ``usage`` is the completion's token usage, if any."""
+    if not _enabled:
+        return
+    model_call_seconds.observe(seconds, operation, outcome)
+    _add_server_timing('model', seconds)
+    record_tokens(operation, usage)
+
+
+def record_tokens(operation, usage):
+    if not _enabled or usage is None:
+        return
+    model_tokens.inc(operation, 'prompt', amount=getattr(usage, 'prompt_tokens', 0) or 0)
+    model_tokens.inc(operation, 'completion', amount=getattr(usage, 'completion_tokens', 0) or 0)
+
+
+def render(gauges=()):
+    """Render the registry, plus ``(name, help, {labels: value})`` gauges, as Prometheus text."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for name, help_text, values in gauges:
+        name = f"{PREFIX}_{name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values.items():
+            label_names = [label_name for label_name, _ in labels]
+            label_values = [label_value for _, label_value in labels]
+            lines.append(f"{name}{_format_labels(label_names, label_values)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """Time every request when METRICS_ENABLED is set.
+
+    Call after query_counter.init_app, whose per-request counter this reports.
+    """
+    global _enabled, _server_timing
+    _enabled = bool(app.config.get('METRICS_ENABLED'))
+    _server_timing = _enabled and bool(app.config.get('SERVER_TIMING'))
+    if not _enabled:
+        return
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        if _server_timing:
+            _timings.set({})
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        # Streamed responses are timed until their headers are ready
+        request_seconds.observe(elapsed, endpoint, request.method, str(response.status_code))
+
+        counter = g.get('query_counter')
+        if counter is not None:
+            request_queries.observe(counter.count, endpoint)
+            request_db_seconds.observe(counter.duration, endpoint)
+            _add_server_timing('db', counter.duration)
+
+        timings = _timings.get()
+        if timings is not None:
+            with _timings_lock:
+                entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+            entries.append(f"total;dur={elapsed * 1000:.1f}")
+            response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    @app.teardown_request
+    def stop_server_timing(exc):
+        _timings.set(None)
@@ -0,0 +1,320 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import httpx
+import openai
+from flask import current_app
+from openai import AsyncOpenAI, OpenAI
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying and counting against the upstream's health
+TRANSIENT_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the model while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Open after consecutive transient failures; allow one probe after a cooldown."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def configure(self, failure_threshold, reset_timeout):
+        with self._lock:
+            self.failure_threshold = failure_threshold
+            self.reset_timeout = reset_timeout
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    logger.warning("Model circuit breaker opened after repeated upstream failures.")
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def abandon(self):
+        """Release the half-open probe of a call that ended without an upstream answer."""
+        with self._lock:
+            self._probing = False
+
+
+class RetryBudget:
+    """Cap retries to a fraction of recent calls so retries cannot amplify an outage."""
+
+    def __init__(self, ratio=0.2, min_retries=3):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.calls = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+            # Decay so the budget tracks recent traffic rather than all-time totals
+            if self.calls >= 1000:
+                self.calls //= 2
+                self.retries //= 2
+
+    def try_spend(self):
+        with self._lock:
+            if self.retries >= max(self.min_retries, self.calls * self.ratio):
+                return False
+            self.retries += 1
+            return True
+
+
+class CallStats:
+    """Per-operation call counters and latency totals."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, operation):
+        return self._stats.setdefault(operation, {
+            'calls': 0, 'successes': 0, 'failures': 0, 'rejected': 0,
+            'retries': 0, 'latency_total': 0.0, 'latency_max': 0.0,
+        })
+
+    def record(self, operation, outcome, latency):
+        with self._lock:
+            stats = self._entry(operation)
+            stats['calls'] += 1
+            stats[outcome] += 1
+            stats['latency_total'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+
+    def record_retry(self, operation):
+        with self._lock:
+            self._entry(operation)['retries'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {operation: dict(stats) for operation, stats in self._stats.items()}
+
+
+breaker = CircuitBreaker()
+retry_budget = RetryBudget()
+call_stats = CallStats()
+
+
+def init_app(app):
+    """Configure the shared circuit breaker from OPENAI_BREAKER_THRESHOLD and OPENAI_BREAKER_RESET."""
+    breaker.configure(
+        app.config.get('OPENAI_BREAKER_THRESHOLD', 5),
+        app.config.get('OPENAI_BREAKER_RESET', 30.0),
+    )
+
+
+def get_client():
+    """Return a long-lived OpenAI client so connections and TLS sessions are reused."""
+    config = current_app.config
+    key = (config.get('OPENAI_API_KEY'), config.get('OPENAI_BASE_URL'))
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = OpenAI(
+                    api_key=key[0],
+                    base_url=key[1],
+                    timeout=config.get('OPENAI_TIMEOUT', 30.0),
+                    # Retries are handled by call_model so they share the retry budget
+                    max_retries=0,
+                )
+                _clients[key] = client
+    return client
+
+
+def get_async_client():
+    """Return the long-lived AsyncOpenAI client used by the ASGI entry point."""
+    config = current_app.config
+    key = ('async', config.get('OPENAI_API_KEY'), config.get('OPENAI_BASE_URL'))
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = AsyncOpenAI(
+                    api_key=key[1],
+                    base_url=key[2],
+                    timeout=config.get('OPENAI_TIMEOUT', 30.0),
+                    max_retries=0,
+                    http_client=openai.DefaultAsyncHttpxClient(limits=httpx.Limits(
+                        max_connections=config.get('ASYNC_MAX_CONNECTIONS', 200),
+                        max_keepalive_connections=config.get('ASYNC_MAX_KEEPALIVE', 50),
+                    )),
+                )
+                _clients[key] = client
+    return client
+
+
+async def close_async_clients():
+    """Close pooled async clients; called when the ASGI server shuts down."""
+    with _clients_lock:
+        clients = [key for key in _clients if key[0] == 'async']
+        closing = [_clients.pop(key) for key in clients]
+    for client in closing:
+        await client.close()
+
+
+class _Attempts:
+    """Deadline, retry budget and circuit breaker bookkeeping for one model call."""
+
+    def __init__(self, operation, timeout=None, deadline=None):
+        config = current_app.config
+        self.operation = operation
+        self.max_retries = config.get('OPENAI_MAX_RETRIES', 2)
+        self.deadline = time.monotonic() + (deadline or config.get('OPENAI_DEADLINE', 45.0))
+        self.timeout = timeout or config.get('OPENAI_TIMEOUT', 30.0)
+        self.start = time.monotonic()
+        self.attempt = 0
+
+        if not breaker.allow():
+            call_stats.record(operation, 'rejected', 0.0)
+            metrics.observe_model_call(operation, 'rejected', 0.0)
+            raise CircuitOpenError(f"Model calls are paused after repeated failures ({operation}).")
+        retry_budget.record_call()
+
+    def next_timeout(self):
+        return max(1.0, min(self.timeout, self.deadline - time.monotonic()))
+
+    def retry_after(self, error):
+        """Record a transient failure; return the backoff before retrying, or None to give up."""
+        breaker.record_failure()
+        backoff = random.uniform(0, min(8.0, 0.5 * 2 ** self.attempt))
+        if (self.attempt >= self.max_retries
+                or time.monotonic() + backoff >= self.deadline
+                or not breaker.allow()
+                or not retry_budget.try_spend()):
+            self._record('failures')
+            return None
+        self.attempt += 1
+        call_stats.record_retry(self.operation)
+        logger.warning(f"Retrying {self.operation} after {type(error).__name__} (attempt {self.attempt})")
+        return backoff
+
+    def _record(self, outcome, usage=None):
+        elapsed = time.monotonic() - self.start
+        call_stats.record(self.operation, outcome, elapsed)
+        metrics.observe_model_call(self.operation, outcome, elapsed, usage)
+
+    def abandon(self):
+        # Cancelled (e.g. the client disconnected) with no verdict on upstream health
+        breaker.abandon()
+
+    def failed(self):
+        # Non-transient errors (bad request, auth) still mean upstream answered
+        breaker.record_success()
+        self._record('failures')
+
+    def succeeded(self, result=None):
+        breaker.record_success()
+        self._record('successes', getattr(result, 'usage', None))
+
+
+def call_model(operation, request, timeout=None, deadline=None):
+    """Run ``request(client, timeout)`` with a deadline, jittered retries and the circuit breaker.
+
+    ``timeout`` and ``deadline`` override OPENAI_TIMEOUT and OPENAI_DEADLINE for
+    calls expected to run long. Raises CircuitOpenError without calling upstream
+    while the breaker is open, and re-raises the last error once retries or the
+    deadline are exhausted.
+    """
+    attempts = _Attempts(operation, timeout, deadline)
+    client = get_client()
+    while True:
+        try:
+            result = request(client, attempts.next_timeout())
+        except TRANSIENT_ERRORS as e:
+            backoff = attempts.retry_after(e)
+            if backoff is None:
+                raise
+            time.sleep(backoff)
+        except Exception:
+            attempts.failed()
+            raise
+        except BaseException:
+            attempts.abandon()
+            raise
+        else:
+            attempts.succeeded(result)
+            return result
+
+
+async def call_model_async(operation, request, timeout=None, deadline=None):
+    """Async counterpart of call_model; ``request(client, timeout)`` returns an awaitable.
+
+    Shares the circuit breaker, retry budget and statistics with synchronous calls.
+    """
+    attempts = _Attempts(operation, timeout, deadline)
+    client = get_async_client()
+    while True:
+        try:
+            result = await request(client, attempts.next_timeout())
+        except TRANSIENT_ERRORS as e:
+            backoff = attempts.retry_after(e)
+            if backoff is None:
+                raise
+            await asyncio.sleep(backoff)
+        except Exception:
+            attempts.failed()
+            raise
+        except BaseException:
+            attempts.abandon()
+            raise
+        else:
+            attempts.succeeded(result)
+            return result
+
+
+def client_stats():
+    return {
+        'breaker': breaker.state,
+        'operations': call_stats.snapshot(),
+    }
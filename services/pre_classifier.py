@@ -0,0 +1,160 @@
+"""Local, CPU-only classification that runs before the remote vision model.
+
+LOCAL_CLASSIFIER selects the stage:
+
+- ``''`` (default): disabled, every upload goes to the vision model
+- ``'quality'``: reject nearly uniform or very blurry frames
+- ``'onnx'``: the quality gate plus an ONNX image classifier that rejects
+  background frames and answers directly above LOCAL_CLASSIFIER_ANSWER_THRESHOLD
+  for species the vision model has already described in this process
+
+The ONNX stage needs ``onnxruntime`` and ``numpy``, a model taking one NCHW
+float image normalised with ImageNet statistics, and a labels file with one
+class name per line. Classes named in BACKGROUND_LABELS mean "no animal". The
+model is loaded once per process on first use.
+"""
+import logging
+import threading
+from flask import current_app
+from PIL import Image, ImageFilter, ImageOps, ImageStat
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_LABELS = {'background', 'none', 'no_animal', 'empty'}
+ANALYSIS_SIZE = 256  # px, longest side used by the quality gate
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+class RejectedImageError(ValueError):
+    """Raised for uploads the local stage is confident contain no recognisable animal."""
+
+
+class QualityGate:
+    """Reject frames that are nearly uniform (covered lens, black frame) or too blurry to recognise."""
+
+    def __init__(self, min_contrast, min_sharpness):
+        self.min_contrast = min_contrast
+        self.min_sharpness = min_sharpness
+
+    def check(self, image):
+        """Return a rejection reason, or None if the image is usable."""
+        gray = image.convert('L')
+        gray.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+        if ImageStat.Stat(gray).stddev[0] < self.min_contrast:
+            return "The image is blank or too dark. Please capture the animal again."
+        edges = gray.filter(ImageFilter.FIND_EDGES)
+        if ImageStat.Stat(edges).stddev[0] < self.min_sharpness:
+            return "The image is too blurry. Please hold the camera still and try again."
+        return None
+
+    def predict(self, image):
+        return None
+
+
+class OnnxClassifier(QualityGate):
+    """Quality gate followed by an ONNX Runtime image classifier."""
+
+    def __init__(self, min_contrast, min_sharpness, model_path, labels_path, threads=1):
+        super().__init__(min_contrast, min_sharpness)
+        try:
+            import numpy
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError("LOCAL_CLASSIFIER='onnx' requires the onnxruntime and numpy packages.") from e
+        if not model_path or not labels_path:
+            raise RuntimeError("LOCAL_CLASSIFIER_MODEL and LOCAL_CLASSIFIER_LABELS must be set.")
+
+        self._np = numpy
+        options = onnxruntime.SessionOptions()
+        # Every worker process has its own session; keep each one to a few cores
+        options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(
+            model_path, sess_options=options, providers=['CPUExecutionProvider']
+        )
+        model_input = self._session.get_inputs()[0]
+        self._input_name = model_input.name
+        height, width = model_input.shape[2:4]
+        self._size = (width if isinstance(width, int) else 224, height if isinstance(height, int) else 224)
+
+        with open(labels_path, encoding='utf-8') as labels_file:
+            self.labels = [line.strip() for line in labels_file if line.strip()]
+        logger.info(f"Loaded local classifier {model_path} with {len(self.labels)} labels")
+
+    def predict(self, image):
+        """Return ``(label, confidence)`` for the most likely class."""
+        np = self._np
+        pixels = np.asarray(ImageOps.fit(image.convert('RGB'), self._size), dtype=np.float32) / 255.0
+        pixels = (pixels - np.array(IMAGENET_MEAN, dtype=np.float32)) / np.array(IMAGENET_STD, dtype=np.float32)
+        batch = pixels.transpose(2, 0, 1)[np.newaxis]
+
+        scores = self._session.run(None, {self._input_name: batch})[0][0].astype(np.float64)
+        # Accept either logits or probabilities from the model
+        if scores.min() < 0 or abs(scores.sum() - 1.0) > 1e-3:
+            scores = np.exp(scores - scores.max())
+            scores /= scores.sum()
+        best = int(scores.argmax())
+        return self.labels[best], float(scores[best])
+
+
+def get_classifier():
+    """Return the configured local classifier, or None when the stage is disabled."""
+    global _classifier
+    name = current_app.config.get('LOCAL_CLASSIFIER', '')
+    if not name:
+        return None
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                config = current_app.config
+                min_contrast = config.get('IMAGE_MIN_CONTRAST', 8.0)
+                min_sharpness = config.get('IMAGE_MIN_SHARPNESS', 4.0)
+                if name == 'quality':
+                    _classifier = QualityGate(min_contrast, min_sharpness)
+                elif name == 'onnx':
+                    _classifier = OnnxClassifier(
+                        min_contrast, min_sharpness,
+                        config.get('LOCAL_CLASSIFIER_MODEL'),
+                        config.get('LOCAL_CLASSIFIER_LABELS'),
+                        config.get('LOCAL_CLASSIFIER_THREADS', 1),
+                    )
+                else:
+                    raise ValueError(f"Unknown local classifier: {name}")
+    return _classifier
+
+
+def classify(image_path):
+    """Run the local stage on an upload.
+
+    Returns the model's ``(label, confidence)`` for an animal class, or None when
+    the stage is disabled, has no model or saw no animal with confidence. Raises
+    RejectedImageError for images without a recognisable animal.
+    """
+    classifier = get_classifier()
+    if classifier is None:
+        return None
+
+    with Image.open(image_path) as image:
+        image.load()
+    reason = classifier.check(image)
+    if reason:
+        raise RejectedImageError(reason)
+
+    prediction = classifier.predict(image)
+    if prediction is None:
+        return None
+    label, confidence = prediction
+    if label.lower() in BACKGROUND_LABELS:
+        if confidence >= current_app.config.get('LOCAL_CLASSIFIER_REJECT_THRESHOLD', 0.9):
+            raise RejectedImageError("No animal was found in the image. Please try another photo.")
+        return None
+    return label, confidence
+
+
+def is_confident(prediction):
+    """Whether a local prediction is trusted enough to skip the vision model."""
+    return prediction is not None and \
+        prediction[1] >= current_app.config.get('LOCAL_CLASSIFIER_ANSWER_THRESHOLD', 0.9)
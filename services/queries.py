@@ -0,0 +1,63 @@
+"""Hot read queries shared by the routes and scripts/check_query_plans.py.
+
+Each one is backed by an index from migration 2; keep the plan check in step
+when changing them.
+"""
+from datetime import timedelta
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from app import db
+from models import AnimalSpotting, Badge, Task, spotting_badges
+
+
+def open_task_conditions(today):
+    return (
+        Task.expires_at >= today,
+        Task.created_at <= today + timedelta(days=1)
+    )
+
+
+def current_tasks(today):
+    """Tasks that are still open on ``today`` (ix_task_expires_at_created_at)."""
+    return Task.query.filter(*open_task_conditions(today))
+
+
+def current_task_progress(today, region=None, limit=20):
+    """Current tasks with their spotting counts as ``(id, animal, task_type, spottings)`` rows.
+
+    With a region only its tasks are returned, found through
+    ix_task_region_expires_at; without one, the first ``limit`` current tasks of
+    any region. Spottings are counted with one grouped query over
+    ix_animal_spotting_task_id instead of loading every spotting of every task.
+    """
+    conditions = list(open_task_conditions(today))
+    if region is not None:
+        conditions.append(Task.region == region)
+    return db.session.query(
+        Task.id, Task.animal, Task.task_type, func.count(AnimalSpotting.id)
+    ).outerjoin(AnimalSpotting, AnimalSpotting.task_id == Task.id).filter(
+        *conditions
+    ).group_by(Task.id, Task.animal, Task.task_type).order_by(Task.id).limit(limit)
+
+
+def recent_badges(limit=5):
+    """Most recently awarded badges (ix_spotting_badges_awarded_at).
+
+    spotting_badges.spotting_id is a foreign key, so the spotting itself need not be joined.
+    """
+    return Badge.query.join(spotting_badges)\
+        .order_by(spotting_badges.c.awarded_at.desc())\
+        .limit(limit)
+
+
+def spotting_by_share_id(share_id):
+    """The spotting behind a share link (unique share_id), with its badges loaded."""
+    return AnimalSpotting.query.options(selectinload(AnimalSpotting.badges)).filter_by(share_id=share_id)
+
+
+def spottings_between(start, end):
+    """Spottings made in ``[start, end)`` (ix_animal_spotting_spotted_at)."""
+    return AnimalSpotting.query.filter(
+        AnimalSpotting.spotted_at >= start,
+        AnimalSpotting.spotted_at < end
+    )
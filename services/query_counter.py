@@ -0,0 +1,106 @@
+"""Count and time the SQL statements issued per request, or inside a ``counting_queries()`` block.
+
+Tests and scripts can assert on query counts, and ask for the SQL itself when
+they need to see it (counters otherwise keep only the count and time)::
+
+    with counting_queries(keep_statements=True) as counter:
+        client.get('/api/badges')
+    assert counter.count <= 2, counter.statements
+
+Requests are counted only when something reads the result: QUERY_COUNT_WARN
+above 0, METRICS_ENABLED, or debug mode (X-Query-Count).
+
+Active counters are kept in a ContextVar rather than per thread: concurrent
+async requests on one event loop each count their own statements, and work
+handed to ``asyncio.to_thread`` (services.async_support.run_sync) inherits the
+context and counts towards the request that started it.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_counters = ContextVar('query_counters', default=())
+
+
+class QueryCounter:
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        self.duration = 0.0  # seconds
+        self.statements = [] if keep_statements else None
+
+
+def _start(counter):
+    _counters.set(_counters.get() + (counter,))
+
+
+def _stop(counter):
+    _counters.set(tuple(active for active in _counters.get() if active is not counter))
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counters = _counters.get()
+    for counter in counters:
+        counter.count += 1
+        if counter.statements is not None:
+            counter.statements.append(statement)
+    if counters:
+        conn.info['query_started'] = time.perf_counter()
+
+
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    for counter in _counters.get():
+        counter.duration += elapsed
+
+
+@contextmanager
+def counting_queries(keep_statements=False):
+    """Count statements executed in the current context until the block exits.
+
+    With ``keep_statements`` the counter also records the SQL of each statement.
+    """
+    counter = QueryCounter(keep_statements)
+    _start(counter)
+    try:
+        yield counter
+    finally:
+        _stop(counter)
+
+
+def init_app(app, engine):
+    """Count and time the statements of every request and log requests above QUERY_COUNT_WARN."""
+    event.listen(engine, 'before_cursor_execute', _count_statement)
+    event.listen(engine, 'after_cursor_execute', _time_statement)
+
+    threshold = app.config.get('QUERY_COUNT_WARN', 20)
+    if threshold <= 0 and not app.config.get('METRICS_ENABLED') and not app.debug:
+        return
+
+    @app.before_request
+    def start_counting_queries():
+        g.query_counter = QueryCounter()
+        _start(g.query_counter)
+
+    @app.after_request
+    def report_query_count(response):
+        counter = g.get('query_counter')
+        if counter is not None and app.debug:
+            response.headers['X-Query-Count'] = str(counter.count)
+        return response
+
+    @app.teardown_request
+    def stop_counting_queries(exc):
+        counter = g.pop('query_counter', None)
+        if counter is None:
+            return
+        _stop(counter)
+        if 0 < threshold < counter.count:
+            logger.warning(f"{request.path} issued {counter.count} SQL statements (threshold {threshold})")
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from PIL import Image
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import RecognitionCacheEntry
+from services import image_service, metrics
+from services.storage import get_storage
+from services.gpt_service import get_mock_recognition
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# A dHash of 64 bits is indexed as PHASH_BANDS bands of 16; two hashes within
+# PHASH_BANDS - 1 bits of each other agree on at least one whole band.
+PHASH_BANDS = 4
+PHASH_BAND_CHARS = 4
+PHASH_CANDIDATES = 200
+TOUCH_INTERVAL = timedelta(minutes=10)
+
+_pending_hits = Counter()
+_pending_lock = threading.Lock()
+
+
+def save_upload(file):
+    """Stream an upload to scratch space and store a preprocessed copy under its SHA-256 digest.
+
+    Identical uploads share one stored image. Returns ``(filename, content_hash,
+    created)`` where ``created`` is False when the image was already stored.
+    """
+    _, ext, mime_type = image_service.output_format()
+    storage = get_storage()
+
+    token = uuid.uuid4().hex
+    temp_path = os.path.join(storage.scratch_dir, f".upload-{token}")
+    processed_path = os.path.join(storage.scratch_dir, f".processed-{token}{ext}")
+    digest = hashlib.sha256()
+    try:
+        with open(temp_path, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+
+        content_hash = digest.hexdigest()
+        filename = f"{content_hash}{ext}"
+        if storage.exists(filename):
+            return filename, content_hash, False
+
+        with metrics.timed('image_preprocess'):
+            image_service.preprocess_image(temp_path, processed_path)
+        # The image last, so its presence means the thumbnail is stored too
+        storage.put_file(image_service.thumbnail_name(filename),
+                         image_service.thumbnail_name(processed_path), mime_type)
+        storage.put_file(filename, processed_path, mime_type)
+        return filename, content_hash, True
+    finally:
+        for path in (temp_path, processed_path, image_service.thumbnail_name(processed_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def perceptual_hash(image_path, hash_size=8):
+    """Compute a difference hash (dHash) that survives re-encoding and resizing."""
+    with Image.open(image_path) as image:
+        pixels = list(image.convert('L').resize((hash_size + 1, hash_size)).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+
+def phash_bands(phash):
+    """The indexed bands of a perceptual hash, as ``(band, hex)`` pairs."""
+    return [(band, phash[band * PHASH_BAND_CHARS:(band + 1) * PHASH_BAND_CHARS]) for band in range(PHASH_BANDS)]
+
+
+def hamming_distance(a, b):
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def _nearest(phash):
+    """The entry whose perceptual hash is closest to ``phash``, within RECOGNITION_CACHE_PHASH_DISTANCE bits."""
+    max_distance = min(current_app.config.get('RECOGNITION_CACHE_PHASH_DISTANCE', 3), PHASH_BANDS - 1)
+    columns = (RecognitionCacheEntry.id, RecognitionCacheEntry.perceptual_hash,
+               RecognitionCacheEntry.result, RecognitionCacheEntry.last_hit_at)
+    candidates = db.session.query(*columns).filter(or_(*(
+        func.substr(RecognitionCacheEntry.perceptual_hash, band * PHASH_BAND_CHARS + 1, PHASH_BAND_CHARS) == value
+        for band, value in phash_bands(phash)
+    ))).limit(PHASH_CANDIDATES).all()
+
+    best, best_distance = None, max_distance + 1
+    for candidate in candidates:
+        distance = hamming_distance(phash, candidate.perceptual_hash)
+        if distance < best_distance:
+            best, best_distance = candidate, distance
+    return best
+
+
+def _record_hit(entry):
+    """Count a hit, writing it at most once per TOUCH_INTERVAL per entry so reads rarely write."""
+    now = datetime.utcnow()
+    with _pending_lock:
+        _pending_hits[entry.id] += 1
+        if entry.last_hit_at is not None and entry.last_hit_at >= now - TOUCH_INTERVAL:
+            return
+        hits = _pending_hits.pop(entry.id)
+
+    touch_before = now - TOUCH_INTERVAL
+    updated = RecognitionCacheEntry.query.filter(
+        RecognitionCacheEntry.id == entry.id,
+        or_(RecognitionCacheEntry.last_hit_at.is_(None), RecognitionCacheEntry.last_hit_at < touch_before)
+    ).update({
+        'hit_count': func.coalesce(RecognitionCacheEntry.hit_count, 0) + hits,
+        'last_hit_at': now,
+    }, synchronize_session=False)
+    db.session.commit()
+    if not updated:
+        # Another process touched it first; carry the hits to the next touch
+        with _pending_lock:
+            _pending_hits[entry.id] += hits
+
+
+def lookup(content_hash, image_path):
+    """Return ``(result, perceptual_hash)`` for an upload; result is None on a miss.
+
+    With RECOGNITION_CACHE_PHASH, an upload with no exact match reuses the result
+    of the stored image whose perceptual hash differs by the fewest bits, up to
+    RECOGNITION_CACHE_PHASH_DISTANCE.
+    """
+    entry = db.session.query(RecognitionCacheEntry.id, RecognitionCacheEntry.result,
+                             RecognitionCacheEntry.last_hit_at).filter(
+        RecognitionCacheEntry.content_hash == content_hash
+    ).first()
+
+    phash = None
+    if entry is None and current_app.config.get('RECOGNITION_CACHE_PHASH'):
+        try:
+            phash = perceptual_hash(image_path)
+        except Exception as e:
+            logger.warning(f"Could not compute perceptual hash: {str(e)}")
+        else:
+            entry = _nearest(phash)
+
+    if entry is None:
+        return None, phash
+
+    _record_hit(entry)
+    logger.debug(f"Recognition cache hit for {content_hash}")
+    return entry.result, phash
+
+
+def store(content_hash, perceptual_hash_value, image_path, result):
+    """Remember a recognition result for this image content."""
+    if result == get_mock_recognition():
+        return
+
+    entry = RecognitionCacheEntry(
+        content_hash=content_hash,
+        perceptual_hash=perceptual_hash_value,
+        image_path=image_path,
+        result=result,
+    )
+    db.session.add(entry)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
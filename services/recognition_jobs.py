@@ -0,0 +1,148 @@
+"""Background recognition jobs, persisted in ``recognition_job`` and run by a per-process thread pool.
+
+Jobs live only in the pool of the process that accepted them, so a restart or
+deploy strands its queued and running jobs. A job still pending after
+RECOGNITION_JOB_TIMEOUT is treated as stale: ``expire_stale`` (run at startup,
+by scripts/cleanup_uploads.py and whenever a stale job is polled) marks it
+failed and removes its upload.
+"""
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_, update
+from app import db
+from models import RecognitionJob
+from services.pre_classifier import RejectedImageError
+from services.recognition_service import process_upload, remove_upload
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATUSES = ('queued', 'running')
+STALE_ERROR = 'Interrupted before it finished (stale job)'
+
+_executor = None
+_slots = None
+_pool_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """Raised when the recognition queue has no free slots."""
+
+
+def _get_pool():
+    global _executor, _slots
+    if _executor is None:
+        with _pool_lock:
+            if _executor is None:
+                workers = current_app.config.get('RECOGNITION_WORKERS', 4)
+                _slots = threading.BoundedSemaphore(current_app.config.get('RECOGNITION_QUEUE_SIZE', 32))
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='recognition')
+    return _executor, _slots
+
+
+def enqueue(filename, content_hash, task_id=None, location=None, owns_file=True):
+    """Persist a recognition job and hand it to the worker pool."""
+    executor, slots = _get_pool()
+    if not slots.acquire(blocking=False):
+        raise QueueFullError("Too many images are being processed. Please try again shortly.")
+
+    try:
+        job = RecognitionJob(
+            id=uuid.uuid4().hex,
+            status='queued',
+            image_path=filename,
+            content_hash=content_hash,
+            task_id=task_id,
+            location=location,
+            owns_file=owns_file,
+        )
+        db.session.add(job)
+        db.session.commit()
+
+        executor.submit(_run, current_app._get_current_object(), job.id)
+    except Exception:
+        slots.release()
+        raise
+    return job
+
+
+def _run(app, job_id):
+    try:
+        with app.app_context():
+            # Claim the job unless it expired while waiting in the queue
+            claimed = db.session.execute(
+                update(RecognitionJob).where(RecognitionJob.id == job_id, RecognitionJob.status == 'queued')
+                .values(status='running', started_at=datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                logger.warning(f"Recognition job {job_id} expired before it started")
+                return
+            job = db.session.get(RecognitionJob, job_id)
+
+            try:
+                _, spotting, new_badges = process_upload(
+                    job.image_path, job.content_hash, job.task_id, job.location
+                )
+            except Exception as e:
+                logger.error(f"Recognition job {job_id} failed: {str(e)}", exc_info=True)
+                db.session.rollback()
+                if job.owns_file:
+                    remove_upload(job.image_path)
+                job.status = 'failed'
+                job.error = str(e)[:255]
+                if isinstance(e, RejectedImageError):
+                    job.error_message = str(e)[:255]
+            else:
+                job.status = 'done'
+                job.spotting_id = spotting.id
+                job.new_badges = [badge.name for badge in new_badges]
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+    except Exception as e:
+        logger.error(f"Could not update recognition job {job_id}: {str(e)}", exc_info=True)
+    finally:
+        _slots.release()
+
+
+def _cutoff(now):
+    return now - timedelta(seconds=current_app.config.get('RECOGNITION_JOB_TIMEOUT', 300))
+
+
+def stale_condition(now=None):
+    """SQL condition matching pending jobs older than RECOGNITION_JOB_TIMEOUT."""
+    cutoff = _cutoff(now or datetime.utcnow())
+    return or_(
+        and_(RecognitionJob.status == 'queued', RecognitionJob.created_at < cutoff),
+        and_(RecognitionJob.status == 'running', RecognitionJob.started_at < cutoff),
+    )
+
+
+def expire_stale():
+    """Fail stale pending jobs and remove the uploads they own; returns the number expired."""
+    now = datetime.utcnow()
+    expired = db.session.execute(
+        update(RecognitionJob).where(stale_condition(now))
+        .values(status='failed', error=STALE_ERROR, finished_at=now)
+        .returning(RecognitionJob.id, RecognitionJob.image_path, RecognitionJob.owns_file)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    for job_id, image_path, owns_file in expired:
+        logger.warning(f"Recognition job {job_id} was interrupted; marked failed")
+        if owns_file:
+            remove_upload(image_path)
+    return len(expired)
+
+
+def get_job(job_id):
+    job = db.session.get(RecognitionJob, job_id)
+    if job is not None and job.status in PENDING_STATUSES:
+        pending_since = job.created_at if job.status == 'queued' else job.started_at
+        if pending_since is not None and pending_since < _cutoff(datetime.utcnow()):
+            expire_stale()
+            db.session.refresh(job)
+    return job
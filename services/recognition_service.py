@@ -0,0 +1,234 @@
+import asyncio
+import logging
+from app import db
+from models import AnimalSpotting
+from services import metrics, pre_classifier, recognition_cache, rollups
+from services.achievement_service import AchievementService
+from services.cache import LRUCache
+from services.async_support import run_sync
+from services.gpt_service import (
+    get_mock_recognition, recognize_animal, recognize_animal_async, stream_recognize_animal,
+    stream_recognize_animal_async
+)
+from services.image_service import thumbnail_name
+from services.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+DETAIL_FIELDS = ('habitat', 'diet', 'behavior', 'interesting_facts')
+
+# Details of recently recognized species, reused when the local classifier answers
+_species_details = LRUCache(max_entries=512)
+
+
+def normalize_species(name):
+    """Lower-case a species name and collapse underscores and whitespace, for comparing labels."""
+    return ' '.join(name.replace('_', ' ').split()).lower()
+
+
+def pre_classify(filepath):
+    """Run the local classifier before the vision model.
+
+    Returns ``(result, prediction)``; ``result`` is a complete recognition when the
+    local prediction is confident enough to answer and details of the species are
+    known from an earlier model answer, otherwise None. Raises RejectedImageError
+    for images without a recognisable animal.
+    """
+    with metrics.timed('pre_classify'):
+        prediction = pre_classifier.classify(filepath)
+    if not pre_classifier.is_confident(prediction):
+        return None, prediction
+
+    label, confidence = prediction
+    details = _species_details.get(normalize_species(label))
+    if details is None:
+        # Answering now would store a spotting with blank details
+        logger.debug(f"Local classifier answered {label} ({confidence:.2f}) without known details")
+        return None, prediction
+    logger.debug(f"Local classifier answered {label} ({confidence:.2f})")
+    return {'animal': label, 'details': details, 'confidence': confidence}, prediction
+
+
+def with_local_confidence(result, prediction):
+    """Attach the local confidence to a remote result when both name the same animal."""
+    if result != get_mock_recognition():
+        _species_details.set(normalize_species(result['animal']), result['details'])
+    if prediction is not None and normalize_species(prediction[0]) == normalize_species(result['animal']):
+        return dict(result, confidence=prediction[1])
+    return result
+
+
+def process_upload(filename, content_hash, task_id=None, location=None):
+    """Recognize a stored upload, record the spotting and award achievements.
+
+    Returns ``(result, spotting, new_badges)``. Shared by the synchronous endpoint
+    and the background job workers.
+    """
+    filepath = get_storage().local_path(filename)
+
+    # Reuse an earlier recognition of the same image, then try the local classifier,
+    # before calling the model
+    result, phash, prediction = lookup_local(content_hash, filepath)
+    if result is None:
+        result = with_local_confidence(recognize_animal(filepath), prediction)
+        recognition_cache.store(content_hash, phash, filename, result)
+
+    spotting, new_badges = record_spotting(filename, result, task_id, location)
+    return result, spotting, new_badges
+
+
+def record_spotting(filename, result, task_id=None, location=None):
+    """Store the spotting for a recognized upload and award achievements in one transaction."""
+    # Create spotting record and set attributes
+    spotting = AnimalSpotting()
+    spotting.task_id = task_id
+    spotting.image_path = filename
+    spotting.recognition_result = result["animal"]
+    spotting.detailed_info = result["details"]
+    spotting.confidence_score = result.get("confidence")
+    spotting.location = location
+    spotting.generate_share_id()
+
+    db.session.add(spotting)
+    db.session.flush()
+
+    # Check and award achievements in the same transaction as the insert
+    with metrics.timed('achievements'):
+        new_badges = AchievementService.check_achievements(spotting)
+    rollups.record_spotting(spotting)
+    db.session.commit()
+    return spotting, new_badges
+
+
+def record_spotting_summary(filename, result, task_id=None, location=None):
+    """Record the spotting as in record_spotting, returning ``(share_id, badge_names)``."""
+    spotting, new_badges = record_spotting(filename, result, task_id, location)
+    return spotting.share_id, [badge.name for badge in new_badges]
+
+
+def lookup_local(content_hash, filepath):
+    """Answer from the recognition cache or the local classifier without the vision model.
+
+    Returns ``(result, phash, prediction)``; ``result`` is None when the model is needed.
+    """
+    result, phash = recognition_cache.lookup(content_hash, filepath)
+    prediction = None
+    if result is None:
+        result, prediction = pre_classify(filepath)
+    return result, phash, prediction
+
+
+async def process_upload_async(filename, content_hash, task_id=None, location=None):
+    """Async counterpart of process_upload for the ASGI entry point.
+
+    Returns ``(result, share_id, badge_names)``; database and image work runs in
+    worker threads while the vision model call is awaited on the event loop.
+    """
+    # Downloads the object on nodes without a cached copy
+    filepath = await asyncio.to_thread(get_storage().local_path, filename)
+
+    result, phash, prediction = await run_sync(lookup_local, content_hash, filepath)
+    if result is None:
+        result = with_local_confidence(await recognize_animal_async(filepath), prediction)
+        await run_sync(recognition_cache.store, content_hash, phash, filename, result)
+
+    share_id, badge_names = await run_sync(record_spotting_summary, filename, result, task_id, location)
+    return result, share_id, badge_names
+
+
+def finished_fields(snapshot, final):
+    """Return the fields of a partial recognition that the model has finished writing.
+
+    A field is finished once a later field has started; ``interesting_facts``
+    grows one finished fact at a time.
+    """
+    finished = {}
+    details = snapshot.get('details') or {}
+    if snapshot.get('animal') and ('details' in snapshot or final):
+        finished['animal'] = snapshot['animal']
+
+    started = [field for field in DETAIL_FIELDS if field in details]
+    for field in started:
+        if field == 'interesting_facts':
+            facts = details[field] or []
+            finished[field] = list(facts if final else facts[:-1])
+        elif final or field != started[-1]:
+            finished[field] = details[field]
+    return finished
+
+
+def snapshot_events(snapshot, final, sent):
+    """Return the events for fields finished in ``snapshot`` and not yet in ``sent``, updating it."""
+    events = []
+    for field, value in finished_fields(snapshot, final).items():
+        if sent.get(field) == value:
+            continue
+        sent[field] = value
+        events.append(('animal', value) if field == 'animal' else ('detail', (field, value)))
+    return events
+
+
+def stream_upload(filename, content_hash, task_id=None, location=None):
+    """Recognize a stored upload, yielding ``(event, data)`` as the result is generated.
+
+    Yields ``('animal', name)`` once the species is known, ``('detail', (field,
+    value))`` for each finished detail field (``interesting_facts`` again as each
+    fact completes) and finally ``('done', (result, spotting, new_badges))`` after
+    the spotting is recorded as in process_upload.
+    """
+    filepath = get_storage().local_path(filename)
+
+    result, phash = recognition_cache.lookup(content_hash, filepath)
+    remote = False
+    if result is None:
+        result, prediction = pre_classify(filepath)
+        remote = result is None
+    snapshots = stream_recognize_animal(filepath) if remote else [(result, True)]
+
+    sent = {}
+    for snapshot, final in snapshots:
+        yield from snapshot_events(snapshot, final, sent)
+        if final:
+            result = snapshot
+
+    if remote:
+        result = with_local_confidence(result, prediction)
+        recognition_cache.store(content_hash, phash, filename, result)
+    spotting, new_badges = record_spotting(filename, result, task_id, location)
+    yield 'done', (result, spotting, new_badges)
+
+
+async def stream_upload_async(filename, content_hash, task_id=None, location=None):
+    """Async counterpart of stream_upload for the ASGI entry point.
+
+    Yields the same events, ending with ``('done', (result, share_id, badge_names))``.
+    """
+    filepath = await asyncio.to_thread(get_storage().local_path, filename)
+
+    result, phash, prediction = await run_sync(lookup_local, content_hash, filepath)
+    remote = result is None
+    sent = {}
+    if remote:
+        async for snapshot, final in stream_recognize_animal_async(filepath):
+            for event in snapshot_events(snapshot, final, sent):
+                yield event
+            if final:
+                result = snapshot
+        result = with_local_confidence(result, prediction)
+        await run_sync(recognition_cache.store, content_hash, phash, filename, result)
+    else:
+        for event in snapshot_events(result, True, sent):
+            yield event
+
+    share_id, badge_names = await run_sync(record_spotting_summary, filename, result, task_id, location)
+    yield 'done', (result, share_id, badge_names)
+
+
+def remove_upload(filename):
+    """Delete an upload, and its thumbnail, whose recognition failed."""
+    storage = get_storage()
+    for name in (filename, thumbnail_name(filename)):
+        try:
+            storage.delete(name)
+        except Exception:
+            logger.warning(f"Could not remove upload {name}")
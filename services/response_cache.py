@@ -0,0 +1,43 @@
+"""Rendered responses kept in memory and served as conditional responses.
+
+For pages that rarely change, such as share pages (a spotting does not change
+after recognition) and the badge list. Entries expire after their TTL, which
+bounds how long changes made elsewhere (e.g. scripts/backfill_badges.py) take
+to show up. Every response carries a strong ETag over its body, so clients and
+CDNs revalidating a copy get a 304 without the page being rendered.
+"""
+import hashlib
+from flask import current_app, request
+from services.cache import LRUCache
+
+_cache = LRUCache(max_entries=2048)
+
+
+def cached_response(key, render, ttl, max_age, mimetype='text/html'):
+    """Serve the body returned by ``render()``, rendering it at most once per ``ttl`` seconds.
+
+    ``max_age`` is the Cache-Control lifetime given to clients and shared caches.
+    Exceptions from ``render`` (e.g. a 404 abort) propagate and are not cached.
+    """
+    entry = _cache.get(key)
+    if entry is None:
+        body = render()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        entry = (body, hashlib.sha256(body).hexdigest()[:32])
+        _cache.set(key, entry, ttl=ttl)
+
+    body, etag = entry
+    response = current_app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def invalidate(key):
+    _cache.delete(key)
+
+
+def cache_stats():
+    return _cache.stats()
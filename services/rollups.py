@@ -0,0 +1,217 @@
+"""Spotting counts per day, species and location, kept in ``spotting_rollup``.
+
+Each row counts the spottings of one ``(dimension, key, day)``:
+
+- ``'all'`` (key ``''``): every spotting
+- ``'species'``: the recognition result, lower-cased with whitespace collapsed
+- ``'location'``: for ``'lat,lng'`` locations the geocoded place ("city, state,
+  country") when the geocode cache or gazetteer knows it, otherwise a whole-degree
+  area such as "52°N 13°E area" (about 110 km), so the public leaderboard never
+  exposes precise coordinates; other locations are keyed by their lower-cased name
+
+Rows dated TOTAL_DAY hold all-time totals, so leaderboards and summaries read a
+bounded number of rows however many spottings there are.
+
+ROLLUP_MODE 'inline' (default) updates the rows in the transaction that records
+each spotting. 'deferred' leaves them to scripts/rebuild_rollups.py, run
+periodically, which recomputes whole days from AnimalSpotting; the same script
+repairs or backfills past days in either mode, and must be run once after
+migration 5 to count the spottings recorded before it.
+
+On PostgreSQL, inline updates take ROLLUP_LOCK shared and rebuilds take it
+exclusively, each until their transaction ends, so a rebuild neither misses a
+spotting committed during its scan nor races an increment on the rows it
+replaces. Inline recording waits while a rebuild runs.
+"""
+import logging
+from collections import Counter
+from datetime import date, datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, func, insert, literal, select, text
+from app import db
+from models import AnimalSpotting, SpottingRollup
+from services import counters
+from services.badge_rules import parse_location, week_start
+from services.location_service import known_place
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ('all', 'species', 'location')
+TOTAL_DAY = date(1970, 1, 1)
+KEY_LENGTH = 255
+PERIODS = ('day', 'week', 'month', 'all')
+INSERT_BATCH = 5000
+ROLLUP_LOCK = 0x726f6c6c  # pg_advisory_xact_lock key shared by inline updates and rebuilds
+
+
+def species_key(name):
+    return ' '.join((name or '').split()).lower()[:KEY_LENGTH] or None
+
+
+def area_label(lat, lng):
+    """A whole-degree area, e.g. "52°N 13°E area"."""
+    lat, lng = round(lat), round(lng)
+    return f"{abs(lat)}°{'S' if lat < 0 else 'N'} {abs(lng)}°{'W' if lng < 0 else 'E'} area"
+
+
+def location_key(location):
+    point = parse_location(location)
+    if point is not None:
+        try:
+            place = known_place(*point)
+        except ValueError:  # out of range
+            return None
+        names = [(place or {}).get(field) for field in ('city', 'state', 'country')]
+        if any(names):
+            return ', '.join(name for name in names if name).lower()[:KEY_LENGTH]
+        return area_label(*point)
+    return ' '.join((location or '').split()).lower()[:KEY_LENGTH] or None
+
+
+def rollup_keys(recognition_result, location, places=None):
+    """Return the ``(dimension, key)`` pairs a spotting counts towards.
+
+    ``places`` memoizes location keys by location across calls (e.g. a rebuild).
+    """
+    keys = [('all', '')]
+    species = species_key(recognition_result)
+    if species:
+        keys.append(('species', species))
+    if places is None:
+        place = location_key(location)
+    else:
+        if location not in places:
+            places[location] = location_key(location)
+        place = places[location]
+    if place:
+        keys.append(('location', place))
+    return keys
+
+
+def _lock(shared):
+    if db.engine.dialect.name == 'postgresql':
+        function = 'pg_advisory_xact_lock_shared' if shared else 'pg_advisory_xact_lock'
+        db.session.execute(text(f'SELECT {function}(:key)'), {'key': ROLLUP_LOCK})
+
+
+def record_spotting(spotting):
+    """Count a new spotting in the current transaction (ROLLUP_MODE 'inline')."""
+    if current_app.config.get('ROLLUP_MODE', 'inline') != 'inline':
+        return
+    _lock(shared=True)
+    day = (spotting.spotted_at or datetime.utcnow()).date()
+    # Always the same order (dimension, then day before total) so concurrent
+    # transactions lock the rows in the same order
+    for dimension, key in rollup_keys(spotting.recognition_result, spotting.location):
+        for bucket in (day, TOTAL_DAY):
+            counters.increment(SpottingRollup, {'dimension': dimension, 'key': key, 'day': bucket})
+
+
+def period_start(period, today):
+    """First day of ``period`` containing ``today``, or None for all time."""
+    if period == 'day':
+        return today
+    if period == 'week':
+        return week_start(today)
+    if period == 'month':
+        return today.replace(day=1)
+    if period == 'all':
+        return None
+    raise ValueError(f"Unknown period: {period}")
+
+
+def top(dimension, period='all', limit=10, today=None):
+    """Return the ``limit`` keys with the most spottings in ``period`` as ``(key, count)`` pairs."""
+    today = today or datetime.utcnow().date()
+    start = period_start(period, today)
+    if start is None:
+        query = select(SpottingRollup.key, SpottingRollup.value).where(
+            SpottingRollup.dimension == dimension,
+            SpottingRollup.day == TOTAL_DAY
+        ).order_by(SpottingRollup.value.desc(), SpottingRollup.key)
+    else:
+        total = func.sum(SpottingRollup.value)
+        query = select(SpottingRollup.key, total).where(
+            SpottingRollup.dimension == dimension,
+            SpottingRollup.day.between(start, today)
+        ).group_by(SpottingRollup.key).order_by(total.desc(), SpottingRollup.key)
+    return [(key, int(count)) for key, count in db.session.execute(query.limit(limit))]
+
+
+def daily_counts(days, today=None):
+    """Return ``(day, spottings)`` for the last ``days`` days up to ``today``, oldest first."""
+    today = today or datetime.utcnow().date()
+    first = today - timedelta(days=days - 1)
+    rows = dict(db.session.execute(
+        select(SpottingRollup.day, SpottingRollup.value).where(
+            SpottingRollup.dimension == 'all',
+            SpottingRollup.key == '',
+            SpottingRollup.day.between(first, today)
+        )
+    ).all())
+    return [(first + timedelta(days=i), rows.get(first + timedelta(days=i), 0)) for i in range(days)]
+
+
+def summary(today=None):
+    """Return all-time and today's spotting totals and the number of distinct species and locations."""
+    today = today or datetime.utcnow().date()
+    rows = db.session.execute(
+        select(SpottingRollup.dimension, SpottingRollup.day, func.count(), func.sum(SpottingRollup.value)).where(
+            SpottingRollup.day.in_((TOTAL_DAY, today))
+        ).group_by(SpottingRollup.dimension, SpottingRollup.day)
+    ).all()
+    totals = {(dimension, day): (keys, int(value or 0)) for dimension, day, keys, value in rows}
+    return {
+        'spottings': totals.get(('all', TOTAL_DAY), (0, 0))[1],
+        'spottings_today': totals.get(('all', today), (0, 0))[1],
+        'species': totals.get(('species', TOTAL_DAY), (0, 0))[0],
+        'locations': totals.get(('location', TOTAL_DAY), (0, 0))[0],
+    }
+
+
+def rebuild(start=None, end=None):
+    """Recompute the rows of days in ``[start, end)`` from AnimalSpotting, then the totals.
+
+    Without bounds every row is rebuilt. Spottings are streamed and counted with
+    the same key functions as ``record_spotting``. ROLLUP_LOCK is held from
+    before the scan until the caller commits, which it should do promptly.
+    Returns the number of spottings counted.
+    """
+    _lock(shared=False)
+    query = select(AnimalSpotting.spotted_at, AnimalSpotting.recognition_result, AnimalSpotting.location).where(
+        AnimalSpotting.spotted_at.isnot(None)
+    )
+    days = SpottingRollup.day != TOTAL_DAY
+    if start is not None:
+        query = query.where(AnimalSpotting.spotted_at >= datetime.combine(start, datetime.min.time()))
+        days = days & (SpottingRollup.day >= start)
+    if end is not None:
+        query = query.where(AnimalSpotting.spotted_at < datetime.combine(end, datetime.min.time()))
+        days = days & (SpottingRollup.day < end)
+
+    counts = Counter()
+    places = {}
+    spottings = 0
+    for spotted_at, recognition_result, location in db.session.execute(query.execution_options(yield_per=10000)):
+        spottings += 1
+        day = spotted_at.date()
+        for dimension, key in rollup_keys(recognition_result, location, places):
+            counts[(dimension, key, day)] += 1
+
+    db.session.execute(delete(SpottingRollup).where(days))
+    rows = [{'dimension': dimension, 'key': key, 'day': day, 'value': value}
+            for (dimension, key, day), value in counts.items()]
+    for offset in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(insert(SpottingRollup), rows[offset:offset + INSERT_BATCH])
+
+    # Totals are the sums of the daily rows, which are small next to the spottings
+    db.session.execute(delete(SpottingRollup).where(SpottingRollup.day == TOTAL_DAY))
+    db.session.execute(insert(SpottingRollup).from_select(
+        ['dimension', 'key', 'day', 'value'],
+        select(
+            SpottingRollup.dimension, SpottingRollup.key, literal(TOTAL_DAY, SpottingRollup.day.type),
+            func.sum(SpottingRollup.value)
+        ).where(SpottingRollup.day != TOTAL_DAY).group_by(SpottingRollup.dimension, SpottingRollup.key)
+    ))
+    logger.info(f"Rebuilt spotting rollups from {spottings} spottings ({len(rows)} daily rows)")
+    return spottings
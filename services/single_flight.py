@@ -0,0 +1,176 @@
+"""Share one in-flight upstream call between concurrent callers asking for the same key.
+
+The first caller for a key (the leader) runs the call; callers arriving while it
+is in flight wait for its result instead of repeating it. SINGLE_FLIGHT_BACKEND
+selects the scope:
+
+- ``'local'`` (default): threads of this process
+- ``'db'``: additionally serialise leaders of different processes on a
+  PostgreSQL advisory lock, after which ``recheck`` picks up the result the
+  previous holder stored
+
+A session-level advisory lock pins a connection for the whole upstream call,
+so lock connections come from their own pool of SINGLE_FLIGHT_LOCK_POOL
+connections, separate from db.engine's. Each process may therefore open that
+many connections on top of the app pool (SQLAlchemy's default 5 + 10
+overflow); size the server's max_connections for both. When every lock
+connection is busy, leaders call upstream without the process lock (falling
+back to per-process coalescing) rather than waiting for one.
+
+``do_async`` coalesces coroutines on the ASGI event loop of this process.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from app import db
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+_async_flights = {}  # key -> asyncio.Future, used on the ASGI event loop only
+_lock_engine = None
+_lock_engine_lock = threading.Lock()
+LOCK_POOL_TIMEOUT = 1  # seconds to wait for a free lock connection
+
+
+def lock_key(key):
+    """Map a flight key to a signed 64-bit PostgreSQL advisory lock key."""
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def _get_lock_engine():
+    global _lock_engine
+    if _lock_engine is None:
+        with _lock_engine_lock:
+            if _lock_engine is None:
+                _lock_engine = create_engine(
+                    db.engine.url,
+                    pool_size=current_app.config.get('SINGLE_FLIGHT_LOCK_POOL', 5),
+                    max_overflow=0,
+                    pool_timeout=LOCK_POOL_TIMEOUT,
+                    pool_recycle=300,
+                    pool_pre_ping=True,
+                )
+    return _lock_engine
+
+
+@contextmanager
+def _process_lock(key, wait):
+    """Hold the advisory lock for ``key``; yields False if it was not granted within ``wait`` seconds."""
+    try:
+        connection = _get_lock_engine().connect()
+    except PoolTimeoutError:
+        logger.warning(f"No free single-flight lock connection for {key}; calling upstream without it")
+        yield False
+        return
+
+    with connection:
+        connection.execute(text(f"SET LOCAL lock_timeout = '{int(wait * 1000)}ms'"))
+        try:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': lock_key(key)})
+        except OperationalError:
+            connection.rollback()
+            logger.warning(f"Timed out waiting for the {key} lock held by another process")
+            yield False
+            return
+        # End the transaction so the connection is not idle in one while the
+        # call runs; the session-level lock is kept until unlocked
+        connection.commit()
+        try:
+            yield True
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': lock_key(key)})
+            connection.commit()
+
+
+def _lead(key, func, wait, recheck):
+    if current_app.config.get('SINGLE_FLIGHT_BACKEND', 'local') != 'db' \
+            or db.engine.dialect.name != 'postgresql':
+        return func()
+
+    with _process_lock(key, wait):
+        if recheck is not None:
+            result = recheck()
+            if result is not None:
+                return result
+        return func()
+
+
+def do(key, func, wait, recheck=None):
+    """Return ``func()``, sharing one call between concurrent callers for ``key``.
+
+    Followers wait up to ``wait`` seconds for the leader, then call ``func``
+    themselves; the leader's exception is raised in every follower. ``recheck``
+    returns a result stored by another process, or None, and is only consulted
+    by the 'db' backend once the process lock is held.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if not flight.done.wait(wait):
+            logger.warning(f"Timed out waiting for in-flight {key}; calling upstream")
+            return func()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = _lead(key, func, wait, recheck)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+async def do_async(key, func, wait):
+    """Async counterpart of do: ``func`` is a coroutine function, awaited once per key."""
+    future = _async_flights.get(key)
+    if future is not None:
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), wait)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out waiting for in-flight {key}; calling upstream")
+        except asyncio.CancelledError:
+            # The leader was cancelled, not this caller
+            if not future.cancelled():
+                raise
+        return await func()
+
+    future = _async_flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        result = await func()
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception retrieved when nobody else was waiting
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        if not future.done():
+            future.cancel()
+        _async_flights.pop(key, None)
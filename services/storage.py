@@ -0,0 +1,208 @@
+"""Object storage for uploaded images.
+
+STORAGE_BACKEND selects where uploads live:
+
+- ``'local'`` (default): files under UPLOAD_FOLDER, served by ``/uploads/<key>``
+  or, with STORAGE_PUBLIC_URL set, by a web server or CDN in front of that folder
+- ``'s3'``: an S3-compatible bucket (AWS, MinIO, ...) through ``boto3``, served
+  from STORAGE_PUBLIC_URL or presigned URLs. Objects written or read by this node
+  are kept in STORAGE_CACHE_FOLDER, so recognising an upload on the node that
+  received it never downloads it again
+
+Keys are content-addressed (see ``recognition_cache.save_upload``), so an object
+never changes once written and can be cached by clients for a year.
+"""
+import logging
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from flask import current_app, url_for
+
+logger = logging.getLogger(__name__)
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CACHE_MAX_AGE = 31536000  # seconds
+PRESIGNED_URL_TTL = 7 * 24 * 60 * 60  # seconds, the longest S3 allows
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def _move(source, dest):
+    """Atomically move a file into place, copying first across filesystems."""
+    try:
+        os.replace(source, dest)
+    except OSError:
+        partial = f"{dest}.{uuid.uuid4().hex}.partial"
+        shutil.copyfile(source, partial)
+        os.replace(partial, dest)
+        os.remove(source)
+
+
+def _is_object_name(name):
+    # Skip in-progress uploads and partial writes
+    return not name.startswith('.') and not name.endswith('.partial')
+
+
+class LocalStorage:
+    """Uploads stored in a directory of this node."""
+
+    def __init__(self, root, public_url=None):
+        self.root = root
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.scratch_dir = root  # same filesystem, so put_file is a rename
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def put_file(self, key, path, content_type):
+        """Store the file at ``path`` under ``key``, consuming the file."""
+        _move(path, self._path(key))
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def local_path(self, key):
+        """Return a path on this node to read the object from."""
+        return self._path(key)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key):
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        return url_for('upload_file', key=key)
+
+    def list_objects(self):
+        """Yield ``(key, modified_at)`` for every stored object."""
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and _is_object_name(entry.name):
+                    yield entry.name, datetime.utcfromtimestamp(entry.stat().st_mtime)
+
+    def prune_cache(self, before):
+        return 0
+
+
+class S3Storage:
+    """Uploads stored in an S3-compatible bucket, with a local read-through cache."""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, public_url=None, cache_dir=None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND='s3' requires the boto3 package.") from e
+        if not bucket:
+            raise RuntimeError("STORAGE_S3_BUCKET must be set.")
+
+        self._client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self._client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.scratch_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, key):
+        return os.path.join(self.scratch_dir, key)
+
+    def put_file(self, key, path, content_type):
+        """Upload the file at ``path`` under ``key`` and keep it in the local cache."""
+        # upload_file streams from disk, switching to multipart uploads for large files
+        self._client.upload_file(path, self.bucket, self.prefix + key, ExtraArgs={
+            'ContentType': content_type,
+            'CacheControl': CACHE_CONTROL,
+        })
+        _move(path, self._cache_path(key))
+
+    def exists(self, key):
+        if os.path.exists(self._cache_path(key)):
+            return True
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self._client_error as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def local_path(self, key):
+        """Return a cached copy of the object, downloading it on first use."""
+        path = self._cache_path(key)
+        if not os.path.exists(path):
+            partial = f"{path}.{uuid.uuid4().hex}.partial"
+            try:
+                self._client.download_file(self.bucket, self.prefix + key, partial)
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+        return path
+
+    def delete(self, key):
+        self._client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+        try:
+            os.remove(self._cache_path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key):
+        if self.public_url:
+            return f"{self.public_url}/{self.prefix}{key}"
+        return self._client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.prefix + key}, ExpiresIn=PRESIGNED_URL_TTL
+        )
+
+    def list_objects(self):
+        """Yield ``(key, modified_at)`` for every stored object."""
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                key = item['Key'][len(self.prefix):]
+                if _is_object_name(key):
+                    yield key, item['LastModified'].replace(tzinfo=None)
+
+    def prune_cache(self, before):
+        """Delete cached copies last used before ``before``; returns how many."""
+        pruned = 0
+        with os.scandir(self.scratch_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and datetime.utcfromtimestamp(entry.stat().st_atime) < before:
+                    try:
+                        os.remove(entry.path)
+                        pruned += 1
+                    except FileNotFoundError:
+                        pass
+        return pruned
+
+
+def get_storage():
+    """Return the configured upload storage, creating it on first use."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                config = current_app.config
+                name = config.get('STORAGE_BACKEND', 'local')
+                if name == 'local':
+                    _storage = LocalStorage(config['UPLOAD_FOLDER'], config.get('STORAGE_PUBLIC_URL'))
+                elif name == 's3':
+                    _storage = S3Storage(
+                        config.get('STORAGE_S3_BUCKET'),
+                        prefix=config.get('STORAGE_S3_PREFIX', ''),
+                        endpoint_url=config.get('STORAGE_S3_ENDPOINT_URL'),
+                        region=config.get('STORAGE_S3_REGION'),
+                        public_url=config.get('STORAGE_PUBLIC_URL'),
+                        cache_dir=config.get('STORAGE_CACHE_FOLDER'),
+                    )
+                else:
+                    raise ValueError(f"Unknown storage backend: {name}")
+    return _storage
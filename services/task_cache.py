@@ -0,0 +1,232 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import TaskCacheEntry
+from services import task_sets
+from services.async_support import run_sync
+from services.cache import LRUCache
+from services.gpt_service import generate_tasks, generate_tasks_async, get_mock_tasks
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def location_key(lat, lng, location_info, precision=2):
+    """Build a normalized cache key for a task request.
+
+    Requests that resolve to a named place share the city/state/country tuple so
+    every user in the same city hits the same entry. Places without a city (parks,
+    open water, rural areas) fall back to a coordinate bucket of the given precision.
+    """
+    parts = [
+        (location_info.get(field) or '').strip().lower()
+        for field in ('city', 'state', 'country', 'natural')
+    ]
+    if parts[0]:
+        return 'loc:' + '|'.join(parts)
+
+    bucket = f"{round(float(lat), precision):.{precision}f},{round(float(lng), precision):.{precision}f}"
+    return f"geo:{bucket}|" + '|'.join(parts[1:])
+
+
+def window_ttl(ttl):
+    """Clamp a TTL so entries never outlive the current daily task window."""
+    now = datetime.utcnow()
+    next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return max(1, min(ttl, int((next_midnight - now).total_seconds())))
+
+
+class MemoryTaskCache:
+    """Per-process task cache backed by an LRU dictionary."""
+
+    def __init__(self, max_entries):
+        self._cache = LRUCache(max_entries=max_entries)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, tasks, ttl):
+        self._cache.set(key, tasks, ttl=ttl)
+
+    def stats(self):
+        return dict(self._cache.stats(), backend='memory')
+
+
+class SQLTaskCache:
+    """Task cache shared between processes through the task_cache_entry table.
+
+    Hits refresh ``accessed_at`` at most once per TOUCH_INTERVAL, so reads do not
+    write. Expired and least recently used entries are evicted every
+    EVICT_EVERY stores per process, so the table may briefly exceed
+    ``max_entries`` by that many entries per worker.
+    """
+
+    TOUCH_INTERVAL = timedelta(minutes=10)
+    EVICT_EVERY = 50
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._stores = 0
+
+    def get(self, key):
+        now = datetime.utcnow()
+        entry = db.session.query(TaskCacheEntry.id, TaskCacheEntry.tasks, TaskCacheEntry.accessed_at).filter(
+            TaskCacheEntry.cache_key == key,
+            TaskCacheEntry.expires_at > now
+        ).first()
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # LRU order only needs to be coarse; skip the write for recently touched entries
+        touch_before = now - self.TOUCH_INTERVAL
+        if entry.accessed_at is None or entry.accessed_at < touch_before:
+            TaskCacheEntry.query.filter(
+                TaskCacheEntry.id == entry.id,
+                or_(TaskCacheEntry.accessed_at.is_(None), TaskCacheEntry.accessed_at < touch_before)
+            ).update({'accessed_at': now}, synchronize_session=False)
+            db.session.commit()
+        self.hits += 1
+        return entry.tasks
+
+    def set(self, key, tasks, ttl):
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=ttl)
+        entry = TaskCacheEntry.query.filter_by(cache_key=key).first()
+        if entry is None:
+            entry = TaskCacheEntry(cache_key=key)
+            db.session.add(entry)
+        entry.tasks = tasks
+        entry.accessed_at = now
+        entry.expires_at = expires_at
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker stored the same key first; its value is just as good.
+            db.session.rollback()
+            return
+
+        self._stores += 1
+        if self._stores % self.EVICT_EVERY == 0:
+            self._evict(now)
+
+    def _evict(self, now):
+        TaskCacheEntry.query.filter(TaskCacheEntry.expires_at <= now).delete(synchronize_session=False)
+
+        overflow = TaskCacheEntry.query.count() - self.max_entries
+        if overflow > 0:
+            stale_ids = [row.id for row in TaskCacheEntry.query
+                         .with_entities(TaskCacheEntry.id)
+                         .order_by(TaskCacheEntry.accessed_at.asc())
+                         .limit(overflow)]
+            TaskCacheEntry.query.filter(TaskCacheEntry.id.in_(stale_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': TaskCacheEntry.query.count(),
+            'max_entries': self.max_entries,
+            'backend': 'sql',
+        }
+
+
+BACKENDS = {
+    'memory': MemoryTaskCache,
+    'sql': SQLTaskCache,
+}
+
+
+def get_backend():
+    """Return the configured task cache backend, creating it on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = current_app.config.get('TASK_CACHE_BACKEND', 'memory')
+                if name not in BACKENDS:
+                    raise ValueError(f"Unknown task cache backend: {name}")
+                _backend = BACKENDS[name](current_app.config.get('TASK_CACHE_MAX_ENTRIES', 1024))
+    return _backend
+
+
+def _cache_lookup(backend, key):
+    try:
+        return backend.get(key)
+    except Exception as e:
+        logger.error(f"Task cache lookup failed: {str(e)}", exc_info=True)
+        db.session.rollback()
+        return None
+
+
+def _cache_store(backend, key, tasks):
+    # Fallback tasks are returned on upstream errors; caching them would pin the
+    # whole location to mock data until the entry expires.
+    if tasks == get_mock_tasks():
+        return
+    try:
+        backend.set(key, tasks, window_ttl(current_app.config.get('TASK_CACHE_TTL', 86400)))
+    except Exception as e:
+        logger.error(f"Task cache store failed: {str(e)}", exc_info=True)
+        db.session.rollback()
+
+
+def region_key(lat, lng, location_info: dict) -> str:
+    """The task region (and cache key) a location's tasks are served from."""
+    return location_key(lat, lng, location_info, current_app.config.get('TASK_CACHE_PRECISION', 2))
+
+
+def get_or_generate_tasks(lat, lng, location_info: dict) -> dict:
+    """Serve tasks for a location from the cache, falling back to the region's task set."""
+    key = region_key(lat, lng, location_info)
+    backend = get_backend()
+
+    tasks = _cache_lookup(backend, key)
+    if tasks is not None:
+        logger.debug(f"Task cache hit for {key}")
+        return tasks
+
+    # Serve the region's materialized set; cold regions are generated on demand
+    try:
+        tasks = task_sets.get_task_set(key, location_info)
+    except Exception as e:
+        logger.error(f"Task set lookup failed: {str(e)}", exc_info=True)
+        db.session.rollback()
+        tasks = generate_tasks(location_info)
+
+    _cache_store(backend, key, tasks)
+    return tasks
+
+
+async def get_or_generate_tasks_async(lat, lng, location_info: dict) -> dict:
+    """Async counterpart of get_or_generate_tasks for the ASGI entry point."""
+    key = region_key(lat, lng, location_info)
+    backend = get_backend()
+
+    tasks = await run_sync(_cache_lookup, backend, key)
+    if tasks is not None:
+        logger.debug(f"Task cache hit for {key}")
+        return tasks
+
+    try:
+        tasks = await task_sets.get_task_set_async(key, location_info)
+    except Exception as e:
+        logger.error(f"Task set lookup failed: {str(e)}", exc_info=True)
+        tasks = await generate_tasks_async(location_info)
+
+    await run_sync(_cache_store, backend, key, tasks)
+    return tasks
+
+
+def cache_stats() -> dict:
+    return get_backend().stats()
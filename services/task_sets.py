@@ -0,0 +1,191 @@
+"""Task sets materialized as Task rows per region.
+
+A region is the task cache key of a location (see ``task_cache.location_key``).
+Daily tasks expire at the next UTC midnight and weekly tasks at the start of
+the next (Monday-based) week. ``scheduler.py`` regenerates sets for regions
+requested recently at each rollover; requests for a region without a current
+set generate one on demand and materialize it for everyone else.
+"""
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Task, TaskRegion
+from services import single_flight
+from services.async_support import run_sync
+from services.gpt_service import generate_tasks, generate_tasks_async, generate_tasks_batch, get_mock_tasks
+
+logger = logging.getLogger(__name__)
+
+TASK_TYPES = ('daily', 'weekly')
+TOUCH_INTERVAL = timedelta(hours=1)  # granularity of TaskRegion.last_requested_at
+STORE_GRACE = 10  # seconds allowed for materializing a generated set
+
+
+def expiry_times(now):
+    """Return ``{task_type: expires_at}`` for sets generated at ``now``."""
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    next_week = tomorrow + timedelta(days=(7 - tomorrow.weekday()) % 7)
+    return {'daily': tomorrow, 'weekly': next_week}
+
+
+def load_task_set(region, now=None):
+    """Return the region's current tasks as ``{'daily': [...], 'weekly': [...]}``.
+
+    A task type with no current set maps to an empty list.
+    """
+    now = now or datetime.utcnow()
+    tasks = {task_type: [] for task_type in TASK_TYPES}
+    rows = db.session.query(Task.task_type, Task.animal).filter(
+        Task.region == region,
+        Task.expires_at > now
+    ).order_by(Task.id)
+    for task_type, animal in rows:
+        tasks.setdefault(task_type, []).append(animal)
+    return tasks
+
+
+def is_complete(tasks):
+    return all(tasks.get(task_type) for task_type in TASK_TYPES)
+
+
+def touch_region(region, location_info, now=None):
+    """Record that a region was requested, creating it on first use."""
+    now = now or datetime.utcnow()
+    entry = db.session.get(TaskRegion, region)
+    if entry is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(TaskRegion(key=region, location_info=location_info,
+                                          created_at=now, last_requested_at=now))
+        except IntegrityError:
+            # Another worker registered the region first
+            pass
+    elif entry.last_requested_at is None or now - entry.last_requested_at >= TOUCH_INTERVAL:
+        entry.last_requested_at = now
+        entry.location_info = location_info
+    db.session.commit()
+
+
+def materialize(region, generated, now=None):
+    """Persist the parts of ``generated`` the region has no current set for.
+
+    The region row is locked while checking and inserting, so concurrent callers
+    do not store two sets for the same window. Returns the region's current tasks.
+    """
+    now = now or datetime.utcnow()
+    db.session.query(TaskRegion).filter(TaskRegion.key == region).with_for_update().first()
+    tasks = load_task_set(region, now)
+    expires = expiry_times(now)
+    for task_type in TASK_TYPES:
+        if tasks[task_type] or not generated.get(task_type):
+            continue
+        for animal in generated[task_type]:
+            db.session.add(Task(animal=animal, task_type=task_type, region=region,
+                                created_at=now, expires_at=expires[task_type]))
+        tasks[task_type] = list(generated[task_type])
+    db.session.commit()
+    return tasks
+
+
+def complete_task_set(region):
+    """Return the region's current tasks if both sets exist, otherwise None."""
+    tasks = load_task_set(region)
+    return tasks if is_complete(tasks) else None
+
+
+def current_task_set(region, location_info):
+    """Record the request and return the region's complete current set, or None."""
+    touch_region(region, location_info)
+    return complete_task_set(region)
+
+
+def store_generated(region, generated):
+    """Materialize tasks generated on demand and return what should be served."""
+    # Fallback tasks are served but never materialized
+    if generated == get_mock_tasks():
+        return generated
+    try:
+        return materialize(region, generated)
+    except Exception as e:
+        logger.error(f"Failed to store tasks for {region}: {str(e)}", exc_info=True)
+        db.session.rollback()
+        return generated
+
+
+def generation_wait():
+    """Seconds callers wait for an in-flight generation of the same region."""
+    return current_app.config.get('OPENAI_DEADLINE', 45) + STORE_GRACE
+
+
+def get_task_set(region, location_info):
+    """Serve the region's materialized set, generating the missing parts on demand."""
+    tasks = current_task_set(region, location_info)
+    if tasks is not None:
+        return tasks
+
+    # Concurrent misses for the region share one generation; with the 'db'
+    # single-flight backend, later processes pick up the set it materialized
+    logger.info(f"No current task set for {region}; generating on demand")
+    return single_flight.do(
+        f"tasks:{region}",
+        lambda: store_generated(region, generate_tasks(location_info)),
+        generation_wait(),
+        recheck=lambda: complete_task_set(region),
+    )
+
+
+async def get_task_set_async(region, location_info):
+    """Async counterpart of get_task_set; database work runs in worker threads."""
+    tasks = await run_sync(current_task_set, region, location_info)
+    if tasks is not None:
+        return tasks
+
+    async def generate():
+        logger.info(f"No current task set for {region}; generating on demand")
+        generated = await generate_tasks_async(location_info)
+        return await run_sync(store_generated, region, generated)
+
+    return await single_flight.do_async(f"tasks:{region}", generate, generation_wait())
+
+
+def refresh_active_regions(now=None):
+    """Generate and store sets for recently requested regions that lack a current one.
+
+    Regions are generated in batches, several per model call. Returns
+    ``(refreshed, failed)`` region counts.
+    """
+    now = now or datetime.utcnow()
+    active_since = now - timedelta(days=current_app.config.get('TASK_REGION_ACTIVE_DAYS', 7))
+    regions = db.session.query(TaskRegion.key, TaskRegion.location_info).filter(
+        TaskRegion.last_requested_at >= active_since
+    ).order_by(TaskRegion.key).all()
+
+    current = {}
+    for region, task_type in db.session.query(Task.region, Task.task_type).filter(
+        Task.region.isnot(None),
+        Task.expires_at > now
+    ).distinct():
+        current.setdefault(region, set()).add(task_type)
+    stale = {region: location_info for region, location_info in regions
+             if current.get(region, set()) != set(TASK_TYPES)}
+    generated = generate_tasks_batch(stale)
+
+    refreshed = failed = 0
+    for region, location_info in stale.items():
+        tasks = generated.get(region)
+        if tasks is None:
+            # Left out of its batch or the batch failed; retry on its own
+            tasks = generate_tasks(location_info)
+            if tasks == get_mock_tasks():
+                failed += 1
+                continue
+        try:
+            materialize(region, tasks, now)
+            refreshed += 1
+        except Exception as e:
+            logger.error(f"Failed to store tasks for {region}: {str(e)}", exc_info=True)
+            db.session.rollback()
+            failed += 1
+    return refreshed, failed
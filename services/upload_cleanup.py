@@ -0,0 +1,59 @@
+"""Remove stored uploads that no spotting or live pending recognition refers to.
+
+Uploads are normally deleted when their recognition fails, but a worker that
+dies mid-request leaves its upload behind, and a restart strands the jobs in
+its pool. Stale jobs are expired first and, like failed ones, do not keep their
+upload. Objects younger than the grace period are skipped, as their
+recognition may still be running.
+"""
+import logging
+from datetime import datetime, timedelta
+from app import db
+from models import AnimalSpotting, RecognitionJob
+from services import recognition_jobs
+from services.image_service import original_name, thumbnail_name
+from services.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+def referenced(names):
+    """Return the subset of upload ``names`` a spotting or a pending, not yet stale, job still uses."""
+    names = list(names)
+    spotted = db.session.query(AnimalSpotting.image_path).filter(AnimalSpotting.image_path.in_(names))
+    pending = db.session.query(RecognitionJob.image_path).filter(
+        RecognitionJob.image_path.in_(names),
+        RecognitionJob.status.in_(recognition_jobs.PENDING_STATUSES),
+        ~recognition_jobs.stale_condition()
+    )
+    return {name for (name,) in spotted.union(pending)}
+
+
+def remove_orphans(min_age, dry_run=False, batch_size=500):
+    """Delete uploads (and thumbnails) older than ``min_age`` seconds that nothing refers to.
+
+    Returns the number of uploads removed, or that would be with ``dry_run``.
+    """
+    if not dry_run:
+        recognition_jobs.expire_stale()
+    storage = get_storage()
+    cutoff = datetime.utcnow() - timedelta(seconds=min_age)
+    candidates = sorted({original_name(key) for key, modified_at in storage.list_objects() if modified_at < cutoff})
+
+    removed = 0
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        in_use = referenced(batch)
+        for name in batch:
+            if name in in_use:
+                continue
+            removed += 1
+            if dry_run:
+                logger.info(f"Would remove orphaned upload {name}")
+                continue
+            for key in (name, thumbnail_name(name)):
+                storage.delete(key)
+            logger.info(f"Removed orphaned upload {name}")
+
+    if not dry_run:
+        storage.prune_cache(cutoff)
+    return removed
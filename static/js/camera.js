@@ -142,52 +142,180 @@ const initCamera = () => {
         }
     }
 
+    function parseResponse(response) {
+        const contentType = response.headers.get('content-type');
+        if (!response.ok) {
+            return (contentType && contentType.includes('application/json')
+                ? response.json()
+                : Promise.resolve({ error: `HTTP error! status: ${response.status}` })
+            ).then(errorData => {
+                const error = new Error(errorData.error || `Server error (${response.status})`);
+                // 400 responses explain what was wrong with the image
+                error.userFacing = response.status === 400 && Boolean(errorData.error);
+                throw error;
+            });
+        }
+        return response.json();
+    }
+
+    function pollRecognitionJob(statusUrl, attempt = 0) {
+        const delay = Math.min(500 * Math.pow(1.5, attempt), 3000);
+        return new Promise(resolve => setTimeout(resolve, delay))
+            .then(() => fetch(statusUrl))
+            .then(parseResponse)
+            .then(data => {
+                if (data.status === 'queued' || data.status === 'running') {
+                    if (attempt >= 60) {
+                        throw new Error('Recognition is taking too long. Please try again later.');
+                    }
+                    return pollRecognitionJob(statusUrl, attempt + 1);
+                }
+                if (data.status === 'failed') {
+                    const error = new Error(data.error || 'Recognition failed');
+                    // Rejected images carry a reason the user can act on
+                    error.userFacing = Boolean(data.rejected && data.error);
+                    throw error;
+                }
+                return data;
+            });
+    }
+
+    function showRecognitionResult(data) {
+        recognitionResult.innerHTML = `
+            <div class="alert alert-success">
+                <h4 class="alert-heading">
+                    <i class="fas fa-check-circle me-2"></i>${data.result}
+                </h4>
+                <hr>
+                <div class="animal-details">
+                    <p><strong>Habitat:</strong> ${data.details.habitat}</p>
+                    <p><strong>Diet:</strong> ${data.details.diet}</p>
+                    <p><strong>Behavior:</strong> ${data.details.behavior}</p>
+                    <h5 class="mt-3">Interesting Facts:</h5>
+                    <ul class="list-unstyled">
+                        ${(data.details.interesting_facts || []).map(fact => 
+                            `<li><i class="fas fa-circle-info me-2"></i>${fact}</li>`
+                        ).join('')}
+                    </ul>
+                </div>
+            </div>
+        `;
+
+        if (data.new_badges && data.new_badges.length > 0) {
+            showNotification(`Congratulations! You earned ${data.new_badges.length} new badge(s): ${data.new_badges.join(', ')}`);
+        }
+    }
+
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }
+
+    function showPartialResult(partial) {
+        const pending = '<span class="spinner-border spinner-border-sm text-secondary" role="status"></span>';
+        const detail = field => partial.details[field] !== undefined ? escapeHtml(partial.details[field]) : pending;
+        const facts = partial.details.interesting_facts || [];
+        recognitionResult.innerHTML = `
+            <div class="alert alert-success">
+                <h4 class="alert-heading">
+                    <i class="fas fa-check-circle me-2"></i>${escapeHtml(partial.animal)}
+                </h4>
+                <hr>
+                <div class="animal-details">
+                    <p><strong>Habitat:</strong> ${detail('habitat')}</p>
+                    <p><strong>Diet:</strong> ${detail('diet')}</p>
+                    <p><strong>Behavior:</strong> ${detail('behavior')}</p>
+                    <h5 class="mt-3">Interesting Facts:</h5>
+                    <ul class="list-unstyled">
+                        ${facts.map(fact =>
+                            `<li><i class="fas fa-circle-info me-2"></i>${escapeHtml(fact)}</li>`
+                        ).join('')}
+                    </ul>
+                </div>
+            </div>
+        `;
+    }
+
+    // Read server-sent events from a POST response, rendering the result as it arrives
+    async function readRecognitionStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        const partial = { animal: null, details: {} };
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                throw new Error('Recognition stream ended unexpectedly');
+            }
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const message = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let event = 'message';
+                let data = '';
+                message.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        event = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        data += line.slice(5).trim();
+                    }
+                });
+                const payload = data ? JSON.parse(data) : {};
+
+                if (event === 'animal') {
+                    partial.animal = payload.animal;
+                    showPartialResult(partial);
+                } else if (event === 'detail') {
+                    partial.details[payload.field] = payload.value;
+                    if (partial.animal) {
+                        showPartialResult(partial);
+                    }
+                } else if (event === 'done') {
+                    reader.cancel();
+                    return payload;
+                } else if (event === 'error') {
+                    reader.cancel();
+                    const error = new Error(payload.error || 'Recognition failed');
+                    error.userFacing = Boolean(payload.error);
+                    throw error;
+                }
+            }
+        }
+    }
+
     function submitImage(formData) {
-        fetch('/api/recognize', {
+        const streaming = window.ReadableStream && window.TextDecoder;
+        fetch(streaming ? '/api/recognize/stream' : '/api/recognize', {
             method: 'POST',
             body: formData
         })
-        .then(async response => {
+        .then(response => {
+            // 202 means the server queued the image; poll until the job finishes
+            if (response.status === 202) {
+                return response.json().then(job => pollRecognitionJob(job.status_url));
+            }
             const contentType = response.headers.get('content-type');
-            if (!response.ok) {
-                const errorData = contentType && contentType.includes('application/json') 
-                    ? await response.json()
-                    : { error: `HTTP error! status: ${response.status}` };
-                throw new Error(errorData.error || `Server error (${response.status})`);
+            if (response.ok && contentType && contentType.includes('text/event-stream')) {
+                return readRecognitionStream(response);
             }
-            return response.json();
+            return parseResponse(response);
         })
         .then(data => {
             if (data.error) {
                 throw new Error(data.error);
             }
-            
-            recognitionResult.innerHTML = `
-                <div class="alert alert-success">
-                    <h4 class="alert-heading">
-                        <i class="fas fa-check-circle me-2"></i>${data.result}
-                    </h4>
-                    <hr>
-                    <div class="animal-details">
-                        <p><strong>Habitat:</strong> ${data.details.habitat}</p>
-                        <p><strong>Diet:</strong> ${data.details.diet}</p>
-                        <p><strong>Behavior:</strong> ${data.details.behavior}</p>
-                        <h5 class="mt-3">Interesting Facts:</h5>
-                        <ul class="list-unstyled">
-                            ${data.details.interesting_facts.map(fact => 
-                                `<li><i class="fas fa-circle-info me-2"></i>${fact}</li>`
-                            ).join('')}
-                        </ul>
-                    </div>
-                </div>
-            `;
-
-            if (data.new_badges && data.new_badges.length > 0) {
-                showNotification(`Congratulations! You earned ${data.new_badges.length} new badge(s): ${data.new_badges.join(', ')}`);
-            }
+            showRecognitionResult(data);
         })
         .catch(error => {
-            showErrorMessage('Failed to process image. Please try again or use a different image.', error);
+            const message = error.userFacing
+                ? error.message
+                : 'Failed to process image. Please try again or use a different image.';
+            showErrorMessage(message, error);
         });
     }
 